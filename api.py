@@ -0,0 +1,282 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import weakref
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# How much history `/history` returns without a `seconds` parameter, and at most.
+DEFAULT_HISTORY_SECONDS = 60 * 60
+MAX_HISTORY_SECONDS = 7 * 24 * 60 * 60
+# How many distinct history responses are kept between two snapshots.
+HISTORY_CACHE_SIZE = 8
+# Measurements queued for a Server-Sent Events client that isn't keeping up. Older ones are dropped first.
+EVENT_QUEUE_SIZE = 16
+# How often an idle event stream gets a comment, so proxies and clients don't time it out.
+EVENT_KEEPALIVE_SECONDS = 15
+# How long a kept-alive connection may sit idle between requests.
+IDLE_TIMEOUT_SECONDS = 30
+MAX_HEADER_BYTES = 8192
+
+ENDPOINTS = ('/state', '/history', '/events')
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    503: 'Service Unavailable'}
+
+API_REQUESTS = metrics.counter('cheesecave_api_requests', 'Requests to the read API, by path and status.',
+    ['path', 'status'])
+
+# Every read API of the process, so the gauge below is registered once however many there are.
+_APIS = weakref.WeakSet()
+metrics.gauge('cheesecave_api_event_streams', 'Clients connected to the measurement event stream.',
+    lambda: sum(len(api._subscribers) for api in list(_APIS)))
+
+
+class _Response:
+    """A JSON body encoded once, along with its entity tag."""
+
+    def __init__(self, value):
+        self.body = json.dumps(value, default=str).encode()
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=12).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # Weak comparison, as If-None-Match calls for.
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+class ReadApi:
+    """Serves the controller's latest snapshot and recent history over HTTP, and streams its measurements as
+    Server-Sent Events.
+
+    The controller publishes a snapshot after every measurement, and requests only ever read the last one published: its
+    JSON is encoded on the first request that needs it and then served as is, with an entity tag for conditional
+    requests. However many dashboards poll, the sensors and etcd see no extra load. Everything network related runs on an
+    asyncio loop in a thread of its own.
+
+    Endpoints: `/state` (the snapshot), `/history?seconds=N` and `/events` (a measurement per event).
+    """
+
+    def __init__(self, history=None, time_func=time.time):
+        self._history = history
+        self._time = time_func
+        self._loop = None
+        self._server = None
+        self._thread = None
+        # The last published snapshot (a function returning it), its version and its encoded response (once a request
+        # needed it).
+        self._version = 0
+        self._snapshot = None
+        self._state_response = None
+        self._history_responses = {}
+        # One queue per connected event stream.
+        self._subscribers = set()
+        # Every open connection, with its writer, so closing the API can end them.
+        self._connections = {}
+        _APIS.add(self)
+
+    def start(self, port, host='127.0.0.1'):
+        """Starts serving on `http://host:port/`. Returns once the server listens."""
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, host, port))
+        self._thread = Thread(target=self._loop.run_forever, name='read-api', daemon=True)
+        self._thread.start()
+
+        (bound_host, bound_port) = self._server.sockets[0].getsockname()[:2]
+        logger.info(f'Serving the read API on http://{bound_host}:{bound_port}/.')
+        return bound_port
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        async def stop():
+            self._server.close()
+            # Event streams end on a None event. Idle connections end once their socket is closed under them.
+            for queue in self._subscribers:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            for writer in self._connections.values():
+                writer.close()
+
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def publish(self, snapshot, measurement):
+        """Makes what `snapshot()` returns what `/state` serves, and sends `measurement` to every event stream. Can be
+        called from any thread, and only costs a few assignments until someone asks for the snapshot: it's only called
+        then, from the API's thread, so it has to return what was captured when it was published."""
+        if self._loop is None:
+            return
+
+        self._loop.call_soon_threadsafe(self._published, snapshot, measurement)
+
+    def _published(self, snapshot, measurement):
+        self._version += 1
+        self._snapshot = snapshot
+        self._state_response = None
+        # New measurements were appended to the history too.
+        self._history_responses = {}
+
+        if not self._subscribers:
+            return
+
+        event = f'id: {self._version}\nevent: measurement\ndata: {json.dumps(measurement, default=str)}\n\n'.encode()
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            # Connections are kept alive, so polling dashboards don't pay for a new connection on every request.
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT_SECONDS)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 'GET', '-', 400, None)
+                    return
+
+                if len(head) > MAX_HEADER_BYTES:
+                    await self._respond(writer, 'GET', '-', 400, None)
+                    return
+
+                (request_line, *header_lines) = head.decode('latin-1').split('\r\n')
+                try:
+                    (method, target, version) = request_line.split(' ')
+                except ValueError:
+                    await self._respond(writer, 'GET', '-', 400, None)
+                    return
+
+                headers = {}
+                for line in header_lines:
+                    (name, _, value) = line.partition(':')
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                if not await self._route(writer, method, target, headers, keep_alive) or not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception('Failed to serve a read API request.')
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _route(self, writer, method, target, headers, keep_alive):
+        """Answers a request. Returns whether the connection can take another one."""
+        url = urlsplit(target)
+
+        if method not in ('GET', 'HEAD'):
+            await self._respond(writer, method, url.path, 405, None, keep_alive)
+        elif url.path == '/events':
+            await self._stream_events(writer)
+            return False
+        elif url.path == '/state':
+            if self._snapshot is None:
+                await self._respond(writer, method, url.path, 503, None, keep_alive)
+                return True
+
+            if self._state_response is None:
+                self._state_response = _Response({'version': self._version, **self._snapshot()})
+            await self._respond(writer, method, url.path, 200, self._state_response, keep_alive,
+                headers.get('if-none-match'))
+        elif url.path == '/history' and self._history is not None:
+            try:
+                seconds = int(parse_qs(url.query).get('seconds', [DEFAULT_HISTORY_SECONDS])[0])
+            except ValueError:
+                await self._respond(writer, method, url.path, 400, None, keep_alive)
+                return True
+
+            response = await self._history_response(max(1, min(seconds, MAX_HISTORY_SECONDS)))
+            await self._respond(writer, method, url.path, 200, response, keep_alive, headers.get('if-none-match'))
+        else:
+            await self._respond(writer, method, url.path, 404, None, keep_alive)
+
+        return True
+
+    async def _history_response(self, seconds):
+        response = self._history_responses.get(seconds)
+        if response is not None:
+            return response
+
+        # The history may have to be read from the SD card, which mustn't hold up the other connections.
+        version = self._version
+        records = await asyncio.get_running_loop().run_in_executor(
+            None, self._history.query, self._time() - seconds)
+        response = _Response({'seconds': seconds, 'records': [record._asdict() for record in records]})
+
+        # Only cached if no snapshot was published while reading, since that one may have added records.
+        if version == self._version and len(self._history_responses) < HISTORY_CACHE_SIZE:
+            self._history_responses[seconds] = response
+
+        return response
+
+    async def _respond(self, writer, method, path, status, response, keep_alive=False, if_none_match=None):
+        head = [f'HTTP/1.1 {status} {REASONS[status]}', 'Access-Control-Allow-Origin: *',
+            f'Connection: {"keep-alive" if keep_alive else "close"}']
+        body = b''
+
+        if response is not None:
+            head += [f'ETag: {response.etag}', 'Cache-Control: no-cache']
+            if _etag_matches(if_none_match, response.etag):
+                status = 304
+                head[0] = f'HTTP/1.1 304 {REASONS[304]}'
+            else:
+                head.append('Content-Type: application/json')
+                body = response.body
+
+        if status != 304:
+            head.append(f'Content-Length: {len(body)}')
+
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+        API_REQUESTS.inc(path if path in ENDPOINTS else 'other', str(status))
+
+    async def _stream_events(self, writer):
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+            'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        API_REQUESTS.inc('/events', '200')
+
+        queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    event = b': keepalive\n\n'
+
+                if event is None:
+                    return
+
+                writer.write(event)
+                await writer.drain()
+        finally:
+            self._subscribers.discard(queue)
@@ -0,0 +1,294 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from graph import HistoryGraph
+from history import HistoryStore
+from simulation import DAY_SECONDS, Simulation
+from state import CheeseCaveControllerMode
+from stats import RollingStats
+
+
+logger = logging.getLogger(__name__)
+
+# Benchmarks whose median got slower than this (as a ratio of the baseline's) are reported as regressions.
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+
+def _time_calls(function, iterations, setup=None, batch=1):
+    """Returns how long each of `iterations` calls of `function` took. `setup` runs untimed before every call.
+
+    Calls too short to time one by one are timed in batches of `batch` calls, each giving their average.
+    """
+    durations = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+
+        started = time.perf_counter()
+        for _ in range(batch):
+            function()
+        durations.append((time.perf_counter() - started) / batch)
+
+    return durations
+
+
+def _summary(durations, **extra):
+    durations = sorted(durations)
+
+    return {
+        'iterations': len(durations),
+        'median_seconds': statistics.median(durations),
+        'mean_seconds': statistics.fmean(durations),
+        'p95_seconds': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'min_seconds': durations[0],
+        **extra,
+    }
+
+
+class Benchmarks:
+    """Times the controller's hot paths, headless, against the simulation's fakes."""
+
+    def __init__(self, scale=1.0):
+        self._scale = scale
+        self._simulation = Simulation(refill_every_seconds=0)
+        self._controller = self._simulation.controller
+        self._clock = self._simulation.clock
+
+    def _iterations(self, count):
+        return max(1, int(count * self._scale))
+
+    def close(self):
+        self._simulation.close()
+
+    def run(self):
+        results = {}
+        for name in sorted(dir(self)):
+            if not name.startswith('benchmark_'):
+                continue
+
+            logger.info(f'Running {name}.')
+            results.update(getattr(self, name)())
+
+        return results
+
+    def benchmark_render(self):
+        display_controller = self._controller.display_controller
+        state = self._controller.state
+        results = {}
+
+        for mode in CheeseCaveControllerMode:
+            state.mode = mode
+
+            def change_texts():
+                # A new humidity every time, so the frame has to be composed again.
+                state.humidity = (state.humidity + 0.1) % 100
+
+            def switch_mode():
+                # Coming from another mode is the full redraw of the option bar and every text.
+                change_texts()
+                display_controller._rendered_mode = None
+
+            switch = _time_calls(display_controller.update_image, self._iterations(200), setup=switch_mode)
+            image = _time_calls(display_controller.update_image, self._iterations(200), setup=change_texts)
+            refresh = _time_calls(lambda: display_controller.update_display(force=True), self._iterations(200),
+                setup=change_texts)
+
+            results[f'render.{mode.name.lower()}.mode_switch'] = _summary(switch)
+            results[f'render.{mode.name.lower()}.update_image'] = _summary(image)
+            results[f'render.{mode.name.lower()}.update_display'] = _summary(refresh)
+
+        state.mode = CheeseCaveControllerMode.GENERAL_INFO
+        return results
+
+    def benchmark_measure(self):
+        measurement_delay_seconds = self._controller.configs.measurement_delay_seconds
+
+        def next_tick():
+            self._clock.advance_to(self._clock.monotonic() + measurement_delay_seconds)
+
+        durations = _time_calls(self._controller.measure, self._iterations(2000), setup=next_tick)
+        return {'measure.tick': _summary(durations, ticks_per_second=len(durations) / sum(durations))}
+
+    def benchmark_window_stats(self):
+        results = {}
+
+        for capacity in (12, 720, 17280):
+            stats = RollingStats(capacity)
+            samples = self._iterations(100000)
+
+            started = time.perf_counter()
+            for i in range(samples):
+                stats.add(50 + (i % 17) * 0.1, i * 5.0)
+            elapsed = time.perf_counter() - started
+
+            snapshots = _time_calls(stats.snapshot, self._iterations(100), batch=100)
+
+            results[f'window_stats.add.{capacity}'] = _summary(
+                [elapsed / samples], iterations=samples, samples_per_second=samples / elapsed)
+            results[f'window_stats.snapshot.{capacity}'] = _summary(snapshots)
+
+        return results
+
+    def benchmark_state_serialization(self):
+        results = {}
+
+        for state in (self._controller.configs, self._controller.state):
+            name = state.etcd_path.strip('/').replace('/', '.')
+            serialized = state._serialize()
+
+            dumps = _time_calls(lambda: state._serialize(), self._iterations(100), batch=100)
+            loads = _time_calls(lambda: json.loads(serialized), self._iterations(100), batch=100)
+
+            results[f'state_serialization.{name}.dumps'] = _summary(dumps, size_bytes=len(serialized.encode()))
+            results[f'state_serialization.{name}.loads'] = _summary(loads, size_bytes=len(serialized.encode()))
+
+        # A whole store: serializing, writing the local snapshot and handing the write over to etcd.
+        state = self._controller.state
+
+        def change_state():
+            state.desired_humidity = 50 if state.desired_humidity != 50 else 51
+
+        stores = _time_calls(state._store_state, self._iterations(200), setup=change_state)
+        results['state_serialization.store_state'] = _summary(stores)
+
+        return results
+
+    def benchmark_watch_events(self):
+        state = self._controller.state
+        stored = state.to_dict()
+        events = []
+        for i in range(self._iterations(5000)):
+            # Alternating values, so every event actually changes the state.
+            events.append(json.dumps({**stored, 'desired_humidity': 60 + i % 2}))
+
+        # Every event is newer than anything the state has seen, as it would be coming from the watch.
+        revision = state._etcd_revision or 0
+        durations = []
+        for event in events:
+            revision += 1
+            started = time.perf_counter()
+            state.apply_stored_state(event, revision)
+            durations.append(time.perf_counter() - started)
+
+        return {'watch_events.apply_stored_state': _summary(
+            durations, events_per_second=len(durations) / sum(durations))}
+
+    def benchmark_graph(self):
+        now = self._clock.time()
+        measurement_delay_seconds = self._controller.configs.measurement_delay_seconds
+        with tempfile.TemporaryDirectory() as directory:
+            history = HistoryStore(directory, time_func=lambda: now)
+            # A whole day of measurements.
+            for i in range(int(DAY_SECONDS / measurement_delay_seconds)):
+                timestamp = now - DAY_SECONDS + i * measurement_delay_seconds
+                history.append(timestamp, 12 + (i % 97) * 0.01, 50 + (i % 89) * 0.05, i % 2)
+            history.flush()
+
+            def full_day():
+                HistoryGraph(history, DAY_SECONDS, 200).update(now)
+
+            graph = HistoryGraph(history, DAY_SECONDS, 200)
+            graph.update(now)
+
+            def new_measurement():
+                nonlocal now
+                now += measurement_delay_seconds
+                history.append(now, 12, 50, 0)
+
+            full = _time_calls(full_day, self._iterations(20))
+            incremental = _time_calls(lambda: graph.update(now), self._iterations(200), setup=new_measurement)
+
+        return {
+            'graph.full_day': _summary(full),
+            'graph.incremental': _summary(incremental),
+        }
+
+    def benchmark_simulated_day(self):
+        simulation = Simulation(seed=1)
+        try:
+            summary = simulation.run(DAY_SECONDS * min(1.0, self._scale))
+        finally:
+            simulation.close()
+
+        return {'simulation.day': _summary(
+            [summary['wall_seconds'] / summary['simulated_days']],
+            cpu_seconds_per_simulated_day=summary['cpu_seconds_per_simulated_day'],
+            peak_rss_megabytes=summary['peak_rss_megabytes'],
+        )}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Returns the benchmarks of `current` whose median is slower than `threshold` times the baseline's."""
+    regressions = {}
+
+    for name, result in current['results'].items():
+        baseline_result = baseline['results'].get(name)
+        if baseline_result is None or not baseline_result['median_seconds']:
+            continue
+
+        ratio = result['median_seconds'] / baseline_result['median_seconds']
+        if ratio > threshold:
+            regressions[name] = ratio
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the controller\'s hot paths against simulated hardware.')
+    parser.add_argument('--output', help='Where to write the results, as JSON. Defaults to stdout.')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    parser.add_argument('--scale', type=float, default=1.0, help='Scales the number of iterations of every benchmark.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(module)s: %(message)s', level=logging.INFO)
+    # The controller's own logs would only add noise, and time, to the results.
+    for name in ('main', 'display', 'etcdstate', 'sensorhealth', 'humidifier', 'scheduler'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    benchmarks = Benchmarks(scale=args.scale)
+    try:
+        results = benchmarks.run()
+    finally:
+        benchmarks.close()
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.time(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+
+        for name, ratio in sorted(regressions.items()):
+            logger.warning(f'{name} is {ratio:.2f}x slower than the baseline.')
+
+        sys.exit(1 if regressions else 0)
@@ -1,31 +1,127 @@
-from etcdstate import EtcdBackedState
+from display import DEFAULT_MATERIAL_FIELDS, MATERIAL_FIELDS
+from etcdstate import SNAPSHOT_DIRECTORY, EtcdBackedState
+from pulse import DEFAULT_HUMIDIFIER_MODEL, DEFAULT_PULSE_PROFILES
+from schema import Field, at_least, each_one_of, greater_than, one_of, prefer_remote
+from sensors import validate_sensor_list
+
+
+def _drop_humidifier_decision_delay(configs):
+    # Humidifier decisions are made on every measurement since the humidifier policy was introduced.
+    configs.pop('humidifier_decision_delay_seconds', None)
+    return configs
 
 
 class CheeseCaveConfigs(EtcdBackedState):
-    def __init__(self):
-        super().__init__('/cheesecave/config')
-
-    def default_state(self):
-        return {
-            # How many sensors are plugged in.
-            'sensors': 0,
-            # Whether the humidifier is plugged in.
-            'humidifier_connected': False,
-
-            # How long to wait without any button press before returning to the general info menu.
-            'menu_return_delay_seconds': 20,
-            # How long to wait before grabbing temperature and humidity data.
-            'sensor_delay_seconds': 5,
-            # How long to wait before updating the e-ink display.
-            'display_update_delay_seconds': 60,
-            # How long to wait before updating the e-ink display if a delay was requested due to user input.
-            'display_update_input_delay_seconds': 3,
-            # How long to keep heater running when it's supposed to run.
-            'heater_on_seconds': 1,
-            # How long to wait before turning on heater again.
-            'heater_delay_seconds': 20,
-            # How long to wait between measurements.
-            'measurement_delay_seconds': 5,
-            # How long to wait between deciding humidifier action.
-            'humidifier_decision_delay_seconds': 60,
-        }
+    __slots__ = ('_changed_hook',)
+
+    schema_version = 1
+    migrations = {
+        0: _drop_humidifier_decision_delay,
+    }
+    # Configs are edited remotely. A local change conflicting with a remote one gives way.
+    default_merge = staticmethod(prefer_remote)
+
+    # How many sensors are plugged in. Only used when `sensor_list` is empty, with sensors at 0x44 and 0x45.
+    sensors = Field(0, validate=at_least(0))
+    # Every sensor plugged in, as objects with an `address` and, for sensors behind a TCA9548A multiplexer, its `mux_address` and `mux_channel`.
+    sensor_list = Field([], validate=validate_sensor_list)
+    # How many measurements per second the sensors take on their own (0.5, 1, 2, 4 or 10).
+    sensor_frequency = Field(1, validate=one_of(0.5, 1, 2, 4, 10))
+    # Whether sensors use their accelerated response time mode (4 measurements per second) instead.
+    sensor_art_mode = Field(False)
+    # How long a sensor read can take before it's considered failed. With 0, reads aren't bounded at all.
+    sensor_read_timeout_seconds = Field(0.5, validate=at_least(0))
+    # How long to wait before retrying a failed sensor. Doubles on every failure in a row, up to `sensor_retry_max_seconds`.
+    sensor_retry_base_seconds = Field(5, validate=at_least(0))
+    sensor_retry_max_seconds = Field(300, validate=at_least(0))
+    # How many failures in a row get a sensor quarantined. Quarantined sensors are only retried every `sensor_retry_max_seconds`.
+    sensor_quarantine_failures = Field(5, validate=at_least(1))
+    # How many (scaled) median absolute deviations away a reading has to be to get rejected as an outlier.
+    sensor_outlier_threshold = Field(3.5, validate=at_least(0))
+    # Whether the humidifier is plugged in.
+    humidifier_connected = Field(False)
+    # Which humidifier model is plugged in. Picks how its button is pressed from `humidifier_pulse_profiles`.
+    humidifier_model = Field(DEFAULT_HUMIDIFIER_MODEL)
+    # Per model, how long a press and the pause between presses last, and how many presses turn it on and off.
+    humidifier_pulse_profiles = Field(DEFAULT_PULSE_PROFILES)
+    # How long changes to the state and to these configs are collected before they're stored, locally and in etcd.
+    store_coalesce_seconds = Field(2, validate=at_least(0))
+
+    # How long to wait without any button press before returning to the general info menu.
+    menu_return_delay_seconds = Field(20, validate=at_least(0))
+    # How long to wait before grabbing temperature and humidity data.
+    sensor_delay_seconds = Field(5, validate=at_least(0))
+    # How long to wait before updating the e-ink display.
+    display_update_delay_seconds = Field(60, validate=greater_than(0))
+    # How long to wait before updating the e-ink display if a delay was requested due to user input.
+    display_update_input_delay_seconds = Field(3, validate=at_least(0))
+    # Which displayed fields have to change for the e-ink display to be refreshed. See `display.MATERIAL_FIELDS`.
+    display_material_fields = Field(DEFAULT_MATERIAL_FIELDS, validate=each_one_of(*MATERIAL_FIELDS))
+    # How long the e-ink display can go without a refresh when nothing material changes.
+    display_max_unchanged_seconds = Field(30 * 60, validate=at_least(0))
+    # How much history the graph screen shows.
+    display_graph_seconds = Field(24 * 60 * 60, validate=at_least(60))
+    # How long to keep heater running when it's supposed to run.
+    heater_on_seconds = Field(1, validate=greater_than(0))
+    # How long to wait before turning on heater again.
+    heater_delay_seconds = Field(20, validate=greater_than(0))
+    # How long sensors take to cool down after the heater was turned off. Measurements wait until then.
+    heater_settle_seconds = Field(5, validate=at_least(0))
+    # How long to wait between measurements.
+    measurement_delay_seconds = Field(5, validate=at_least(0.1))
+    # How measurements are paced: 'fixed' takes one every `measurement_delay_seconds`, 'adaptive' takes one every
+    # `measurement_min_delay_seconds` while readings move and backs off up to `measurement_max_delay_seconds` while they're steady.
+    measurement_mode = Field('fixed', validate=one_of('fixed', 'adaptive'))
+    measurement_min_delay_seconds = Field(2, validate=at_least(0.1))
+    measurement_max_delay_seconds = Field(30, validate=at_least(0.1))
+    # How much longer the delay gets after every steady measurement, in adaptive mode.
+    measurement_backoff_factor = Field(1.5, validate=at_least(1))
+    # Readings count as moving once the humidity trend (in % RH per minute), the temperature trend (in °C per minute) or
+    # the spread of humidity readings (standard deviation, in % RH) over the window reaches these.
+    measurement_humidity_trend_threshold = Field(0.5, validate=at_least(0))
+    measurement_temperature_trend_threshold = Field(0.2, validate=at_least(0))
+    measurement_humidity_stddev_threshold = Field(1.5, validate=at_least(0))
+    # How far back the averaged temperature and humidity (and their stats) go.
+    measurement_window_seconds = Field(60, validate=at_least(1))
+    # How the humidifier is controlled on every new measurement: 'hysteresis' or 'pi'.
+    humidifier_control_mode = Field('hysteresis', validate=one_of('hysteresis', 'pi'))
+    # Width of the band around the desired humidity (in % RH) where the humidifier is left as it is, in hysteresis mode.
+    humidifier_hysteresis = Field(2, validate=at_least(0))
+    # Minimum time the humidifier stays on after being turned on, and off after being turned off.
+    humidifier_min_on_seconds = Field(60, validate=at_least(0))
+    humidifier_min_off_seconds = Field(120, validate=at_least(0))
+    # PI mode gains, in duty cycle per % RH and per % RH second of error.
+    humidifier_pi_kp = Field(0.1)
+    humidifier_pi_ki = Field(0.0005)
+    # In PI mode, the humidifier runs for the computed duty cycle of every period this long.
+    humidifier_pi_period_seconds = Field(600, validate=at_least(1))
+
+    # Port of the local endpoint serving Prometheus metrics on /metrics. 0 disables it. Metrics are only recorded
+    # when this endpoint or the textfile below is enabled.
+    metrics_http_port = Field(0, validate=at_least(0))
+    # Address the metrics endpoint listens on. Only local scrapes by default.
+    metrics_http_host = Field('127.0.0.1')
+    # Where to write metrics for node_exporter's textfile collector, every `metrics_textfile_seconds`. Empty disables it.
+    metrics_textfile_path = Field('')
+    metrics_textfile_seconds = Field(15, validate=at_least(1))
+
+    # Port of the local read API (see `api.ReadApi`), serving the live state, recent history and a measurement stream. 0
+    # disables it.
+    api_http_port = Field(0, validate=at_least(0))
+    # Address the read API listens on. Only local clients by default.
+    api_http_host = Field('127.0.0.1')
+
+    # Where the measurement history is kept.
+    history_directory = Field('/var/lib/cheesecave/history')
+    # How long measurements are batched in memory before being written to the history. Longer delays mean fewer SD card writes, but more history lost on a crash.
+    history_flush_seconds = Field(300, validate=greater_than(0))
+
+    def __init__(self, scheduler=None, connection=None, snapshot_directory=SNAPSHOT_DIRECTORY, changed_hook=None):
+        # Called with the names of the configs that changed in etcd, from whichever thread applied the change. Set before
+        # registering, since the first reconciliation may already change some.
+        self._changed_hook = changed_hook
+        super().__init__('/cheesecave/config', scheduler, connection, snapshot_directory)
+
+    def state_changed(self, changed_fields):
+        if self._changed_hook is not None:
+            self._changed_hook(changed_fields)
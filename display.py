@@ -1,9 +1,20 @@
 import os
+import hashlib
+import logging
+import string
+import time
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+from PIL import Image, ImageDraw
+from glyphs import Typeface, load_atlases
+from graph import HistoryGraph
 from state import CheeseCaveControllerMode
+from sensorhealth import OK as SENSOR_OK
+import metrics
 
 
+logger = logging.getLogger(__name__)
+
 if os.name == "nt":
     SMALL_FONT_PATH = "C:\\Windows\\Fonts\\dejavusans-bold.ttf"
     MEDIUM_FONT_PATH = "C:\\Windows\\Fonts\\dejavusans-bold.ttf"
@@ -13,21 +24,56 @@ else:
     MEDIUM_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
     LARGE_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
 
-SMALL_FONT = ImageFont.truetype(SMALL_FONT_PATH, 14)
-MEDIUM_FONT = ImageFont.truetype(MEDIUM_FONT_PATH, 20)
-LARGE_FONT = ImageFont.truetype(LARGE_FONT_PATH, 24)
-ICON_FONT = ImageFont.truetype(
-    os.path.join(os.path.dirname(os.path.realpath(__file__)), "font", "picol.ttf"), 18
-)
+ICON_FONT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "font", "picol.ttf")
+
+# Nothing is opened until something has to be drawn without a glyph atlas, see `load_glyph_atlases`.
+SMALL_FONT = Typeface(SMALL_FONT_PATH, 14)
+MEDIUM_FONT = Typeface(MEDIUM_FONT_PATH, 20)
+LARGE_FONT = Typeface(LARGE_FONT_PATH, 24)
+ICON_FONT = Typeface(ICON_FONT_PATH, 18)
+
+
+# How many distinct (font, text) pairs to keep metrics and rasterized sprites for.
+TEXT_CACHE_SIZE = 128
 
 
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
 def get_text_dimensions(font, text):
-    (left, top, right, bottom) = font.getbbox(text, anchor="lt")
+    (left, top, right, bottom) = font.bbox(text)
     return (right - left, bottom - top)
 
 
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def get_text_sprite(font, text):
+    """Rasterizes black on white text. Returns the sprite and its offset from where `ImageDraw.text` would draw it."""
+    (left, top, right, bottom) = font.bbox(text)
+    left = min(0, left)
+    top = min(0, top)
+
+    sprite = Image.new(IMAGE_MODE, (right - left, bottom - top), color=WHITE)
+    font.draw(ImageDraw.Draw(sprite), (-left, -top), text, BLACK)
+
+    return (sprite, (left, top))
+
+
+def _layer_box(layer):
+    ((x, y), sprite) = layer
+    return (x, y, x + sprite.width, y + sprite.height)
+
+
+def _same_layer(a, b):
+    # Sprites come from a cache, so an unchanged text gives the very same sprite object.
+    return a is not None and a[0] == b[0] and a[1] is b[1]
+
+
+def _boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
 ARROW_UP = "\ue80b"
 ARROW_DOWN = "\ue806"
+ARROW_LEFT = "\ue807"
+CHART = "\ue9d3"
 FAN = "\ue89a"
 SETTINGS = "\ue9b0"
 SHUTDOWN = "\ue86b"
@@ -36,20 +82,99 @@ LINK_EDIT = "\ue93c"
 LINK_REMOVE = "\ue93d"
 
 MODE_ICONS = {
-    CheeseCaveControllerMode.GENERAL_INFO: [FAN, SETTINGS],
+    CheeseCaveControllerMode.GENERAL_INFO: [FAN, CHART],
     CheeseCaveControllerMode.HUMIDITY_SET: [ARROW_UP, ARROW_DOWN],
     CheeseCaveControllerMode.SETTINGS: [SHUTDOWN, LINK_EDIT],
     CheeseCaveControllerMode.WATER_SET: [LINK_REMOVE, LINK_ADD],
+    CheeseCaveControllerMode.HISTORY: [ARROW_LEFT, SETTINGS],
+}
+
+# How fast humidity has to change (in % RH per minute) before a trend arrow is shown next to it.
+HUMIDITY_TREND_ARROW_THRESHOLD = 0.5
+TREND_UP = "\u2191"
+TREND_DOWN = "\u2193"
+
+# Every character the texts of the display are made of, which is what the glyph atlases are built for.
+TEXT_CHARSET = string.digits + string.ascii_letters + string.punctuation + " \u00b0\u00b7" + TREND_UP + TREND_DOWN
+ICON_CHARSET = "".join(sorted({icon for icons in MODE_ICONS.values() for icon in icons if icon is not None}))
+GLYPH_CHARSETS = {
+    SMALL_FONT: TEXT_CHARSET,
+    MEDIUM_FONT: TEXT_CHARSET,
+    LARGE_FONT: TEXT_CHARSET,
+    ICON_FONT: ICON_CHARSET,
 }
 
-WHITE = (255, 255, 255)
-BLACK = (0, 0, 0)
+
+def load_glyph_atlases(directory):
+    """Gives the display's fonts their glyph atlases, cached in `directory`. Meant to be called once at startup, before
+    anything is drawn: the first start builds the atlases, every later one just reads them."""
+    load_atlases(GLYPH_CHARSETS, directory)
+
+# Everything is drawn straight in 1-bit, which is what the e-ink panel displays anyway.
+IMAGE_MODE = "1"
+WHITE = 1
+BLACK = 0
+
+# How to turn the image into the panel's native orientation, for each rotation of the display driver.
+NATIVE_TRANSPOSE = {
+    0: None,
+    1: Image.Transpose.ROTATE_270,
+    2: Image.Transpose.ROTATE_180,
+    3: Image.Transpose.ROTATE_90,
+}
+INVERTED_BYTES = bytes(b ^ 0xFF for b in range(256))
+
+
+@lru_cache(maxsize=None)
+def _row_padding_mask(width, height):
+    """Returns the bits padding every row of a packed 1-bit frame to a byte, as an integer over the whole frame."""
+    stride = (width + 7) // 8
+    row = (1 << (stride * 8 - width)) - 1
+    return int.from_bytes(bytes([0] * (stride - 1) + [row]) * height, "big")
+
+# How much the debug image is scaled up when shown, since 1-bit text is hard to read at the panel's size.
+PREVIEW_SCALE = 3
+
+UPDATE_DISPLAY_SECONDS = metrics.histogram(
+    "cheesecave_update_display_seconds", "Time spent in each stage of a display update.", ["stage"])
+DISPLAY_UPDATES = metrics.counter(
+    "cheesecave_display_updates", "Display updates, by whether the panel was refreshed.", ["result"])
+
+# Fields whose change warrants an e-ink refresh. "time" is the "Updated at" line, which on its own isn't worth a multi-second refresh.
+MATERIAL_FIELDS = ["mode", "temperature", "humidity", "desired_humidity", "water_level", "sensors", "time"]
+DEFAULT_MATERIAL_FIELDS = ["mode", "temperature", "humidity", "desired_humidity", "water_level", "sensors"]
+# Even when nothing material changed, refresh after this long so the "Updated at" line doesn't go too stale.
+DEFAULT_MAX_UNCHANGED_SECONDS = 30 * 60
+
+# How much history the graph screen shows.
+DEFAULT_GRAPH_SECONDS = 24 * 60 * 60
+# Smallest range of values a graph spans vertically, so sensor noise on a steady cave doesn't look like wild swings.
+GRAPH_MIN_HUMIDITY_SPAN = 4
+GRAPH_MIN_TEMPERATURE_SPAN = 2
+# Spacing of the dots of the desired humidity line.
+GRAPH_DOT_SPACING = 4
 
 
 class DisplayController:
-    def __init__(self, display, state):
+    def __init__(self, display, state, material_fields=DEFAULT_MATERIAL_FIELDS,
+            max_unchanged_seconds=DEFAULT_MAX_UNCHANGED_SECONDS, clock=time, history=None,
+            graph_seconds=DEFAULT_GRAPH_SECONDS):
         self.display = display
         self.state = state
+        # Where the graph screen gets its data from. Without a history, it only says there's nothing to show.
+        self._history = history
+        # Anything with `time()` and `monotonic()`, like the `time` module or a simulation's virtual clock.
+        self._clock = clock
+
+        self.reconfigure(material_fields, max_unchanged_seconds, graph_seconds)
+
+        # What was last pushed to the panel, to tell whether a new frame is worth a refresh.
+        self._last_frame_key = None
+        self._last_frame_digest = None
+        self._last_refresh_time = None
+
+        self.refreshes_performed = 0
+        self.refreshes_skipped = 0
 
         if self.display is None:
             # This branch is used for emulation.
@@ -57,7 +182,7 @@ class DisplayController:
         else:
             self._display_dimension = (self.display.width, self.display.height)
 
-        self._image = Image.new("RGB", self._display_dimension, color=WHITE)
+        self._image = Image.new(IMAGE_MODE, self._display_dimension, color=WHITE)
         self._image_draw = ImageDraw.Draw(self._image)
 
         self._temperature_text = ""
@@ -65,10 +190,30 @@ class DisplayController:
         self._desired_humidity_text = ""
         self._time_text = ""
         self._water_level_text = ""
+        self._sensors_text = ""
 
         self._option_bar_width = 0
         self._top_bar_height = 0
 
+        # The option bar of every mode is rendered once, and then just pasted in when the mode changes.
+        self._option_bars = {mode: self._render_option_bar(mode) for mode in CheeseCaveControllerMode}
+        self._rendered_mode = None
+        # Position and sprite of every text currently on the image, so unchanged texts aren't redrawn.
+        self._layers = {}
+
+        # Created on first use, once the graph's width is known. Its buckets are kept up to date from then on.
+        self._graph = None
+        # Labels and pixel spans of the graph screen as last computed. They decide whether the graph needs a refresh.
+        self._graph_sections = None
+
+    def reconfigure(self, material_fields, max_unchanged_seconds, graph_seconds):
+        """Applies new settings from the next update on. Can be called from any thread. `material_fields` are checked
+        by the configs against `MATERIAL_FIELDS`."""
+        self.material_fields = list(material_fields)
+        self.max_unchanged_seconds = max_unchanged_seconds
+        # The graph is rebuilt over the new span by the next update that draws it.
+        self._graph_seconds = graph_seconds
+
     @property
     def width(self):
         return self._display_dimension[0]
@@ -80,6 +225,13 @@ class DisplayController:
     def update_texts(self):
         self._temperature_text = f"{self.state.temperature:.1f} °C {(self.state.temperature * 9 / 5) + 32:.1f} °F"
         self._humidity_text = f"{self.state.humidity:.1f}% RH"
+
+        humidity_trend = self.state.humidity_stats.trend * 60
+        if humidity_trend >= HUMIDITY_TREND_ARROW_THRESHOLD:
+            self._humidity_text += f" {TREND_UP}"
+        elif humidity_trend <= -HUMIDITY_TREND_ARROW_THRESHOLD:
+            self._humidity_text += f" {TREND_DOWN}"
+
         self._desired_humidity_text = f"Desired {self.state.desired_humidity:.1f}% RH"
 
         if self.state.has_water:
@@ -87,35 +239,56 @@ class DisplayController:
         else:
             self._water_level_text = "No water"
 
-        self._time_text = f'Updated at {datetime.now().strftime("%H:%M")}'
+        healthy_sensors = [s for s in self.state.sensor_health if s.status == SENSOR_OK]
+        if len(healthy_sensors) < len(self.state.sensor_health):
+            # Sensor trouble takes over most of the top line, since it's what needs attention.
+            self._sensors_text = f"{len(healthy_sensors)}/{len(self.state.sensor_health)} sensors ok"
+            self._time_text = f'{self._now_text()} \u00b7 {self._sensors_text}'
+        else:
+            self._sensors_text = ""
+            self._time_text = f'Updated at {self._now_text()}'
+
+        if self.state.mode == CheeseCaveControllerMode.HISTORY:
+            self._update_graph()
+        else:
+            self._graph_sections = None
+
+    def _now_text(self):
+        return datetime.fromtimestamp(self._clock.time()).strftime("%H:%M")
 
     def show_debug_image(self):
         self.update_image()
-        self._image.show()
+        self._image.resize((self.width * PREVIEW_SCALE, self.height * PREVIEW_SCALE), Image.Resampling.NEAREST).show()
 
     def clear_image(self):
         self._image_draw.rectangle(
             [0, 0, self.width + 1, self.height + 1],
             fill=WHITE,
         )
+        self._layers = {}
 
-    def _draw_option_bar(self):
-        icon_dimensions = [get_text_dimensions(ICON_FONT, i) for i in MODE_ICONS[self.state.mode] if i is not None]
-        self._option_bar_width = 6 + max([d[0] for d in icon_dimensions])
+    def _render_option_bar(self, mode):
+        icon_dimensions = [get_text_dimensions(ICON_FONT, i) for i in MODE_ICONS[mode] if i is not None]
+        option_bar_width = 6 + max([d[0] for d in icon_dimensions])
 
-        self._image_draw.rectangle(
-            [0, 0, self._option_bar_width + 1, self.height + 1], fill=BLACK
-        )
+        bitmap = Image.new(IMAGE_MODE, (option_bar_width + 2, self.height), color=BLACK)
+        bitmap_draw = ImageDraw.Draw(bitmap)
 
-        icon1 = MODE_ICONS[self.state.mode][0]
+        icon1 = MODE_ICONS[mode][0]
         if icon1 is not None:
-            self._image_draw.text(((self._option_bar_width - icon_dimensions[0][0]) / 2, 6), icon1, font=ICON_FONT, fill=WHITE)
+            ICON_FONT.draw(bitmap_draw, ((option_bar_width - icon_dimensions[0][0]) // 2, 6), icon1, WHITE)
 
-        icon2 = MODE_ICONS[self.state.mode][1]
+        icon2 = MODE_ICONS[mode][1]
         if icon2 is not None:
-            self._image_draw.text(((self._option_bar_width - icon_dimensions[1][0]) / 2, 80), icon2, font=ICON_FONT, fill=WHITE)
+            ICON_FONT.draw(bitmap_draw, ((option_bar_width - icon_dimensions[1][0]) // 2, 80), icon2, WHITE)
 
-    def _draw_texts(self):
+        return (option_bar_width, bitmap)
+
+    def _draw_option_bar(self):
+        (self._option_bar_width, bitmap) = self._option_bars[self.state.mode]
+        self._image.paste(bitmap, (0, 0))
+
+    def _layout_texts(self):
         (time_width, time_height) = get_text_dimensions(SMALL_FONT, self._time_text)
         (water_width, water_height) = get_text_dimensions(
             SMALL_FONT, self._water_level_text
@@ -130,15 +303,11 @@ class DisplayController:
             SMALL_FONT, self._desired_humidity_text
         )
 
-        used_height = 2
-
-        self._image_draw.text(
-            (self._option_bar_width + 5, used_height),
-            self._time_text,
-            font=SMALL_FONT,
-            fill=BLACK,
-        )
+        left = self._option_bar_width + 5
+        layout = {}
 
+        used_height = 2
+        layout["time"] = (left, used_height, SMALL_FONT, self._time_text)
         used_height += time_height
 
         unused_height = (
@@ -148,57 +317,234 @@ class DisplayController:
         middle_padding = unused_height / 7
 
         used_height += top_bottom_padding
-
-        self._image_draw.text(
-            (self._option_bar_width + 5, used_height),
-            self._water_level_text,
-            font=SMALL_FONT,
-            fill=BLACK,
-        )
-
+        layout["water_level"] = (left, used_height, SMALL_FONT, self._water_level_text)
         used_height += water_height + middle_padding
-
-        self._image_draw.text(
-            (self._option_bar_width + 5, used_height),
-            self._humidity_text,
-            font=LARGE_FONT,
-            fill=BLACK,
-        )
-
+        layout["humidity"] = (left, used_height, LARGE_FONT, self._humidity_text)
         used_height += humidity_height + middle_padding
-
-        self._image_draw.text(
-            (
-                self._option_bar_width + 5,
-                used_height,
-            ),
-            self._desired_humidity_text,
-            font=SMALL_FONT,
-            fill=BLACK,
-        )
-
+        layout["desired_humidity"] = (left, used_height, SMALL_FONT, self._desired_humidity_text)
         used_height += desired_humidity_height + middle_padding
+        layout["temperature"] = (left, used_height, MEDIUM_FONT, self._temperature_text)
 
-        self._image_draw.text(
-            (
-                self._option_bar_width + 5,
-                used_height,
-            ),
-            self._temperature_text,
-            font=MEDIUM_FONT,
-            fill=BLACK,
-        )
+        return layout
 
-        used_height += temperature_height + top_bottom_padding
+    def _draw_texts(self):
+        layers = {}
+        for name, (x, y, font, text) in self._layout_texts().items():
+            (sprite, (offset_x, offset_y)) = get_text_sprite(font, text)
+            layers[name] = ((round(x) + offset_x, round(y) + offset_y), sprite)
+
+        # Only layers that moved or whose text changed are redrawn, plus any layer overlapping the area being redrawn.
+        redrawn = {name for name, layer in layers.items() if not _same_layer(self._layers.get(name), layer)}
+        dirty_boxes = [_layer_box(self._layers[name]) for name in redrawn if name in self._layers]
+        dirty_boxes += [_layer_box(layers[name]) for name in redrawn]
+
+        overlapping = True
+        while overlapping:
+            overlapping = [
+                name for name in layers.keys() - redrawn
+                if any(_boxes_overlap(_layer_box(layers[name]), box) for box in dirty_boxes)
+            ]
+            redrawn.update(overlapping)
+            dirty_boxes += [_layer_box(layers[name]) for name in overlapping]
+
+        for name in redrawn:
+            if name in self._layers:
+                (left, top, right, bottom) = _layer_box(self._layers[name])
+                self._image_draw.rectangle([left, top, right - 1, bottom - 1], fill=WHITE)
+
+        for name in redrawn:
+            (position, sprite) = layers[name]
+            self._image.paste(sprite, position)
+
+        self._layers = layers
+
+    def _graph_box(self):
+        (option_bar_width, _) = self._option_bars[CheeseCaveControllerMode.HISTORY]
+        return (option_bar_width + 5, 2, self.width - 3, self.height - 2)
+
+    def _update_graph(self):
+        (left, top, right, bottom) = self._graph_box()
+        graph_seconds = self._graph_seconds
+        if self._graph is None or self._graph.window_seconds != graph_seconds:
+            if self._history is None:
+                self._graph_sections = (("No history", None),)
+                return
+            self._graph = HistoryGraph(self._history, graph_seconds, right - left)
+
+        now = self._clock.time()
+        self._graph.update(now)
+
+        hours = f"{graph_seconds / 3600:g}h"
+        section_height = (bottom - top) // 2
+        (_, label_height) = get_text_dimensions(SMALL_FONT, hours)
+        plot_height = section_height - label_height - 6
+
+        sections = []
+        for (i, series, label, unit, min_span, target) in (
+                (0, self._graph.humidity, f"{hours} RH", "%", GRAPH_MIN_HUMIDITY_SPAN, self.state.desired_humidity),
+                (1, self._graph.temperature, "Temp", " °C", GRAPH_MIN_TEMPERATURE_SPAN, None)):
+            columns = series.columns(now)
+            present = [c for c in columns if c is not None]
+            if not present:
+                sections.append((f"{label} no data", None))
+                continue
+
+            minimum = min(c[0] for c in present)
+            maximum = max(c[1] for c in present)
+            text = f"{label} {minimum:.0f}-{maximum:.0f}{unit}" if unit == "%" else \
+                f"{label} {minimum:.1f}-{maximum:.1f}{unit}"
+
+            # Centered on the data when it spans less than the minimum, so a flat line sits in the middle.
+            span = max(maximum - minimum, min_span)
+            low = (minimum + maximum - span) / 2
+            plot_top = top + i * section_height + label_height + 3
+            scale = (plot_height - 1) / span
+
+            def to_y(value):
+                return round(plot_top + (plot_height - 1) - (value - low) * scale)
+
+            spans = []
+            previous = None
+            for column in columns:
+                if column is None:
+                    spans.append(None)
+                    previous = None
+                    continue
+
+                # Stretched to overlap the previous column, so the line stays connected.
+                (column_min, column_max) = column
+                if previous is not None:
+                    column_min = min(column_min, previous[1])
+                    column_max = max(column_max, previous[0])
+                spans.append((to_y(column_max), to_y(column_min)))
+                previous = column
+
+            target_y = to_y(target) if target is not None and low <= target <= low + span else None
+            sections.append((text, (plot_top, plot_height, tuple(spans), target_y)))
+
+        self._graph_sections = tuple(sections)
+
+    def _draw_graph(self):
+        (left, top, right, bottom) = self._graph_box()
+        self._image_draw.rectangle([left, 0, self.width, self.height], fill=WHITE)
+        # Texts are drawn over a blank area again once back on a text screen.
+        self._layers = {}
+
+        section_height = (bottom - top) // 2
+        for (i, (text, plot)) in enumerate(self._graph_sections):
+            (sprite, (offset_x, offset_y)) = get_text_sprite(SMALL_FONT, text)
+            self._image.paste(sprite, (left + offset_x, top + i * section_height + offset_y))
+
+            if plot is None:
+                continue
+
+            (plot_top, plot_height, spans, target_y) = plot
+            self._image_draw.line([left - 1, plot_top, left - 1, plot_top + plot_height - 1], fill=BLACK)
+            if target_y is not None:
+                self._image_draw.point([(x, target_y) for x in range(left, right, GRAPH_DOT_SPACING)], fill=BLACK)
+
+            for (x, span) in enumerate(spans, start=left):
+                if span is not None:
+                    self._image_draw.line([x, span[0], x, span[1]], fill=BLACK)
 
     def update_image(self):
         self.update_texts()
-        self.clear_image()
-
-        self._draw_option_bar()
-        self._draw_texts()
-
-    def update_display(self):
-        self.update_image()
-        self.display.image(self._image)
-        self.display.display()
+        self._draw_image()
+
+    def _draw_image(self):
+        """Draws the texts and graph as last computed by `update_texts`."""
+        # The option bar only changes with the mode, and its width moves every text, so that's the only full redraw.
+        if self.state.mode != self._rendered_mode:
+            self.clear_image()
+            self._draw_option_bar()
+            self._rendered_mode = self.state.mode
+
+        if self.state.mode == CheeseCaveControllerMode.HISTORY:
+            self._draw_graph()
+        else:
+            self._draw_texts()
+
+    def _frame_key(self):
+        texts = {
+            "mode": self.state.mode,
+            "temperature": self._temperature_text,
+            "humidity": self._humidity_text,
+            "desired_humidity": self._desired_humidity_text,
+            "water_level": self._water_level_text,
+            "sensors": self._sensors_text,
+            "time": self._time_text,
+        }
+
+        # The graph is always material. It's only ever set on the graph screen.
+        return tuple(texts[field] for field in self.material_fields) + (self._graph_sections,)
+
+    def _frame_is_stale(self):
+        return self._last_refresh_time is None or \
+            self._clock.monotonic() - self._last_refresh_time >= self.max_unchanged_seconds
+
+    def _push_frame(self):
+        # The driver's `image()` walks and converts every pixel. A 1-bit image rotated into the panel's orientation
+        # already has the layout of the driver's black framebuffer (rows packed MSB first, padded to a byte), so the
+        # frame is copied in wholesale instead. Only the padding differs: the driver leaves it white, as it fills the
+        # buffer before drawing, and PIL leaves it 0.
+        black_framebuffer = getattr(self.display, "_blackframebuf", None)
+        color_framebuffer = getattr(self.display, "_colorframebuf", None)
+        transpose = NATIVE_TRANSPOSE.get(getattr(self.display, "rotation", 0))
+
+        native_image = self._image if transpose is None else self._image.transpose(transpose)
+        frame = native_image.tobytes()
+        padding_mask = _row_padding_mask(*native_image.size)
+        if padding_mask:
+            frame = (int.from_bytes(frame, "big") | padding_mask).to_bytes(len(frame), "big")
+
+        if black_framebuffer is None or len(black_framebuffer.buf) != len(frame):
+            self.display.image(self._image.convert("L"))
+            return
+
+        if not self.display._black_inverted:
+            frame = frame.translate(INVERTED_BYTES)
+        black_framebuffer.buf[:] = frame
+
+        # Nothing is ever drawn in color, so the color buffer only needs clearing.
+        if color_framebuffer is not None and color_framebuffer is not black_framebuffer:
+            color_framebuffer.buf[:] = bytes([0xFF if self.display._color_inverted else 0x00]) * len(color_framebuffer.buf)
+
+    def update_display(self, force=False):
+        """Refreshes the panel if the frame changed in a material way. Returns whether a refresh happened."""
+        with UPDATE_DISPLAY_SECONDS.time("total"):
+            return self._update_display(force)
+
+    def _update_display(self, force):
+        with UPDATE_DISPLAY_SECONDS.time("texts"):
+            self.update_texts()
+
+        frame_key = self._frame_key()
+        if not force and frame_key == self._last_frame_key and not self._frame_is_stale():
+            self.refreshes_skipped += 1
+            DISPLAY_UPDATES.inc("skipped")
+            return False
+
+        with UPDATE_DISPLAY_SECONDS.time("compose"):
+            self._draw_image()
+
+        # Different texts can still render to the same pixels, which doesn't need a refresh either.
+        frame_digest = hashlib.blake2b(self._image.tobytes(), digest_size=16).digest()
+        if not force and frame_digest == self._last_frame_digest and not self._frame_is_stale():
+            self._last_frame_key = frame_key
+            self.refreshes_skipped += 1
+            DISPLAY_UPDATES.inc("skipped")
+            return False
+
+        with UPDATE_DISPLAY_SECONDS.time("push"):
+            self._push_frame()
+        with UPDATE_DISPLAY_SECONDS.time("refresh"):
+            self.display.display()
+
+        self._last_frame_key = frame_key
+        self._last_frame_digest = frame_digest
+        self._last_refresh_time = self._clock.monotonic()
+        self.refreshes_performed += 1
+        DISPLAY_UPDATES.inc("performed")
+        logger.debug(f"Display refreshed ({self.refreshes_performed} refreshes, {self.refreshes_skipped} skipped).")
+
+        return True
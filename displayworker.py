@@ -0,0 +1,77 @@
+import logging
+import time
+from threading import Condition, Thread
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_REQUESTS = metrics.counter(
+    'cheesecave_display_requests', 'Display update requests, by whether they replaced one still waiting.', ['result'])
+# How long the refresh itself takes is `cheesecave_update_display_seconds{stage="total"}`.
+DISPLAY_QUEUE_SECONDS = metrics.histogram(
+    'cheesecave_display_queue_seconds', 'Time between a display update being due and the worker starting on it.')
+
+
+class DisplayWorker:
+    """Owns the display panel, updating it from a single thread.
+
+    Updates are requested through a one-slot mailbox where the latest request wins: asking for an update while one is
+    still waiting replaces it, so a burst of button presses ends up as a single refresh. Requesting never blocks on the
+    panel.
+    """
+
+    def __init__(self, display_controller, clock=time):
+        self._display_controller = display_controller
+        # Anything with `monotonic()`, like the `time` module or the controller's clock.
+        self._clock = clock
+        self._condition = Condition()
+        # The waiting request, as (monotonic time it's due, whether to force a refresh), or None.
+        self._request = None
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='display', daemon=True)
+        self._thread.start()
+
+    def request(self, delay=0, force=False):
+        with self._condition:
+            if self._request is not None:
+                DISPLAY_REQUESTS.inc('coalesced')
+                # A coalesced forced request stays forced.
+                force = force or self._request[1]
+            else:
+                DISPLAY_REQUESTS.inc('queued')
+
+            self._request = (self._clock.monotonic() + delay, force)
+            self._condition.notify()
+
+    def _next_request(self):
+        with self._condition:
+            while True:
+                if self._request is None:
+                    self._condition.wait()
+                    continue
+
+                (due, force) = self._request
+                wait_for = due - self._clock.monotonic()
+                if wait_for > 0:
+                    self._condition.wait(wait_for)
+                    continue
+
+                self._request = None
+                return (due, force)
+
+    def _run(self):
+        while True:
+            (due, force) = self._next_request()
+
+            started = self._clock.monotonic()
+            try:
+                self._display_controller.update_display(force=force)
+            except Exception:
+                logger.exception('Failed to update the display.')
+            finished = self._clock.monotonic()
+            DISPLAY_QUEUE_SECONDS.observe(started - due)
+
+            logger.debug(f'Display update took {finished - started:.2f}s, {started - due:.2f}s after it was due.')
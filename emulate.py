@@ -1,14 +1,19 @@
 import os
+import tempfile
 import time
 
 from display import DisplayController
+from etcdconnection import OfflineConnection
 from state import CheeseCaveControllerMode, CheeseCaveState
 
-state = CheeseCaveState()
+# Emulated values must never reach the controller's snapshots or etcd, so the state is kept in a throwaway directory.
+snapshot_directory = tempfile.TemporaryDirectory(prefix='cheesecave-emulate-')
+
+state = CheeseCaveState(connection=OfflineConnection(), snapshot_directory=snapshot_directory.name)
 state.temperature = 33
 state.humidity = 55.5
 state.desired_humidity = 60
-state._total_humidifier_run_time = 0#4 * 60 * 60
+state.total_humidifier_run_time = 0#4 * 60 * 60
 state.has_water = True
 state.mode = CheeseCaveControllerMode.GENERAL_INFO
 
@@ -0,0 +1,329 @@
+import json
+import logging
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import sleep
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Where the connection settings live. The configs themselves are stored in etcd, so these have to come from a local file.
+ETCD_SETTINGS_PATH = '/etc/cheesecave/etcd.json'
+
+DEFAULT_ETCD_SETTINGS = {
+    'host': '192.168.0.11',
+    'port': 2379,
+    'ca_cert': '/etc/cheesecave/ca.pem',
+    'cert_key': '/etc/cheesecave/client-key.pem',
+    'cert_cert': '/etc/cheesecave/client.pem',
+    # A single watch on this prefix serves every registered state.
+    'prefix': '/cheesecave/',
+    # How states are laid out in etcd: 'document' stores each state as one JSON document under its path, 'fields'
+    # stores every field as its own key under the path (e.g. /cheesecave/state/desired_humidity).
+    'layout': 'document',
+}
+
+DOCUMENT_LAYOUT = 'document'
+FIELDS_LAYOUT = 'fields'
+
+# How many revisions of our own writes are remembered, to recognise their echo through the watch.
+OWN_REVISIONS_KEPT = 256
+
+ETCD_REQUEST_SECONDS = metrics.histogram(
+    'cheesecave_etcd_request_seconds', 'Latency of requests to etcd.', ['operation'])
+ETCD_WATCH_EVENTS = metrics.counter(
+    'cheesecave_etcd_watch_events', 'Events received from the etcd watch, by whether they were applied or were the '
+    'echo of our own writes.', ['result'])
+ETCD_CONFLICTS = metrics.counter(
+    'cheesecave_etcd_conflicts', 'Writes to etcd rejected because someone else wrote the same keys first.')
+ETCD_RECONNECTS = metrics.counter('cheesecave_etcd_reconnects', 'Times the connection to etcd was lost.')
+
+# Bounds of the exponential backoff between attempts to reach etcd.
+MIN_RECONNECT_DELAY_SECONDS = 1
+MAX_RECONNECT_DELAY_SECONDS = 60
+
+
+def load_etcd_settings(path=ETCD_SETTINGS_PATH):
+    try:
+        with open(path) as f:
+            settings = json.load(f)
+    except FileNotFoundError:
+        logger.info(f'No etcd settings at {path}. Using the defaults.')
+        settings = {}
+
+    return {**DEFAULT_ETCD_SETTINGS, **settings}
+
+
+class OfflineConnection:
+    """Stands in for `EtcdConnection` where states must never reach etcd, like when emulating the display. Writes stay
+    pending in the states' local snapshots."""
+
+    def register(self, state):
+        pass
+
+    def notify_pending(self):
+        pass
+
+
+class EtcdConnection:
+    """Owns the process' single etcd client.
+
+    States register with the connection, which then takes care of everything that involves the network from one
+    background thread: connecting with backoff, reconciling every registered state once connected, dispatching events
+    from a single prefix watch to the state they belong to and draining the states' pending writes.
+    """
+
+    def __init__(self, settings=None):
+        self._settings = settings if settings is not None else load_etcd_settings()
+        self._layout = self._settings.get('layout', DOCUMENT_LAYOUT)
+        if self._layout not in (DOCUMENT_LAYOUT, FIELDS_LAYOUT):
+            raise ValueError(f'Unknown etcd layout {self._layout}.')
+        self._client = None
+        self._watch_id = None
+        self._states = {}
+        self._condition = Condition()
+        # States that need to be reconciled with etcd, either because they just registered or because we reconnected.
+        self._unreconciled = set()
+        self._watch_failed = False
+        self._thread = None
+        # Revisions created by our own puts. Their events come back through the watch, but there's nothing to apply.
+        self._own_revisions = deque(maxlen=OWN_REVISIONS_KEPT)
+        # Values of the puts in flight, by key. Their events can come back through the watch before the put returns
+        # with its revision, and have to be told apart from other clients' changes all the same.
+        self._own_writes = {}
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    def register(self, state):
+        with self._condition:
+            if not state.etcd_path.startswith(self._settings['prefix']):
+                raise ValueError(f'{state.etcd_path} is outside of the watched prefix {self._settings["prefix"]}.')
+
+            self._states[state.etcd_path] = state
+            self._unreconciled.add(state.etcd_path)
+            self._condition.notify()
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='etcd-sync', daemon=True)
+                self._thread.start()
+
+    def notify_pending(self):
+        with self._condition:
+            self._condition.notify()
+
+    def _run(self):
+        reconnect_delay = MIN_RECONNECT_DELAY_SECONDS
+
+        while True:
+            try:
+                self._connect()
+                reconnect_delay = MIN_RECONNECT_DELAY_SECONDS
+                self._sync()
+            except Exception:
+                logger.warning(f'Lost etcd. Retrying in {reconnect_delay}s.', exc_info=True)
+                ETCD_RECONNECTS.inc()
+
+            self._disconnect()
+            sleep(reconnect_delay)
+            reconnect_delay = min(2 * reconnect_delay, MAX_RECONNECT_DELAY_SECONDS)
+
+    def _connect(self):
+        # Imported lazily, so everything that only needs a state (like the simulation's in-process etcd) runs without it.
+        import etcd3
+
+        client = etcd3.Etcd3Client(
+            host=self._settings['host'],
+            port=self._settings['port'],
+            ca_cert=self._settings['ca_cert'],
+            cert_key=self._settings['cert_key'],
+            cert_cert=self._settings['cert_cert'],
+        )
+
+        # Watching before reconciling means no change can slip in between the two.
+        self._watch_id = client.add_watch_prefix_callback(self._settings['prefix'], self._dispatch)
+        self._client = client
+
+        with self._condition:
+            self._watch_failed = False
+            self._unreconciled.update(self._states)
+
+        logger.info(f'Connected to etcd at {self._settings["host"]}:{self._settings["port"]}.')
+
+    def _disconnect(self):
+        client = self._client
+        self._client = None
+
+        if client is None:
+            return
+
+        try:
+            if self._watch_id is not None:
+                client.cancel_watch(self._watch_id)
+            client.close()
+        except Exception:
+            pass
+
+        self._watch_id = None
+
+    def _sync(self):
+        while True:
+            with self._condition:
+                while not self._watch_failed and not self._unreconciled and \
+                        not any(state.has_pending_writes() for state in self._states.values()):
+                    self._condition.wait()
+
+                if self._watch_failed:
+                    raise ConnectionError('The etcd watch stream failed.')
+
+                unreconciled = [self._states[path] for path in self._unreconciled]
+                self._unreconciled.clear()
+                states = list(self._states.values())
+
+            for state in unreconciled:
+                if self._layout == FIELDS_LAYOUT:
+                    self._reconcile_fields(state)
+                else:
+                    self._reconcile(state)
+
+            for state in states:
+                if self._layout == FIELDS_LAYOUT:
+                    self._write_fields(state)
+                else:
+                    self._write(state)
+
+    def _reconcile(self, state):
+        with ETCD_REQUEST_SECONDS.time('get'):
+            stored_state, metadata = self._client.get(state.etcd_path)
+
+        state.reconcile(stored_state, metadata.mod_revision if metadata is not None else 0)
+
+    def _reconcile_fields(self, state):
+        prefix = state.etcd_path + '/'
+        with ETCD_REQUEST_SECONDS.time('get_prefix'):
+            stored_fields = {metadata.key.decode()[len(prefix):]: (value, metadata.mod_revision)
+                for value, metadata in self._client.get_prefix(prefix)}
+
+        state.reconcile_fields(stored_fields)
+
+    def _transaction(self, revisions, values):
+        """Puts every value if, and only if, each key is still at the given revision (0 for keys that don't exist yet).
+        Returns the revision of the writes, or None on conflict."""
+        transactions = self._client.transactions
+        # A put's own response doesn't carry the revision it created, but reading a written key back in the same
+        # transaction does.
+        (first_key, _) = next(iter(values.items()))
+
+        with self._condition:
+            self._own_writes.update({key: value.encode() for key, value in values.items()})
+
+        succeeded = False
+        try:
+            with ETCD_REQUEST_SECONDS.time('transaction'):
+                succeeded, responses = self._client.transaction(
+                    compare=[transactions.mod(key) == revision for key, revision in revisions.items()],
+                    success=[transactions.put(key, value) for key, value in values.items()] +
+                        [transactions.get(first_key)],
+                    failure=[],
+                )
+        finally:
+            # Together with recording the revision, so the watch sees either one or the other.
+            with self._condition:
+                for key in values:
+                    self._own_writes.pop(key, None)
+                if succeeded:
+                    (_, metadata) = responses[-1][0]
+                    self._own_revisions.append(metadata.mod_revision)
+
+        if not succeeded:
+            ETCD_CONFLICTS.inc()
+            return None
+
+        return metadata.mod_revision
+
+    def _write(self, state):
+        pending = state.pending_write()
+        if pending is None:
+            return
+
+        (state_serialized, revision) = pending
+        written_revision = self._transaction({state.etcd_path: revision}, {state.etcd_path: state_serialized})
+        if written_revision is None:
+            # Someone else wrote the state since we last saw it. Merging what they wrote queues the merged state, which
+            # the next round writes over their revision.
+            self._reconcile(state)
+            return
+
+        state.write_synced(state_serialized, written_revision)
+
+    def _write_fields(self, state):
+        # Only the fields that changed are written, so a write costs as much as the change. They're all written in a
+        # single transaction, so other clients never see half of a change.
+        pending = state.pending_fields()
+        if not pending:
+            return
+
+        keys = {name: f'{state.etcd_path}/{name}' for name in pending}
+        written_revision = self._transaction(
+            {keys[name]: revision for name, (_, revision) in pending.items()},
+            {keys[name]: value for name, (value, _) in pending.items()})
+        if written_revision is None:
+            self._reconcile_fields(state)
+            return
+
+        state.fields_synced({name: value for name, (value, _) in pending.items()}, written_revision)
+
+    def _dispatch(self, response):
+        import etcd3
+
+        # The etcd client reports a broken watch stream by calling back with the exception.
+        if isinstance(response, Exception):
+            with self._condition:
+                self._watch_failed = True
+                self._condition.notify()
+            return
+
+        # Field events of the same response are handed over together, so a state gets one notification per change.
+        stored_fields = {}
+
+        for e in response.events:
+            if not isinstance(e, etcd3.events.PutEvent):
+                continue
+
+            key = e.key.decode()
+            with self._condition:
+                own = e.mod_revision in self._own_revisions or self._own_writes.get(key) == e.value
+            if own:
+                ETCD_WATCH_EVENTS.inc('own')
+                continue
+            ETCD_WATCH_EVENTS.inc('applied')
+
+            state = self._states.get(key)
+            if state is not None:
+                state.apply_stored_state(e.value, e.mod_revision)
+                continue
+
+            (path, _, name) = key.rpartition('/')
+            state = self._states.get(path)
+            if state is not None:
+                stored_fields.setdefault(state, {})[name] = (e.value, e.mod_revision)
+
+        for state, fields in stored_fields.items():
+            state.apply_stored_fields(fields)
+
+
+_shared_connection = None
+_shared_connection_lock = Lock()
+
+
+def shared_connection():
+    """Returns the process-wide connection, creating it from the settings file on first use."""
+    global _shared_connection
+
+    with _shared_connection_lock:
+        if _shared_connection is None:
+            _shared_connection = EtcdConnection()
+
+        return _shared_connection
@@ -1,89 +1,515 @@
-import time
-import etcd3
-from threading import Timer
 import json
+import logging
+import os
+from threading import Lock, RLock
+from etcdconnection import shared_connection
+from schema import MISSING, SCHEMA_VERSION_KEY, SchemaMeta, prefer_local
+import metrics
 
 
-STORE_DELAY_SECONDS_KEY = 'store_delay_seconds'
-DEFAULT_STATE_STORE_DELAY_SECONDS = 300
+logger = logging.getLogger(__name__)
 
-def dict_store_delay_seconds(d):
-    if STORE_DELAY_SECONDS_KEY in d:
-        return d[STORE_DELAY_SECONDS_KEY]
+# Every state keeps a local snapshot here, so it's available at startup without waiting for etcd.
+SNAPSHOT_DIRECTORY = '/var/lib/cheesecave/state'
 
-    return DEFAULT_STATE_STORE_DELAY_SECONDS
+STORE_STATE_SECONDS = metrics.histogram(
+    'cheesecave_store_state_seconds', 'Time spent in each stage of storing a state locally.', ['path', 'stage'])
+APPLY_STORED_STATE_SECONDS = metrics.histogram(
+    'cheesecave_apply_stored_state_seconds', 'Time spent applying a state stored in etcd (watch events and reconciles).',
+    ['path'])
 
+# How long changes are collected before they're stored, until the configs say otherwise. See `set_store_coalesce_seconds`.
+DEFAULT_STORE_COALESCE_SECONDS = 2
 
-class EtcdBackedState:
-    def __init__(self, etcd_path):
-        self._etcd = etcd3.Etcd3Client(
-            host="192.168.0.11",
-            port=2379,
-            ca_cert="/etc/cheesecave/ca.pem",
-            cert_key="/etc/cheesecave/client-key.pem",
-            cert_cert="/etc/cheesecave/client.pem",
-        )
-        self._etcd_path = etcd_path
 
-        stored_state, _ = self._etcd.get(self._etcd_path)
+class EtcdBackedState(metaclass=SchemaMeta):
+    """State stored in etcd, kept available offline through a local snapshot.
 
-        if stored_state is None:
-            self.state = self.default_state()
-        else:
-            self.state = json.loads(stored_state)
+    Fields are declared by subclasses as `schema.Field`s, and are read as plain attributes. Setting a field validates
+    the value and marks it dirty, to be stored. Stored states older than `schema_version` are brought up to date with
+    `migrations`, which map a version to a function upgrading a state dict from that version to the next.
+
+    The snapshot is loaded at construction. Everything that talks to etcd is left to the `EtcdConnection` the state
+    registers with: reconciling with the stored state once connected, delivering remote changes and draining local
+    writes. Local writes update the snapshot first and are marked pending in it, so they survive a restart while etcd is
+    unreachable.
 
-        self._store_state_timer = None
-        self._store_state()
-        self._watch_state()
+    States are changed from several threads (buttons, scheduled jobs, humidifier commands and the etcd watch), so every
+    change goes through the state's lock. Writes to etcd are only made against the revision they were based on. When
+    etcd has moved on, the stored and local changes are merged field by field (see `_merge`) and written again.
+    """
 
-    def __getattr__(self, name):
-        # This is needed when the object is in `__init__` to avoid a recursion loop before the `state` attribute is set.
-        if name == 'state':
-            return None
+    __slots__ = ('_scheduler', '_connection', '_dirty_fields', '_etcd_path', '_snapshot_path', '_lock', '_sync_lock',
+        '_pending_serialized', '_unsynced_fields', '_last_stored_serialized', '_extra', '_etcd_values',
+        '_etcd_revision', '_etcd_field_revisions', '_store_scheduled', '_snapshot_lock', '_snapshot_sequence',
+        '_snapshot_written', '_queued_snapshot', '_store_coalesce_seconds')
+
+    schema_version = 0
+    migrations = {}
+    # How a field changed both locally and in etcd is resolved, unless the field has its own `merge`.
+    default_merge = staticmethod(prefer_local)
+
+    def __init__(self, etcd_path, scheduler=None, connection=None, snapshot_directory=SNAPSHOT_DIRECTORY):
+        # Stores are coalesced through the controller's scheduler. Without one (e.g. when emulating), every change is stored right away.
+        self._scheduler = scheduler
+        self._connection = connection if connection is not None else shared_connection()
+        self._dirty_fields = set()
+        # Whether a store is scheduled that will still see the dirty fields. Guarded by `_lock`.
+        self._store_scheduled = False
+        self._store_coalesce_seconds = DEFAULT_STORE_COALESCE_SECONDS
+        self._etcd_path = etcd_path
+        self._snapshot_path = os.path.join(snapshot_directory, etcd_path.strip('/').replace('/', '_') + '.json')
 
-        return self.state[name]
+        # Guards the fields. Reentrant, so custom setters and `atomic` blocks can set other fields.
+        self._lock = RLock()
+        # Guards the write-behind queue. Since every put stores the whole state, the queue only ever needs the latest
+        # serialized state that hasn't reached etcd yet. Always taken after `_lock`, never before.
+        self._sync_lock = Lock()
+        # Guards writing the snapshot. Snapshots are numbered in the order they're taken (under `_lock`), so one written
+        # outside of `_lock` never replaces a newer one.
+        self._snapshot_lock = Lock()
+        self._snapshot_sequence = 0
+        self._snapshot_written = 0
+        # The latest snapshot taken under `_lock`, until it's written once the lock is released.
+        self._queued_snapshot = None
+        self._pending_serialized = None
+        # Fields changed locally that haven't reached etcd yet. Only the per-field layout writes them one by one.
+        self._unsynced_fields = set()
+        # The last state written locally, used to skip stores that wouldn't change anything.
+        self._last_stored_serialized = None
+        # Stored fields this version doesn't know about (e.g. written by a newer version), kept so they aren't lost.
+        self._extra = {}
+        # The last values known to be stored in etcd, which merges tell local and remote changes apart with. None until
+        # known. Along with the revision they were stored at: of the whole state, or of every field in the per-field
+        # layout. A revision of 0 means nothing is stored yet.
+        self._etcd_values = None
+        self._etcd_revision = None
+        self._etcd_field_revisions = {}
+
+        for name, field in self._fields.items():
+            object.__setattr__(self, name, field.new_default())
+
+        self._load_snapshot()
+        self._connection.register(self)
 
     def __setattr__(self, name, value):
-        if self.state is not None and name in self.state:
-            self.state[name] = value
+        field = self._fields.get(name)
+        if field is None:
+            object.__setattr__(self, name, value)
+        elif field.setter_function is not None:
+            with self._lock:
+                field.setter_function(self, value)
         else:
-            super().__setattr__(name, value)
+            self._set_field(name, value)
+
+    @property
+    def etcd_path(self):
+        return self._etcd_path
+
+    def atomic(self):
+        """Returns the state's lock, to hold over changes that read fields before setting them (e.g. an increment).
+        Changes from other threads, including stored changes, are applied before or after the block, never within."""
+        return self._lock
 
     def default_state(self):
-        raise NotImplementedError()
+        return {name: field.new_default() for name, field in self._fields.items()}
 
-    def state_changed(self):
+    def state_changed(self, changed_fields):
+        """Called with the names of the fields that changed, after a change stored in etcd was applied."""
         pass
 
+    def to_dict(self):
+        """Returns the state as it's serialized."""
+        with self._lock:
+            state = dict(self._extra)
+            for name in self._fields:
+                state[name] = getattr(self, name)
+        state[SCHEMA_VERSION_KEY] = self.schema_version
+
+        return state
+
+    def _serialize(self):
+        return json.dumps(self.to_dict())
+
+    def _migrate(self, state):
+        version = state.pop(SCHEMA_VERSION_KEY, 0)
+        if version > self.schema_version:
+            logger.warning(f'{self._etcd_path} was stored by a newer version (schema {version}). Unknown fields are kept as they are.')
+
+        while version < self.schema_version:
+            migration = self.migrations.get(version)
+            if migration is not None:
+                state = migration(dict(state))
+            version += 1
+
+        return state
+
+    def _validated(self, state):
+        """Splits a (migrated) stored state into valid field values and fields this version doesn't know about."""
+        values = {}
+        extra = {}
+
+        for name, value in state.items():
+            field = self._fields.get(name)
+            if field is None:
+                extra[name] = value
+                continue
+
+            try:
+                values[name] = field.check(value)
+            except (TypeError, ValueError) as e:
+                logger.warning(f'Ignoring invalid stored {name} of {self._etcd_path}: {e}')
+
+        return values, extra
+
+    def _apply_values(self, values, extra):
+        """Sets values as they are. Returns the names of the fields that changed."""
+        changed_fields = set()
+
+        for name, value in values.items():
+            if getattr(self, name) != value:
+                object.__setattr__(self, name, value)
+                changed_fields.add(name)
+
+        for name, value in extra.items():
+            if self._extra.get(name) != value:
+                self._extra[name] = value
+                changed_fields.add(name)
+
+        return changed_fields
+
+    def _merge(self, values, extra):
+        """Merges values stored in etcd with the local ones. Returns the names of the fields that changed.
+
+        Fields without local changes waiting to reach etcd take the stored value. Fields with local changes keep them
+        if etcd still has the last value known to be stored, and are otherwise resolved by their merge policy. Without
+        any known stored value (e.g. after a restart with writes still pending), that's every locally changed field.
+        """
+        etcd_values = self._etcd_values if self._etcd_values is not None else {}
+        changed_fields = set()
+
+        for name, remote in values.items():
+            local = getattr(self, name)
+            if local == remote:
+                continue
+
+            if name in self._dirty_fields or name in self._unsynced_fields:
+                base = etcd_values.get(name, MISSING)
+                if remote == base:
+                    continue
+                field = self._fields[name]
+                value = (field.merge or self.default_merge)(base, local, remote)
+            else:
+                value = remote
+
+            if value != local:
+                object.__setattr__(self, name, value)
+                changed_fields.add(name)
+
+        # Fields this version doesn't know about are never changed locally.
+        for name, value in extra.items():
+            if self._extra.get(name) != value:
+                self._extra[name] = value
+                changed_fields.add(name)
+
+        return changed_fields
+
+    def _load_snapshot(self):
+        try:
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            logger.info(f'No local snapshot of {self._etcd_path}. Starting from defaults until etcd is reachable.')
+            return
+        except (OSError, ValueError):
+            logger.exception(f'Local snapshot of {self._etcd_path} is unreadable. Starting from defaults.')
+            return
+
+        stored_state = snapshot['state']
+        stored_version = stored_state.get(SCHEMA_VERSION_KEY, 0)
+        values, extra = self._validated(self._migrate(stored_state))
+        self._apply_values(values, extra)
+
+        self._last_stored_serialized = self._serialize()
+        if not snapshot['pending']:
+            # The snapshot was last written once in sync with etcd, so it's also what etcd last had as far as we know.
+            self._etcd_values = dict(values)
+
+        # Fields added (or migrated) since the snapshot was written are stored along with any pending write. Which
+        # fields are pending isn't in the snapshot, so they all are.
+        if snapshot['pending'] or values.keys() != self._fields.keys() or stored_version != self.schema_version:
+            self._pending_serialized = self._last_stored_serialized
+            self._unsynced_fields = set(self.to_dict())
+
+    def _queue_snapshot(self, serialized, pending):
+        # Called with `_lock` held. Replaces any snapshot queued before, which is older.
+        self._snapshot_sequence += 1
+        self._queued_snapshot = (serialized, pending, self._snapshot_sequence)
+
+    def _write_queued_snapshot(self):
+        """Writes the snapshot queued by `_queue_snapshot`, if any. Called once `_lock` is released, so buttons and the
+        etcd watch don't wait on the SD card."""
+        with self._lock:
+            queued = self._queued_snapshot
+            self._queued_snapshot = None
+
+        if queued is None:
+            return
+
+        (serialized, pending, sequence) = queued
+        with self._snapshot_lock:
+            # Another thread may have written a newer one in the meantime.
+            if sequence < self._snapshot_written:
+                return
+            self._snapshot_written = sequence
+            self._write_snapshot_file(serialized, pending)
+
+    def _write_snapshot_file(self, serialized, pending):
+        temporary_path = self._snapshot_path + '.tmp'
+
+        try:
+            os.makedirs(os.path.dirname(self._snapshot_path), exist_ok=True)
+            with open(temporary_path, 'w') as f:
+                f.write(f'{{"pending": {json.dumps(pending)}, "state": {serialized}}}')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_path, self._snapshot_path)
+        except OSError:
+            logger.exception(f'Failed to write the local snapshot of {self._etcd_path}.')
+
+    def _set_field(self, name, value):
+        value = self._fields[name].check(value)
+
+        with self._lock:
+            if getattr(self, name) == value:
+                return
+
+            object.__setattr__(self, name, value)
+            self._mark_dirty(name)
+
+    def _mark_dirty(self, name):
+        self._dirty_fields.add(name)
+
+        if self._scheduler is None:
+            self._store_state()
+        elif not self._store_scheduled:
+            # The first change opens a coalescing window. Changes made until it closes are stored together. The job
+            # itself can't tell, since it's still scheduled for a moment after it took the dirty fields.
+            self._store_scheduled = True
+            self._scheduler.after(self._store_state_job_name, self._store_coalesce_seconds, self._store_state)
+
+    def set_store_coalesce_seconds(self, seconds):
+        """Sets how long changes are collected before they're stored. Applies from the next change that opens a window."""
+        self._store_coalesce_seconds = seconds
+
     @property
-    def _store_delay_seconds(self):
-        return dict_store_delay_seconds(self.state)
+    def _store_state_job_name(self):
+        return f'store_state:{self._etcd_path}'
 
     def _store_state(self):
-        state_serialized = json.dumps(self.state)
-        self._etcd.put(self._etcd_path, state_serialized)
+        with self._lock:
+            dirty_fields = self._dirty_fields
+            self._dirty_fields = set()
+            self._store_scheduled = False
+
+            with STORE_STATE_SECONDS.time(self._etcd_path, 'serialize'):
+                state_serialized = self._serialize()
+            # Fields can change and change back within the coalescing window, in which case there's nothing to store.
+            if state_serialized == self._last_stored_serialized:
+                return
+
+            self._last_stored_serialized = state_serialized
+
+            with self._sync_lock:
+                self._unsynced_fields |= dirty_fields
+                self._pending_serialized = state_serialized
+                self._queue_snapshot(state_serialized, pending=True)
+
+        with STORE_STATE_SECONDS.time(self._etcd_path, 'snapshot'):
+            self._write_queued_snapshot()
+
+        self._connection.notify_pending()
+
+    def _update_pending(self, remote_values):
+        """After stored values were merged in, only fields still differing from them are left to write. Called with
+        both locks held. The snapshot it may queue is written by the caller, once they're released."""
+        state = self.to_dict()
+        for name, value in remote_values.items():
+            if state.get(name, MISSING) == value:
+                self._unsynced_fields.discard(name)
+            else:
+                self._unsynced_fields.add(name)
+
+        state_serialized = json.dumps(state)
+        was_pending = self._pending_serialized is not None
+        self._pending_serialized = state_serialized if self._unsynced_fields else None
+
+        # Most stored states seen are the echo of what was just written, which leaves the snapshot as it is.
+        if state_serialized != self._last_stored_serialized or was_pending != bool(self._unsynced_fields):
+            self._last_stored_serialized = state_serialized
+            self._queue_snapshot(state_serialized, pending=bool(self._unsynced_fields))
+
+    def has_pending_writes(self):
+        return self._pending_serialized is not None
+
+    def pending_write(self):
+        """Returns the serialized state still to be written to etcd, and the revision it has to be written over."""
+        with self._sync_lock:
+            if self._pending_serialized is None:
+                return None
+
+            return self._pending_serialized, self._etcd_revision or 0
+
+    def write_synced(self, state_serialized, revision):
+        with self._lock, self._sync_lock:
+            if self._etcd_revision is None or revision > self._etcd_revision:
+                self._etcd_values, _ = self._validated(self._migrate(json.loads(state_serialized)))
+                self._etcd_revision = revision
+
+            # A newer write may have been queued while this one was in flight, in which case it's still pending.
+            if self._pending_serialized == state_serialized:
+                self._pending_serialized = None
+                self._unsynced_fields = set()
+                self._queue_snapshot(state_serialized, pending=False)
+
+        self._write_queued_snapshot()
+
+    def pending_fields(self):
+        """Returns every field that still has to be written to etcd, for the per-field layout, as its serialized value
+        and the revision it has to be written over."""
+        with self._lock, self._sync_lock:
+            if self._pending_serialized is None:
+                return {}
 
-        self._start_store_state_timer()
+            state = self.to_dict()
+            return {name: (json.dumps(state[name]), self._etcd_field_revisions.get(name, 0))
+                for name in self._unsynced_fields if name in state}
 
-    def _start_store_state_timer(self):
-        self._store_state_timer = Timer(
-            self._store_delay_seconds, self._store_state)
-        self._store_state_timer.start()
+    def fields_synced(self, fields_serialized, revision):
+        with self._lock, self._sync_lock:
+            state = self.to_dict()
+            etcd_values = self._etcd_values if self._etcd_values is not None else {}
 
-    def _watch_state(self):
-        self._etcd.add_watch_callback(key=self._etcd_path, callback=self.watch_callback)
+            for name, value in fields_serialized.items():
+                self._etcd_field_revisions[name] = revision
+                if name in self._fields:
+                    etcd_values[name] = json.loads(value)
+                # Like for whole states, a field changed again while its write was in flight is still pending.
+                if json.dumps(state[name]) == value:
+                    self._unsynced_fields.discard(name)
 
-    def watch_callback(self, response):
-        for e in response.events:
-            if isinstance(e, etcd3.events.PutEvent) and e.key == self._etcd_path:
-                watched_value = json.loads(e.value)
-                if watched_value == self.state:
+            self._etcd_values = etcd_values
+            if not self._unsynced_fields:
+                self._pending_serialized = None
+                self._queue_snapshot(json.dumps(state), pending=False)
+
+        self._write_queued_snapshot()
+
+    def reconcile(self, stored_state, revision):
+        """Merges the state stored in etcd, or None if there isn't any, at `revision`. Once connected, this is the first
+        thing the state gets from etcd."""
+        if stored_state is not None:
+            self.apply_stored_state(stored_state, revision)
+            return
+
+        with self._lock, self._sync_lock:
+            # Nothing is stored yet, so the whole state has to be.
+            self._etcd_values = {}
+            self._etcd_revision = 0
+            self._update_pending({name: MISSING for name in self.to_dict()})
+
+        self._write_queued_snapshot()
+
+    def reconcile_fields(self, stored_fields):
+        """Like `reconcile`, for the per-field layout, with the serialized value and revision of every field stored in
+        etcd."""
+        with self._lock, self._sync_lock:
+            self._etcd_field_revisions = {name: revision for name, (_, revision) in stored_fields.items()}
+            if not stored_fields:
+                self._etcd_values = {}
+                self._update_pending({name: MISSING for name in self.to_dict()})
+
+        if not stored_fields:
+            self._write_queued_snapshot()
+            return
+
+        # Reconciling sees every stored field at once, so it's where a state stored in an older schema gets migrated.
+        with APPLY_STORED_STATE_SECONDS.time(self._etcd_path):
+            changed_fields = self._apply_stored_dict(
+                {name: json.loads(value) for name, (value, _) in stored_fields.items()})
+
+        self._write_queued_snapshot()
+        if changed_fields:
+            self.state_changed(changed_fields)
+
+    def apply_stored_fields(self, stored_fields):
+        """Merges fields changed in etcd, given their serialized values and revisions. Only those fields are decoded and
+        compared."""
+        with APPLY_STORED_STATE_SECONDS.time(self._etcd_path), self._lock:
+            values = {}
+            for name, (value, revision) in stored_fields.items():
+                # Reconciling may have already seen a newer revision than the watch delivers.
+                if revision <= self._etcd_field_revisions.get(name, 0):
                     continue
 
-                # Special casing for when the store delay changes.
-                if dict_store_delay_seconds(watched_value) != self._store_delay_seconds:
-                    self._store_state_timer.cancel()
-                    self._start_store_state_timer()
+                self._etcd_field_revisions[name] = revision
+                if name != SCHEMA_VERSION_KEY:
+                    values[name] = json.loads(value)
+
+            values, extra = self._validated(values)
+            changed_fields = self._merge(values, extra)
+
+            etcd_values = self._etcd_values if self._etcd_values is not None else {}
+            etcd_values.update(values)
+            self._etcd_values = etcd_values
+
+            with self._sync_lock:
+                self._update_pending({**values, **extra})
+
+        self._write_queued_snapshot()
+        self._notify_if_pending()
+        if changed_fields:
+            self.state_changed(changed_fields)
+
+    def apply_stored_state(self, stored_state, revision):
+        """Merges a state stored in etcd at `revision`, either seen through the watch or read after a conflicting
+        write."""
+        with APPLY_STORED_STATE_SECONDS.time(self._etcd_path), self._lock:
+            # Reconciling may have already seen a newer revision than the watch delivers.
+            if self._etcd_revision is not None and revision <= self._etcd_revision:
+                return
+
+            self._etcd_revision = revision
+            changed_fields = self._apply_stored_dict(json.loads(stored_state))
+
+        self._write_queued_snapshot()
+        self._notify_if_pending()
+        if changed_fields:
+            self.state_changed(changed_fields)
+
+    def _notify_if_pending(self):
+        # Merging a stored change can leave local changes to write, or fields the stored state lacks. Coming from the
+        # watch, nothing else would tell the connection until the next local change.
+        if self.has_pending_writes():
+            self._connection.notify_pending()
+
+    def _apply_stored_dict(self, stored_state):
+        stored_version = stored_state.get(SCHEMA_VERSION_KEY, 0)
+        values, extra = self._validated(self._migrate(stored_state))
+
+        with self._lock:
+            changed_fields = self._merge(values, extra)
+            self._etcd_values = dict(values)
+
+            remote_values = {**values, **extra, SCHEMA_VERSION_KEY: stored_version}
+            # Fields the stored state lacks have to be stored even if nothing changed locally, and every field of a
+            # state stored in an older schema.
+            for name in self._fields.keys() - values.keys():
+                remote_values[name] = MISSING
+            if stored_version != self.schema_version:
+                remote_values = {name: MISSING for name in remote_values}
+
+            with self._sync_lock:
+                self._update_pending(remote_values)
 
-                self.state = watched_value
-                self.state_changed()
+        return changed_fields
@@ -0,0 +1,209 @@
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
+import PIL
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the atlas layout changes, so older cached atlases are rebuilt instead of misread.
+ATLAS_VERSION = 1
+# PNG text chunk holding an atlas' metrics.
+METRICS_CHUNK = 'cheesecave-glyphs'
+
+
+@lru_cache(maxsize=None)
+def _font_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Typeface:
+    """A font file at a given size, opened only when something can't be drawn from its glyph atlas.
+
+    Every size of the same file is opened from a single in-memory copy of it. Text is measured with the metrics FreeType
+    uses for 1-bit rendering, which is what the display draws in, so boxes are the same whether text comes from the atlas
+    or the font.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.atlas = None
+        self._font = None
+
+    def __repr__(self):
+        return f'Typeface({os.path.basename(self.path)!r}, {self.size})'
+
+    @property
+    def font(self):
+        if self._font is None:
+            self._font = ImageFont.truetype(io.BytesIO(_font_file(self.path)), self.size)
+
+        return self._font
+
+    def bbox(self, text):
+        """Returns the box `text` covers when drawn at (0, 0), like `FreeTypeFont.getbbox`."""
+        if self.atlas is not None and self.atlas.covers(text):
+            return self.atlas.bbox(text)
+
+        return self.font.getbbox(text, mode='1')
+
+    def draw(self, draw, xy, text, fill):
+        """Draws `text` at (integer) `xy`, like `ImageDraw.text` would."""
+        if self.atlas is not None and self.atlas.covers(text):
+            self.atlas.draw(draw, xy, text, fill)
+        else:
+            draw.text(xy, text, font=self.font, fill=fill)
+
+
+def _pixel(position):
+    # FreeType positions are rounded half up to whole pixels.
+    return math.floor(position + 0.5)
+
+
+class GlyphAtlas:
+    """Every glyph of a fixed character set rasterized once, along with the metrics to lay text out from them.
+
+    Glyphs are kept as 1-bit masks (ink set), which are stamped with a single `ImageDraw.bitmap` call each. Every glyph
+    lands where FreeType rasterizes it on its own, where PIL's string rendering can move a few (like '~') by a pixel
+    depending on their neighbours.
+    """
+
+    def __init__(self, glyphs, kerning):
+        # Per character: its mask, the mask's offset from the pen position, its advance and its box.
+        self._glyphs = glyphs
+        # Advance adjustments of the character pairs that have one.
+        self._kerning = kerning
+
+    def covers(self, text):
+        glyphs = self._glyphs
+        return all(c in glyphs for c in text)
+
+    def _layout(self, text):
+        pen = 0.0
+        previous = None
+        for c in text:
+            if previous is not None:
+                pen += self._kerning.get(previous + c, 0)
+            yield (c, _pixel(pen))
+            pen += self._glyphs[c][2]
+            previous = c
+
+    def bbox(self, text):
+        if not text:
+            return (0, 0, 0, 0)
+
+        (left, top, right, bottom) = (0, None, 0, None)
+        for (c, x) in self._layout(text):
+            (glyph_left, glyph_top, glyph_right, glyph_bottom) = self._glyphs[c][3]
+            left = min(left, x + glyph_left)
+            right = max(right, x + glyph_right)
+            top = glyph_top if top is None else min(top, glyph_top)
+            bottom = glyph_bottom if bottom is None else max(bottom, glyph_bottom)
+
+        return (left, top, right, bottom)
+
+    def draw(self, draw, xy, text, fill):
+        (x, y) = xy
+        for (c, offset) in self._layout(text):
+            (mask, (mask_left, mask_top), _, _) = self._glyphs[c]
+            draw.bitmap((x + offset + mask_left, y + mask_top), mask, fill=fill)
+
+    @classmethod
+    def build(cls, font, charset):
+        glyphs = {}
+        for c in charset:
+            (left, top, right, bottom) = font.getbbox(c, mode='1')
+            origin = (min(0, left), min(0, top))
+            mask = Image.new('1', (max(1, right - origin[0]), max(1, bottom - origin[1])), color=0)
+            ImageDraw.Draw(mask).text((-origin[0], -origin[1]), c, font=font, fill=1)
+            glyphs[c] = (mask, origin, font.getlength(c, mode='1'), (left, top, right, bottom))
+
+        kerning = {}
+        for a in charset:
+            for b in charset:
+                adjustment = font.getlength(a + b, mode='1') - glyphs[a][2] - glyphs[b][2]
+                if adjustment:
+                    kerning[a + b] = adjustment
+
+        return cls(glyphs, kerning)
+
+    def save(self, path, key):
+        """Writes the atlas as a single PNG: every mask side by side, with the metrics in a text chunk."""
+        characters = sorted(self._glyphs)
+        width = sum(self._glyphs[c][0].width for c in characters)
+        height = max(self._glyphs[c][0].height for c in characters)
+
+        image = Image.new('1', (max(1, width), max(1, height)), color=0)
+        metrics = {}
+        x = 0
+        for c in characters:
+            (mask, origin, advance, box) = self._glyphs[c]
+            image.paste(mask, (x, 0))
+            metrics[c] = [x, mask.width, mask.height, list(origin), advance, list(box)]
+            x += mask.width
+
+        info = PngImagePlugin.PngInfo()
+        info.add_text(METRICS_CHUNK, json.dumps({'key': key, 'glyphs': metrics, 'kerning': self._kerning}), zip=True)
+
+        temporary_path = path + '.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        image.save(temporary_path, format='PNG', pnginfo=info)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, key):
+        """Returns the atlas saved at `path`, or None if there isn't one for `key`."""
+        try:
+            with Image.open(path) as image:
+                image.load()
+                metrics = json.loads(image.text[METRICS_CHUNK])
+                if metrics['key'] != key:
+                    return None
+
+                glyphs = {}
+                for (c, (x, width, height, origin, advance, box)) in metrics['glyphs'].items():
+                    glyphs[c] = (image.crop((x, 0, x + width, height)), tuple(origin), advance, tuple(box))
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError):
+            logger.warning(f'Ignoring unreadable glyph atlas {path}.', exc_info=True)
+            return None
+
+        return cls(glyphs, metrics['kerning'])
+
+
+def _atlas_key(typeface, charset):
+    stat = os.stat(typeface.path)
+    parts = [ATLAS_VERSION, PIL.__version__, os.path.abspath(typeface.path), stat.st_size, stat.st_mtime_ns,
+        typeface.size, ''.join(sorted(charset))]
+    return hashlib.blake2b(json.dumps(parts).encode(), digest_size=16).hexdigest()
+
+
+def load_atlases(charsets, directory):
+    """Gives every typeface of `charsets` (a dict from typeface to the characters it draws) a glyph atlas, read from
+    `directory` or built and cached there. A typeface whose atlas can't be had just keeps drawing with its font."""
+    for (typeface, charset) in charsets.items():
+        try:
+            key = _atlas_key(typeface, charset)
+        except OSError:
+            logger.exception(f'Failed to read {typeface.path}.')
+            continue
+
+        path = os.path.join(directory, f'{os.path.splitext(os.path.basename(typeface.path))[0]}-{typeface.size}.png')
+        atlas = GlyphAtlas.load(path, key)
+        if atlas is None:
+            logger.info(f'Building the glyph atlas of {typeface}.')
+            atlas = GlyphAtlas.build(typeface.font, charset)
+            try:
+                atlas.save(path, key)
+            except OSError:
+                logger.exception(f'Failed to cache the glyph atlas of {typeface} in {directory}.')
+
+        typeface.atlas = atlas
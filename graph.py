@@ -0,0 +1,97 @@
+import math
+from collections import deque
+
+
+class MinMaxBuckets:
+    """Downsamples a series to the minimum and maximum of every fixed time bucket of a sliding window.
+
+    Buckets are aligned on multiples of their duration, so a bucket keeps its place as the window slides and new samples
+    only ever update the newest one. Keeping the buckets up to date costs a step per new sample instead of downsampling
+    the whole window again on every refresh. Unlike averaging, min/max bucketing keeps the peaks a sparkline is for.
+    """
+
+    def __init__(self, window_seconds, buckets):
+        if buckets < 1:
+            raise ValueError('MinMaxBuckets needs at least 1 bucket.')
+
+        self.window_seconds = window_seconds
+        self.buckets = buckets
+        self.bucket_seconds = window_seconds / buckets
+        # [index, minimum, maximum] of every bucket with samples, oldest first. A bucket's index is its start time
+        # divided by the bucket duration.
+        self._buckets = deque()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _index(self, timestamp):
+        return math.floor(timestamp / self.bucket_seconds)
+
+    def add(self, timestamp, value):
+        index = self._index(timestamp)
+
+        if self._buckets:
+            bucket = self._buckets[-1]
+            if bucket[0] == index:
+                if value < bucket[1]:
+                    bucket[1] = value
+                elif value > bucket[2]:
+                    bucket[2] = value
+                return
+
+            # Samples come in time order. An older one could only land in a bucket that was already drawn.
+            if index < bucket[0]:
+                return
+
+        self._buckets.append([index, value, value])
+
+    def trim(self, now):
+        """Drops the buckets that slid out of the window ending at `now`."""
+        oldest_kept = self._index(now) - self.buckets + 1
+        while self._buckets and self._buckets[0][0] < oldest_kept:
+            self._buckets.popleft()
+
+    def columns(self, now):
+        """Returns the (minimum, maximum) of every bucket of the window ending at `now`, oldest first, with None for
+        buckets without any sample."""
+        first_index = self._index(now) - self.buckets + 1
+        columns = [None] * self.buckets
+
+        for (index, minimum, maximum) in self._buckets:
+            column = index - first_index
+            if 0 <= column < self.buckets:
+                columns[column] = (minimum, maximum)
+
+        return columns
+
+
+class HistoryGraph:
+    """Humidity and temperature of the last `window_seconds` from a `HistoryStore`, downsampled to `width` columns.
+
+    Every update only reads the records added since the previous one.
+    """
+
+    def __init__(self, history, window_seconds, width):
+        self._history = history
+        self.window_seconds = window_seconds
+        self.width = width
+        self.humidity = MinMaxBuckets(window_seconds, width)
+        self.temperature = MinMaxBuckets(window_seconds, width)
+        self._last_timestamp = None
+
+    def update(self, now):
+        start = now - self.window_seconds
+        if self._last_timestamp is not None:
+            start = max(start, self._last_timestamp)
+
+        for record in self._history.query(start, now):
+            # Queries include their start, which is the record last seen.
+            if self._last_timestamp is not None and record.timestamp <= self._last_timestamp:
+                continue
+
+            self.humidity.add(record.timestamp, record.humidity)
+            self.temperature.add(record.timestamp, record.temperature)
+            self._last_timestamp = record.timestamp
+
+        self.humidity.trim(now)
+        self.temperature.trim(now)
@@ -0,0 +1,57 @@
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+BUTTON_CHANNELS = [5, 6]
+
+
+class PiHardware:
+    """Everything the controller drives on the Raspberry Pi: the I2C bus, the e-ink panel, the humidifier's control pin
+    and the buttons.
+
+    The Pi libraries are only imported here, so the rest of the controller can run elsewhere against other hardware,
+    like the simulation's.
+    """
+
+    def __init__(self):
+        import board
+        import busio
+        import digitalio
+        from adafruit_epd.ssd1680 import Adafruit_SSD1680
+
+        self._board = board
+        self._digitalio = digitalio
+
+        self.i2c = busio.I2C(board.SCL, board.SDA)
+        self.spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
+        self.ecs = digitalio.DigitalInOut(board.CE0)
+        self.dc = digitalio.DigitalInOut(board.D22)
+        self.rst = digitalio.DigitalInOut(board.D27)
+        self.busy = digitalio.DigitalInOut(board.D17)
+
+        self.display = Adafruit_SSD1680(
+            122,
+            250,
+            self.spi,
+            cs_pin=self.ecs,
+            dc_pin=self.dc,
+            sramcs_pin=None,
+            rst_pin=self.rst,
+            busy_pin=self.busy,
+        )
+        self.display.rotation = 1
+
+    def humidifier_pin(self):
+        pin = self._digitalio.DigitalInOut(self._board.D24)
+        pin.switch_to_output()
+        return pin
+
+    def setup_buttons(self, callback):
+        # Up and down buttons are configured directly with RPi.GPIO so we can have threaded callbacks whenever a button press is detected. This avoids all the busy loop that we'd have to do if we used adafruit's code instead.
+        import RPi.GPIO as GPIO
+
+        GPIO.setmode(GPIO.BCM)
+        for channel in BUTTON_CHANNELS:
+            GPIO.setup(channel, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.add_event_detect(channel, GPIO.RISING, callback=callback, bouncetime=50)
@@ -0,0 +1,262 @@
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from threading import Lock
+
+
+logger = logging.getLogger(__name__)
+
+# Every record is a timestamp followed by temperature, humidity and humidifier state. In the downsampled tiers the
+# values are averages over the bucket, so the humidifier state becomes the fraction of time it was on.
+RECORD = struct.Struct('<dfff')
+
+HistoryRecord = namedtuple('HistoryRecord', ['timestamp', 'temperature', 'humidity', 'humidifier'])
+
+# `resolution` is the bucket size of a tier in seconds (0 keeps every sample). Each tier is split into append-only
+# segment files spanning `segment_seconds`, and whole segments are deleted once they're older than `retention_seconds`,
+# which bounds disk use to roughly retention / resolution records per tier.
+Tier = namedtuple('Tier', ['name', 'resolution', 'segment_seconds', 'retention_seconds'])
+
+TIERS = [
+    Tier('raw', 0, 6 * 60 * 60, 2 * 24 * 60 * 60),
+    Tier('minute', 60, 24 * 60 * 60, 30 * 24 * 60 * 60),
+    Tier('hour', 60 * 60, 30 * 24 * 60 * 60, 5 * 365 * 24 * 60 * 60),
+]
+
+# Pending records are written when the store is flushed, or earlier if this many raw records are waiting.
+MAX_PENDING_RECORDS = 1024
+
+
+class _Bucket:
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.temperature = 0.0
+        self.humidity = 0.0
+        self.humidifier = 0.0
+
+    def add(self, temperature, humidity, humidifier):
+        self.count += 1
+        self.temperature += temperature
+        self.humidity += humidity
+        self.humidifier += humidifier
+
+    def record(self):
+        return (self.start, self.temperature / self.count, self.humidity / self.count, self.humidifier / self.count)
+
+
+class _TierLog:
+    def __init__(self, directory, tier):
+        self.tier = tier
+        self.directory = os.path.join(directory, tier.name)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.pending = bytearray()
+        self.bucket = None
+
+    def segment_start(self, timestamp):
+        return int(timestamp // self.tier.segment_seconds) * self.tier.segment_seconds
+
+    def segment_path(self, start):
+        return os.path.join(self.directory, f'{start}.bin')
+
+    def segments(self):
+        starts = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin'):
+                try:
+                    starts.append(int(name[:-4]))
+                except ValueError:
+                    continue
+
+        return sorted(starts)
+
+    def add(self, timestamp, temperature, humidity, humidifier):
+        if self.tier.resolution == 0:
+            self.pending += RECORD.pack(timestamp, temperature, humidity, humidifier)
+            return
+
+        bucket_start = int(timestamp // self.tier.resolution) * self.tier.resolution
+        if self.bucket is not None and self.bucket.start != bucket_start:
+            self.pending += RECORD.pack(*self.bucket.record())
+            self.bucket = None
+
+        if self.bucket is None:
+            self.bucket = _Bucket(bucket_start)
+
+        self.bucket.add(temperature, humidity, humidifier)
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # Records are grouped per segment so every segment gets a single append.
+        offset = 0
+        try:
+            while offset < len(self.pending):
+                start = self.segment_start(RECORD.unpack_from(self.pending, offset)[0])
+                end = offset + RECORD.size
+                while end < len(self.pending) and self.segment_start(RECORD.unpack_from(self.pending, end)[0]) == start:
+                    end += RECORD.size
+
+                with open(self.segment_path(start), 'ab') as f:
+                    f.write(self.pending[offset:end])
+
+                offset = end
+        finally:
+            # Only the records that made it to disk are dropped.
+            del self.pending[:offset]
+
+    def last_timestamp(self):
+        """Returns the timestamp of the last record on disk, or None if there's none."""
+        for segment in reversed(self.segments()):
+            path = self.segment_path(segment)
+            count = os.path.getsize(path) // RECORD.size
+            if count == 0:
+                continue
+
+            with open(path, 'rb') as f:
+                f.seek((count - 1) * RECORD.size)
+                return RECORD.unpack(f.read(RECORD.size))[0]
+
+        return None
+
+    def prune(self, now):
+        oldest_kept = now - self.tier.retention_seconds
+        for start in self.segments():
+            if start + self.tier.segment_seconds < oldest_kept:
+                os.remove(self.segment_path(start))
+
+    def query(self, start, end):
+        records = []
+
+        for segment in self.segments():
+            if segment + self.tier.segment_seconds <= start or segment > end:
+                continue
+
+            path = self.segment_path(segment)
+            size = os.path.getsize(path)
+            # A crash in the middle of an append can leave a partial record at the end, which is ignored.
+            count = size // RECORD.size
+            if count == 0:
+                continue
+
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                records.extend(_range(m, count, start, end))
+
+        pending_count = len(self.pending) // RECORD.size
+        records.extend(_range(self.pending, pending_count, start, end))
+
+        return records
+
+
+def _range(buffer, count, start, end):
+    # Records in a buffer are ordered by time, so the first one in range is found with a binary search.
+    low = 0
+    high = count
+    while low < high:
+        middle = (low + high) // 2
+        if RECORD.unpack_from(buffer, middle * RECORD.size)[0] < start:
+            low = middle + 1
+        else:
+            high = middle
+
+    records = []
+    for i in range(low, count):
+        record = HistoryRecord._make(RECORD.unpack_from(buffer, i * RECORD.size))
+        if record.timestamp > end:
+            break
+        records.append(record)
+
+    return records
+
+
+class HistoryStore:
+    """Append-only log of measurements, downsampled into coarser tiers as it goes.
+
+    Appends only touch memory. Records are written to disk in batches by `flush`, which the controller calls
+    periodically, so the SD card sees a handful of appends per flush instead of a write per sample.
+    """
+
+    def __init__(self, directory, tiers=TIERS, time_func=time.time):
+        self._time = time_func
+        self._lock = Lock()
+        self._tiers = [_TierLog(directory, tier) for tier in tiers]
+        self._rebuild_buckets()
+
+    @property
+    def tiers(self):
+        return [log.tier for log in self._tiers]
+
+    def append(self, timestamp, temperature, humidity, humidifier):
+        with self._lock:
+            for log in self._tiers:
+                log.add(timestamp, temperature, humidity, float(humidifier))
+
+            needs_flush = len(self._tiers[0].pending) >= MAX_PENDING_RECORDS * RECORD.size
+
+        if needs_flush:
+            self.flush()
+
+    def flush(self):
+        now = self._time()
+
+        with self._lock:
+            for log in self._tiers:
+                try:
+                    log.flush()
+                    log.prune(now)
+                except OSError:
+                    logger.exception(f'Failed to write {log.tier.name} history. Will retry on the next flush.')
+
+    def _rebuild_buckets(self):
+        # Buckets are only written once they're complete, so the ones in progress when the controller last stopped were
+        # lost with it. Their samples are still in the raw tier, from which they're added again.
+        raw = next((log for log in self._tiers if log.tier.resolution == 0), None)
+        if raw is None:
+            return
+
+        for log in self._tiers:
+            if log.tier.resolution == 0:
+                continue
+
+            last = log.last_timestamp()
+            start = float('-inf') if last is None else last + log.tier.resolution
+            try:
+                records = raw.query(start, float('inf'))
+            except OSError:
+                logger.exception(f'Failed to read raw history to rebuild the {log.tier.name} history.')
+                continue
+
+            for record in records:
+                log.add(*record)
+
+    def query(self, start, end=None, tier=None):
+        """Returns the records between `start` and `end` (inclusive).
+
+        Without an explicit tier, the finest tier that still retains `start` is used.
+        """
+        if end is None:
+            end = self._time()
+
+        with self._lock:
+            log = self._tier_log(tier, start)
+            return log.query(start, end)
+
+    def _tier_log(self, name, start):
+        if name is not None:
+            for log in self._tiers:
+                if log.tier.name == name:
+                    return log
+
+            raise ValueError(f'Unknown history tier {name}.')
+
+        age = self._time() - start
+        for log in self._tiers:
+            if log.tier.retention_seconds >= age:
+                return log
+
+        return self._tiers[-1]
@@ -0,0 +1,76 @@
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+HYSTERESIS_MODE = 'hysteresis'
+PI_MODE = 'pi'
+
+
+class HumidityPolicy:
+    """Decides whether the humidifier should run, given the latest averaged humidity.
+
+    In hysteresis mode the humidifier turns on below the desired humidity minus half the band, and off above it plus
+    half the band. In PI mode a proportional-integral controller computes a duty cycle, which is applied by running the
+    humidifier for that fraction of every PI period. In both modes, the humidifier stays on (or off) for at least the
+    configured minimum time after switching, so the relay never chatters.
+    """
+
+    def __init__(self, configs):
+        self._configs = configs
+        self._integral = 0.0
+        self._last_decision_time = None
+        self._period_start = None
+        self._duty_cycle = 0.0
+        # Wall time of the last switch made through the policy. None until then, so the first decision is never held back.
+        self._last_switch_time = None
+
+    @property
+    def duty_cycle(self):
+        return self._duty_cycle
+
+    def decide(self, humidity, desired_humidity, is_on, now):
+        """Returns whether the humidifier should be on."""
+        if self._configs.humidifier_control_mode == PI_MODE:
+            wants_on = self._decide_pi(humidity, desired_humidity, now)
+        else:
+            wants_on = self._decide_hysteresis(humidity, desired_humidity, is_on)
+
+        if wants_on != is_on and self._last_switch_time is not None:
+            min_dwell_seconds = self._configs.humidifier_min_on_seconds if is_on else \
+                self._configs.humidifier_min_off_seconds
+            if now - self._last_switch_time < min_dwell_seconds:
+                return is_on
+
+        return wants_on
+
+    def switched(self, now):
+        self._last_switch_time = now
+
+    def _decide_hysteresis(self, humidity, desired_humidity, is_on):
+        half_band = self._configs.humidifier_hysteresis / 2
+
+        if humidity < desired_humidity - half_band:
+            return True
+        if humidity > desired_humidity + half_band:
+            return False
+
+        return is_on
+
+    def _decide_pi(self, humidity, desired_humidity, now):
+        error = desired_humidity - humidity
+        elapsed = 0 if self._last_decision_time is None else now - self._last_decision_time
+        self._last_decision_time = now
+
+        # The integral term is kept within the duty cycle's range, so it can't wind up while the output is saturated.
+        self._integral += self._configs.humidifier_pi_ki * error * elapsed
+        self._integral = max(0.0, min(1.0, self._integral))
+
+        period = self._configs.humidifier_pi_period_seconds
+        if self._period_start is None or now - self._period_start >= period:
+            self._period_start = now
+            output = self._configs.humidifier_pi_kp * error + self._integral
+            self._duty_cycle = max(0.0, min(1.0, output))
+            logger.debug(f'Humidifier duty cycle for the next {period}s is {self._duty_cycle:.2f}.')
+
+        return now - self._period_start < self._duty_cycle * period
@@ -1,220 +1,554 @@
+import math
 import os
-from time import sleep
-from threading import Timer
-import digitalio
-import busio
-import board
-import RPi.GPIO as GPIO
-import adafruit_sht31d
-from adafruit_epd.ssd1680 import Adafruit_SSD1680
-from display import DisplayController
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from display import DisplayController, load_glyph_atlases
+from displayworker import DisplayWorker
 from state import CheeseCaveControllerMode, CheeseCaveState
 from configs import CheeseCaveConfigs
+from etcdstate import SNAPSHOT_DIRECTORY
+from scheduler import Scheduler
+from etcdconnection import EtcdConnection
+from stats import RollingStats
+from history import HistoryStore
+from sensors import SensorArray, sensor_specs_from_configs
+from sensorhealth import SensorMonitor
+from humidifier import HumidityPolicy
+from sampling import SamplingPolicy
+from pulse import PulseSequencer, pulse_profile_from_configs, press_edges
+from hardware import PiHardware
+from api import ReadApi
+import metrics
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+MEASURE_SECONDS = metrics.histogram(
+    'cheesecave_measure_seconds', 'Time spent in each stage of a measurement.', ['stage'])
+MEASUREMENTS_SKIPPED = metrics.counter(
+    'cheesecave_measurements_skipped', 'Measurements skipped because no sensor reading was usable.')
+HUMIDIFIER_COMMANDS = metrics.counter(
+    'cheesecave_humidifier_commands', 'Humidifier commands, by action and result.', ['action', 'result'])
+HUMIDIFIER_COMMAND_SECONDS = metrics.histogram(
+    'cheesecave_humidifier_command_seconds', 'Time from sending a humidifier command to its presses being done.',
+    ['action'])
+
+# Where files the controller can always rebuild (like the display's glyph atlases) are kept between runs.
+CACHE_DIRECTORY = '/var/lib/cheesecave/cache'
+
+CONFIG_APPLY_SECONDS = metrics.histogram(
+    'cheesecave_config_apply_seconds', 'Time spent applying config changes, by what was reconfigured.', ['part'])
+
+# What re-applies the configs that can change while the controller runs, along with the configs each depends on.
+LIVE_CONFIGS = {
+    'reschedule_measurements': {'measurement_mode', 'measurement_delay_seconds', 'measurement_min_delay_seconds',
+        'measurement_max_delay_seconds'},
+    'resize_measurement_window': {'measurement_window_seconds', 'measurement_delay_seconds',
+        'measurement_min_delay_seconds'},
+    'reschedule_heater': {'heater_on_seconds', 'heater_delay_seconds'},
+    'reschedule_display_updates': {'display_update_delay_seconds'},
+    'reschedule_history_flush': {'history_flush_seconds'},
+    'reschedule_metrics_textfile': {'metrics_textfile_seconds'},
+    'reconfigure_sensors': {'sensors', 'sensor_list', 'sensor_frequency', 'sensor_art_mode',
+        'sensor_read_timeout_seconds', 'sensor_retry_base_seconds', 'sensor_retry_max_seconds',
+        'sensor_quarantine_failures', 'sensor_outlier_threshold'},
+    'reconfigure_humidifier': {'humidifier_connected'},
+    'reconfigure_display': {'display_material_fields', 'display_max_unchanged_seconds', 'display_graph_seconds'},
+    'reconfigure_state_storage': {'store_coalesce_seconds'},
+}
+# Configs only read when something is set up, which a change doesn't take effect without a restart. Configs read on
+# every use (like the humidifier's policy and pulses, or the heater's settle time) apply by themselves.
+RESTART_CONFIGS = {'history_directory', 'metrics_http_port', 'metrics_http_host', 'metrics_textfile_path',
+    'api_http_port', 'api_http_host'}
+
+# How long each step of the last startup took, by step, and in total.
+STARTUP_SECONDS = {}
+metrics.gauge('cheesecave_startup_seconds', 'How long each step of the controller startup took.',
+    lambda: {(step,): seconds for step, seconds in STARTUP_SECONDS.items()}, ['step'])
+
 
 class CheeseCaveController:
-    def __init__(self):
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
-        self.ecs = digitalio.DigitalInOut(board.CE0)
-        self.dc = digitalio.DigitalInOut(board.D22)
-        self.rst = digitalio.DigitalInOut(board.D27)
-        self.busy = digitalio.DigitalInOut(board.D17)
-
-        logger.info('Controller is loading configs and state.')
-        self.configs = CheeseCaveConfigs()
+    def __init__(self, hardware=None, connection=None, clock=time, snapshot_directory=SNAPSHOT_DIRECTORY,
+            cache_directory=CACHE_DIRECTORY):
+        # Anything with `time()`, `monotonic()` and `sleep()`, like the `time` module. The simulation passes a virtual clock.
+        self.clock = clock
+        self.hardware = hardware
+        self._snapshot_directory = snapshot_directory
+        self._cache_directory = cache_directory
+
+        # Every timed job of the controller (measurements, heater, humidifier, display and state storage) runs from this scheduler.
+        self.scheduler = Scheduler(self.clock.monotonic)
+
+        # Configs and state share a single etcd client and watch.
+        self.etcd = connection if connection is not None else EtcdConnection()
+
+        # Names of the configs changed in etcd since they were last applied. See `configs_changed`.
+        self._config_changes = set()
+        self._config_changes_lock = Lock()
+
+        # Steps of the same phase don't depend on each other, so they run side by side. What's slow at startup is
+        # mostly waiting on hardware, files and etcd.
+        started = time.perf_counter()
+        self.run_startup_steps({
+            'hardware': self.setup_hardware,
+            'configs': self.load_configs,
+            'state': self.load_state,
+            'glyph_atlases': lambda: load_glyph_atlases(self._cache_directory),
+        })
+        self.reconfigure_state_storage()
+        self.run_startup_steps({
+            'display': self.setup_display,
+            'sensors': self.setup_sensors,
+            'humidifier': self.setup_humidifier,
+        })
+        self.hardware.setup_buttons(self.button_pressed)
+        self.api = None
+
+        STARTUP_SECONDS['total'] = time.perf_counter() - started
+        logger.info(f'Startup took {STARTUP_SECONDS["total"]:.3f}s.')
+
+        # Until then, the sensors are still heated or cooling down from it. See `heater_cycle`.
+        self._heater_settled_at = 0
+        self._sampling_policy = SamplingPolicy(self.configs)
+        self._temperature_stats = RollingStats(*self._measurement_window())
+        self._humidity_stats = RollingStats(*self._measurement_window())
+
+    def run_startup_steps(self, steps):
+        """Runs every step of a startup phase at once, and returns when they're all done."""
+        with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='startup') as executor:
+            futures = [executor.submit(self._timed_startup_step, name, step) for name, step in steps.items()]
+
+        for future in futures:
+            future.result()
+
+    def _timed_startup_step(self, name, step):
+        started = time.perf_counter()
+        step()
+        STARTUP_SECONDS[name] = time.perf_counter() - started
+        logger.info(f'Startup: {name} took {STARTUP_SECONDS[name]:.3f}s.')
+
+    def setup_hardware(self):
+        if self.hardware is None:
+            self.hardware = PiHardware()
+        self.i2c = self.hardware.i2c
+        self.display = self.hardware.display
+
+    def load_configs(self):
+        self.configs = CheeseCaveConfigs(self.scheduler, self.etcd, self._snapshot_directory, self.configs_changed)
+        # What changes are applied against. Taken before anything is set up with the configs, so a change merged while
+        # setting up is applied again rather than taken as already in place. Applying a change twice does no harm.
+        self._applied_configs = self.configs.to_dict()
+
+    def load_state(self):
         # The state is the one that receives button events when someone presses a button. One of the actions is shutting down the board, so we need to give it a shutdown callback.
-        self.state = CheeseCaveState(self.shutdown)
-        logger.info('Configs and state loaded.')
-
-        self.display = Adafruit_SSD1680(
-            122,
-            250,
-            self.spi,
-            cs_pin=self.ecs,
-            dc_pin=self.dc,
-            sramcs_pin=None,
-            rst_pin=self.rst,
-            busy_pin=self.busy,
+        self.state = CheeseCaveState(self.shutdown, self.scheduler, self.etcd, self._snapshot_directory, self.clock.time)
+
+    def setup_display(self):
+        # The graph screen reads from the history, so it's opened first.
+        self.history = HistoryStore(self.configs.history_directory, time_func=self.clock.time)
+        self.display_controller = DisplayController(
+            self.display,
+            self.state,
+            material_fields=self.configs.display_material_fields,
+            max_unchanged_seconds=self.configs.display_max_unchanged_seconds,
+            clock=self.clock,
+            history=self.history,
+            graph_seconds=self.configs.display_graph_seconds,
         )
-        self.display.rotation = 1
-        self.display_controller = DisplayController(self.display, self.state)
+        self.display_worker = self.make_display_worker()
 
-        logger.info('Display controller started.')
+    def _measurement_window(self):
+        # The window is time based, since adaptive sampling doesn't take measurements at a fixed rate. It's sized for
+        # the fastest rate measurements can be taken at.
+        window_seconds = self.configs.measurement_window_seconds
+        return (math.ceil(window_seconds / self._sampling_policy.minimum_delay()) + 1, window_seconds)
 
-        self.setup_sensors()
-        self.setup_humidifier()
+    def averaged_measures(self):
+        return (self._temperature_stats.mean, self._humidity_stats.mean)
 
-        # Up and down buttons are configured directly with RPi.GPIO so we can have threaded callbacks whenever a button press is detected. This avoids all the busy loop that we'd have to do if we used adafruit's code instead.
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(5, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(5, GPIO.RISING, callback=self.button_pressed, bouncetime=50)
-        GPIO.setup(6, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(6, GPIO.RISING, callback=self.button_pressed, bouncetime=50)
+    def start(self):
+        self.scheduler.every('heater_cycle', self.configs.heater_delay_seconds, self.heater_cycle)
+        self.scheduler.every('measure', self._sampling_policy.current_delay(), self.measure)
+        self.display_worker.start()
+        self.setup_metrics()
+        self.setup_api()
+        self.scheduler.every('flush_history', self.configs.history_flush_seconds, self.history.flush,
+            first_delay=self.configs.history_flush_seconds)
+        self.update_display()
 
-        self._return_menu_timer = None
-        self._display_update_timer = None
+    def setup_metrics(self):
+        if not self.configs.metrics_http_port and not self.configs.metrics_textfile_path:
+            return
 
-        self._measurement_rolling_window_size = int(self.configs.display_update_delay_seconds / \
-            self.configs.measurement_delay_seconds)
-        self._measurements = []
+        metrics.REGISTRY.enabled = True
 
-    def averaged_measures(self):
-        summed_measurements = list(map(sum, zip(*self._measurements)))
-        temperature = summed_measurements[0] / len(self._measurements)
-        humidity = summed_measurements[1] / len(self._measurements)
+        if self.configs.metrics_http_port:
+            metrics.serve(self.configs.metrics_http_port, self.configs.metrics_http_host)
 
-        return (temperature, humidity)
+        if self.configs.metrics_textfile_path:
+            self.scheduler.every('write_metrics', self.configs.metrics_textfile_seconds,
+                lambda: metrics.write_textfile(self.configs.metrics_textfile_path))
 
-    def start(self):
-        self.heater_cycle()
-        self.measure()
-        self.make_humidifier_decision()
+    def setup_api(self):
+        if not self.configs.api_http_port:
+            return
+
+        self.api = ReadApi(self.history, time_func=self.clock.time)
+        self.api.start(self.configs.api_http_port, self.configs.api_http_host)
+
+    def publish_snapshot(self, now, temperature, humidity):
+        # Only the state's fields are copied, since they keep changing. The stats and sensor health are immutable, and
+        # are only turned into dicts (and encoded) on the API's thread, if someone asks.
+        measurement = {'time': now, 'temperature': temperature, 'humidity': humidity,
+            'humidifier': self.state.humidifier_state}
+        state = self.state.to_dict()
+        mode = self.state.mode
+        temperature_stats = self.state.temperature_stats
+        humidity_stats = self.state.humidity_stats
+        sensor_health = self.state.sensor_health
+
+        def snapshot():
+            return {
+                'time': now,
+                'measurement': measurement,
+                'state': state,
+                'mode': mode.name,
+                'stats': {
+                    'temperature': temperature_stats._asdict(),
+                    'humidity': humidity_stats._asdict(),
+                },
+                'sensors': [status._asdict() for status in sensor_health],
+            }
+
+        self.api.publish(snapshot, measurement)
+
+    def configs_changed(self, changed_fields):
+        # Everything a config change touches belongs to the scheduler's thread, so it's applied from there. Changes that
+        # come in before that job runs are applied along with it.
+        with self._config_changes_lock:
+            self._config_changes.update(changed_fields)
+
+        self.scheduler.after('apply_configs', 0, self.apply_config_changes)
+
+    def apply_config_changes(self):
+        with self._config_changes_lock:
+            changed_fields = self._config_changes
+            self._config_changes = set()
+
+        # Changes that were already in place when everything was set up (e.g. merged while loading) are skipped.
+        configs = self.configs.to_dict()
+        changed_fields = {name for name in changed_fields if configs.get(name) != self._applied_configs.get(name)}
+        self._applied_configs = configs
+
+        if changed_fields & RESTART_CONFIGS:
+            logger.warning(f'Changes to {", ".join(sorted(changed_fields & RESTART_CONFIGS))} only take effect once the '
+                'controller restarts.')
+
+        for (part, fields) in LIVE_CONFIGS.items():
+            if not changed_fields & fields:
+                continue
+
+            started = time.perf_counter()
+            try:
+                getattr(self, part)()
+            except Exception:
+                logger.exception(f'Failed to apply changes to {", ".join(sorted(changed_fields & fields))}.')
+                continue
+
+            elapsed = time.perf_counter() - started
+            CONFIG_APPLY_SECONDS.observe(elapsed, part)
+            logger.info(f'Config change: {part} for {", ".join(sorted(changed_fields & fields))} took {elapsed * 1000:.1f}ms.')
+
+    def reschedule_measurements(self):
+        self.scheduler.reschedule('measure', interval=self._sampling_policy.current_delay())
+
+    def resize_measurement_window(self):
+        (capacity, window_seconds) = self._measurement_window()
+        self._temperature_stats.resize(capacity, window_seconds)
+        self._humidity_stats.resize(capacity, window_seconds)
+
+    def reschedule_heater(self):
+        # Only the period the heater is in changes now. The other one applies from the next switch.
+        self.scheduler.reschedule('heater_cycle',
+            interval=self.configs.heater_on_seconds if self.state.heater_on else self.configs.heater_delay_seconds)
+
+    def reschedule_display_updates(self):
+        self.scheduler.reschedule('update_display', interval=self.configs.display_update_delay_seconds)
+
+    def reschedule_history_flush(self):
+        self.scheduler.reschedule('flush_history', interval=self.configs.history_flush_seconds)
+
+    def reschedule_metrics_textfile(self):
+        self.scheduler.reschedule('write_metrics', interval=self.configs.metrics_textfile_seconds)
+
+    def reconfigure_sensors(self):
+        specs = sensor_specs_from_configs(self.configs)
+        (added, removed) = self._sensor_array.reconfigure(
+            specs, frequency=self.configs.sensor_frequency, art=self.configs.sensor_art_mode)
+        self._sensors.reconfigure(**self._sensor_monitor_settings())
+
+        for spec in added:
+            logger.info(f'Sensor {spec} added.')
+        for spec in removed:
+            logger.info(f'Sensor {spec} removed.')
+
+        self._sensor_count = len(specs)
+        self.state.sensor_health = self._sensors.health()
+
+    def reconfigure_humidifier(self):
+        if self.configs.humidifier_connected == (self._humidifier_pulses is not None):
+            return
+
+        if self.configs.humidifier_connected:
+            self._connect_humidifier()
+        else:
+            self._disconnect_humidifier()
+
+    def reconfigure_state_storage(self):
+        for state in (self.configs, self.state):
+            state.set_store_coalesce_seconds(self.configs.store_coalesce_seconds)
+
+    def reconfigure_display(self):
+        self.display_controller.reconfigure(self.configs.display_material_fields,
+            self.configs.display_max_unchanged_seconds, self.configs.display_graph_seconds)
+        # So the change shows without waiting for the next periodic update.
         self.update_display()
 
+    def make_display_worker(self):
+        # Only the display worker's thread touches the panel. Everyone else just requests updates from it.
+        return DisplayWorker(self.display_controller, self.clock)
+
+    def make_pulse_sequencer(self, pin):
+        # Button presses are played from the sequencer's thread, so switching the humidifier never blocks the scheduler.
+        sequencer = PulseSequencer(pin)
+        sequencer.start()
+        return sequencer
+
+    def run(self):
+        # Blocks the calling thread running scheduled jobs.
+        self.scheduler.run()
+
     def shutdown(self):
         pass
 
     def setup_sensors(self):
-        if self.configs.sensors == 0:
+        specs = sensor_specs_from_configs(self.configs)
+        if not specs:
             logger.warning("Controller is configured to control 0 sensors! Temperature and humidity data won't be available.")
-            self._sensors = []
         else:
-            logger.info(f'Controller started with {self.configs.sensors} sensors.')
-            self._sensors = [adafruit_sht31d.SHT31D(self.i2c)]
-
-            if self.configs.sensors == 2:
-                self._sensors.append(adafruit_sht31d.SHT31D(self.i2c, address=0x45))
-
-        for sensor in self._sensors:
-            sensor.repeatability = adafruit_sht31d.REP_HIGH
+            logger.info(f'Controller started with {len(specs)} sensors.')
+
+        self._sensor_array = SensorArray(
+            self.i2c, specs, frequency=self.configs.sensor_frequency, art=self.configs.sensor_art_mode,
+            sleep_func=self.clock.sleep, time_func=self.clock.monotonic)
+        self._sensors = SensorMonitor(self._sensor_array, time_func=self.clock.monotonic,
+            **self._sensor_monitor_settings())
+        self._sensor_count = len(specs)
+        self.state.sensor_health = self._sensors.health()
+
+    def _sensor_monitor_settings(self):
+        return {
+            'read_timeout_seconds': self.configs.sensor_read_timeout_seconds,
+            'retry_base_seconds': self.configs.sensor_retry_base_seconds,
+            'retry_max_seconds': self.configs.sensor_retry_max_seconds,
+            'quarantine_failures': self.configs.sensor_quarantine_failures,
+            'outlier_threshold': self.configs.sensor_outlier_threshold,
+        }
 
     def setup_humidifier(self):
-        if not self.configs.humidifier_connected:
+        self.humidifier_control = None
+        # The sequencer playing presses on the pin while the humidifier is connected, None otherwise.
+        self._humidifier_pulses = None
+        self._pulse_sequencer = None
+        # The last humidifier command sent, and whether it turns it on. The state only changes once its presses are done.
+        self._humidifier_command = None
+        self._humidifier_command_value = None
+
+        self._humidity_policy = HumidityPolicy(self.configs)
+
+        if self.configs.humidifier_connected:
+            self._connect_humidifier()
+        else:
             logger.warning(
                 "Controller is configured without a humidifer connected! The controller won't be able to control humidity.")
-            self.humidifier_control = None
+
+    def _connect_humidifier(self):
+        logger.info('Humidifier control configured.')
+        # The pin and its sequencer are kept once set up, so connecting the humidifier again doesn't claim the pin twice,
+        # or have two sequencers drive it while presses sent before disconnecting still play.
+        if self.humidifier_control is None:
+            self.humidifier_control = self.hardware.humidifier_pin()
+            self._pulse_sequencer = self.make_pulse_sequencer(self.humidifier_control)
+        self._humidifier_pulses = self._pulse_sequencer
+
+    def _disconnect_humidifier(self):
+        logger.warning('Humidifier disconnected. The controller no longer controls humidity.')
+
+        # Left running, nothing would ever turn it off. That includes a humidifier whose "on" presses are still playing:
+        # the "off" presses are queued after them.
+        if self._humidifier_command_pending():
+            running = self._humidifier_command_value
         else:
-            logger.info('Humidifier control configured.')
-            self.humidifier_control = digitalio.DigitalInOut(board.D24)
-            self.humidifier_control.switch_to_output()
+            running = self.state.humidifier_state
+        if running:
+            self._send_humidifier_command(False)
 
-    def button_pressed(self, channel):
-        if self._return_menu_timer is not None:
-            self._return_menu_timer.cancel()
-            self._return_menu_timer = None
+        self._humidifier_pulses = None
 
+    def button_pressed(self, channel):
         if channel == 6:
             self.state.top_button_pressed()
         elif channel == 5:
             self.state.bottom_button_pressed()
 
-        self._return_menu_timer = Timer(
-            self.configs.menu_return_delay_seconds, self.return_to_general_menu)
-        self._return_menu_timer.start()
+        # Scheduling a job under the same name replaces the pending one, so every press pushes the menu return back.
+        self.scheduler.after(
+            'return_to_general_menu', self.configs.menu_return_delay_seconds, self.return_to_general_menu)
         self.update_display(delay=True)
 
     def return_to_general_menu(self):
         self.state.mode = CheeseCaveControllerMode.GENERAL_INFO
         self.update_display()
-        self._return_menu_timer = None
 
     def heater_cycle(self):
-        new_timer = None
-
+        # The heater alternates between two periods, so the job's interval is switched on every tick. The scheduler keeps the timing anchored on when each tick was due.
         if self.state.heater_on:
-            for sensor in self._sensors:
-                sensor.heater = False
+            self._sensors.set_heater(False)
             self.state.heater_on = False
-            new_timer = Timer(
-                self.configs.heater_delay_seconds, self.heater_cycle)
+            self._heater_settled_at = self.clock.monotonic() + self.configs.heater_settle_seconds
+            self.scheduler.reschedule('heater_cycle', interval=self.configs.heater_delay_seconds)
         else:
-            for sensor in self._sensors:
-                sensor.heater = True
+            self._sensors.set_heater(True)
             self.state.heater_on = True
-            new_timer = Timer(self.configs.heater_on_seconds, self.heater_cycle)
-
-        new_timer.start()
+            self._heater_settled_at = self.clock.monotonic() + self.configs.heater_on_seconds + \
+                self.configs.heater_settle_seconds
+            self.scheduler.reschedule('heater_cycle', interval=self.configs.heater_on_seconds)
 
     def update_display(self, delay=False):
-        if self._display_update_timer is not None:
-            self._display_update_timer.cancel()
-
-        if not delay:
-            self.display_controller.update_display()
-
-        next_update_in = self.configs.display_update_delay_seconds
+        update_in = 0
         if delay:
-            next_update_in = self.configs.display_update_input_delay_seconds
+            update_in = self.configs.display_update_input_delay_seconds
+
+        self.display_worker.request(delay=update_in)
 
-        self._display_update_timer = Timer(next_update_in, self.update_display)
-        self._display_update_timer.start()
+        # Replaces the pending periodic update, so periodic updates restart from this one.
+        self.scheduler.every('update_display', self.configs.display_update_delay_seconds, self.display_worker.request,
+            first_delay=update_in + self.configs.display_update_delay_seconds)
 
     def measure(self):
+        with MEASURE_SECONDS.time('total'):
+            self._measure()
+
+    def _measure(self):
+        # Heated sensors read warmer and drier than the cave, until they cooled down again. Rather than having those
+        # readings rejected as outliers (or worse, accepted), the measurement waits for the sensors to settle.
+        settling_seconds = self._heater_settled_at - self.clock.monotonic()
+        if settling_seconds > 0:
+            logger.debug(f'Sensors are heated. Measuring in {settling_seconds:.1f}s.')
+            self.scheduler.reschedule('measure', delay=settling_seconds)
+            return
+
         temperature = []
         humidity = []
 
-        for sensor in self._sensors:
-            temperature.append(sensor.temperature)
-            humidity.append(sensor.relative_humidity)
+        with MEASURE_SECONDS.time('read_sensors'):
+            readings = self._sensors.read()
+            self.state.sensor_health = self._sensors.health()
+
+        if self._sensor_count > 0 and not readings:
+            # Every sensor is failing or was rejected. The sample is skipped rather than averaging in a made up value.
+            logger.warning('No usable sensor readings this round.')
+            MEASUREMENTS_SKIPPED.inc()
+            return
+
+        for reading in readings:
+            temperature.append(reading.temperature)
+            humidity.append(reading.humidity)
 
         # Denominator has a max() to handle case when any of the lists is empty.
         temperature = sum(temperature) / max(1, len(temperature))
         humidity = sum(humidity) / max(1, len(humidity))
 
-        self._measurements.append((temperature, humidity))
+        now = self.clock.time()
+        with MEASURE_SECONDS.time('window_stats'):
+            self._temperature_stats.add(temperature, now)
+            self._humidity_stats.add(humidity, now)
 
-        exceeded_measurements = len(self._measurements) - self._measurement_rolling_window_size
-        if exceeded_measurements > 0:
-            # Getting rid of the oldest measurements that exceed the capacity.
-            self._measurements = self._measurements[exceeded_measurements:]
+            avg_measures = self.averaged_measures()
+            self.state.temperature = avg_measures[0]
+            self.state.humidity = avg_measures[1]
+            self.state.temperature_stats = self._temperature_stats.snapshot()
+            self.state.humidity_stats = self._humidity_stats.snapshot()
 
-        avg_measures = self.averaged_measures()
-        self.state.temperature = avg_measures[0]
-        self.state.humidity = avg_measures[1]
+        with MEASURE_SECONDS.time('history'):
+            self.history.append(now, temperature, humidity, self.state.humidifier_state)
 
-        new_timer = Timer(self.configs.measurement_delay_seconds, self.measure)
-        new_timer.start()
+        # Every new averaged measurement is a chance to react, instead of polling for a decision.
+        with MEASURE_SECONDS.time('humidifier_decision'):
+            self.make_humidifier_decision()
+
+        # Takes effect from the next run, since this is the job's own callback.
+        self.scheduler.reschedule('measure', interval=self._sampling_policy.next_delay(
+            self.state.temperature_stats, self.state.humidity_stats))
+
+        if self.api is not None:
+            with MEASURE_SECONDS.time('publish'):
+                self.publish_snapshot(now, temperature, humidity)
 
     def turn_off_humidifier(self):
-        if self.humidifier_control is None or not self.state.humidifier_state:
+        if self._humidifier_pulses is None or not self.state.humidifier_state or self._humidifier_command_pending():
             return
 
         logger.debug('Turning humidifier off.')
-
-        self.humidifier_control.value = True
-        sleep(0.05)
-        self.humidifier_control.value = False
-        self.state.humidifier_state = False
+        self._send_humidifier_command(False)
 
     def turn_on_humidifier(self):
-        if self.humidifier_control is None or (self.state.humidifier_state or not self.state.has_water):
+        if self._humidifier_pulses is None or (self.state.humidifier_state or not self.state.has_water) or \
+                self._humidifier_command_pending():
             return
 
         logger.debug('Turning humidifier on.')
+        self._send_humidifier_command(True)
+
+    def _humidifier_command_pending(self):
+        return self._humidifier_command is not None and not self._humidifier_command.done()
+
+    def _send_humidifier_command(self, value):
+        # Read on every command, so a changed model or timing applies to the next press.
+        profile = pulse_profile_from_configs(self.configs)
+        presses = profile.on_presses if value else profile.off_presses
+
+        sent = self.clock.monotonic()
+        self._humidifier_command_value = value
+        self._humidifier_command = self._humidifier_pulses.submit(
+            press_edges(profile, presses), name='humidifier on' if value else 'humidifier off')
+        self._humidifier_command.add_done_callback(lambda future: self._humidifier_command_done(future, value, sent))
+
+    def _humidifier_command_done(self, future, value, sent):
+        action = 'on' if value else 'off'
+        HUMIDIFIER_COMMAND_SECONDS.observe(self.clock.monotonic() - sent, action)
+
+        if future.exception() is not None:
+            # The humidifier may or may not have seen the presses. The state is left as it was.
+            logger.error(f'Failed to turn humidifier {action}.')
+            HUMIDIFIER_COMMANDS.inc(action, 'failed')
+            return
+
+        HUMIDIFIER_COMMANDS.inc(action, 'done')
 
-        self.humidifier_control.value = True
-        sleep(0.05)
-        self.humidifier_control.value = False
-        sleep(0.1)
-        self.humidifier_control.value = True
-        sleep(0.05)
-        self.humidifier_control.value = False
-        self.state.humidifier_state = True
+        self.state.humidifier_state = value
+        self._humidity_policy.switched(self.clock.time())
 
     def make_humidifier_decision(self):
-        if self.state.humidity >= self.state.desired_humidity:
-            self.turn_off_humidifier()
-        else:
-            self.turn_on_humidifier()
+        should_run = self._humidity_policy.decide(
+            self.state.humidity, self.state.desired_humidity, self.state.humidifier_state, self.clock.time())
 
-        new_timer = Timer(
-            self.configs.humidifier_decision_delay_seconds, self.make_humidifier_decision)
-        new_timer.start()
+        if should_run:
+            self.turn_on_humidifier()
+        else:
+            self.turn_off_humidifier()
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -223,6 +557,9 @@ if __name__ == "__main__":
     controller = CheeseCaveController()
     logger.info('Controller initialized. Starting.')
     controller.start()
-    logger.info('Controller started. Will now enter an infinite sleep loop.')
-    while True:
-        sleep(3600)
+    logger.info('Controller started. Will now run scheduled jobs.')
+    try:
+        controller.run()
+    finally:
+        # Whatever history is still batched in memory would otherwise be lost.
+        controller.history.flush()
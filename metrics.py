@@ -0,0 +1,280 @@
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets, in seconds. They go from sub-millisecond (state serialization, stats) to the multi-second e-ink refresh.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# Handed out whenever metrics are disabled, so timing a disabled metric costs one check and no allocation.
+_NOOP_TIMER = _NoopTimer()
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started, *self._label_values)
+        return False
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labels=()):
+        super().__init__(registry, name, help, labels)
+        self._values = {}
+
+    def _header(self):
+        # Samples are named with the `_total` suffix, and the type has to be declared for that same name.
+        return [f'# HELP {self.name}_total {self.help}', f'# TYPE {self.name}_total {self.kind}']
+
+    def inc(self, *label_values, amount=1):
+        if not self._registry.enabled:
+            return
+
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = self._header()
+        for label_values, value in values:
+            lines.append(f'{self.name}_total{_format_labels(self.labels, label_values)} {_format_value(value)}')
+
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label values: the count of every bucket (not cumulative), the sum and the count of observations.
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        if not self._registry.enabled:
+            return
+
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *label_values):
+        """Returns a context manager that observes how long its block took."""
+        if not self._registry.enabled:
+            return _NOOP_TIMER
+
+        return _Timer(self, label_values)
+
+    def render(self):
+        with self._lock:
+            values = sorted((label_values, (list(entry[0]), entry[1], entry[2]))
+                for label_values, entry in self._values.items())
+
+        lines = self._header()
+        for label_values, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, [f'le="{_format_value(bound)}"'])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, label_values)} {count}')
+
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read when the metrics are collected, from a callback returning either a number or a dict from label
+    values (as tuples) to numbers."""
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help, callback, labels=()):
+        super().__init__(registry, name, help, labels)
+        self._callback = callback
+
+    def render(self):
+        lines = self._header()
+
+        try:
+            values = self._callback()
+        except Exception:
+            logger.exception(f'Failed to collect {self.name}.')
+            return lines
+
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for label_values, value in sorted(values.items()):
+            if value is None:
+                continue
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}')
+
+        return lines
+
+
+class Registry:
+    """Every metric of the process.
+
+    Metrics are declared when their module is imported, but nothing is recorded until the registry is enabled, so
+    instrumented code costs next to nothing when metrics are off.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered.')
+            self._metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, help, labels, buckets))
+
+    def gauge(self, name, help, callback, labels=()):
+        return self._add(Gauge(self, name, help, callback, labels))
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+gauge('cheesecave_threads', 'Threads currently alive in the process.', threading.active_count)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to stderr every few seconds.
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Serves the metrics on `http://host:port/metrics` from a background thread. Returns the server."""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f'Serving metrics on http://{host}:{server.server_port}/metrics.')
+
+    return server
+
+
+def write_textfile(path, registry=REGISTRY):
+    """Writes the metrics for node_exporter's textfile collector. The file is replaced atomically, so it's never read
+    half written."""
+    temporary_path = path + '.tmp'
+
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(temporary_path, 'w') as f:
+            f.write(registry.render())
+        os.replace(temporary_path, path)
+    except OSError:
+        logger.exception(f'Failed to write metrics to {path}.')
@@ -0,0 +1,111 @@
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread
+
+
+logger = logging.getLogger(__name__)
+
+# How a humidifier model's button is pressed through its control pin: how long a press and the pause between presses
+# last, and how many presses turn it on and off.
+PulseProfile = namedtuple('PulseProfile', ['press_seconds', 'between_presses_seconds', 'on_presses', 'off_presses'])
+
+DEFAULT_HUMIDIFIER_MODEL = 'default'
+DEFAULT_PULSE_PROFILES = {
+    DEFAULT_HUMIDIFIER_MODEL: {
+        'press_seconds': 0.05,
+        'between_presses_seconds': 0.1,
+        'on_presses': 2,
+        'off_presses': 1,
+    },
+}
+
+
+def pulse_profile_from_configs(configs):
+    """Returns the pulse profile of the configured humidifier model, falling back to the default one."""
+    profiles = configs.humidifier_pulse_profiles
+    model = configs.humidifier_model
+
+    if model not in profiles:
+        logger.warning(f'No pulse profile configured for humidifier model {model!r}. Using the default one.')
+        return PulseProfile(**DEFAULT_PULSE_PROFILES[DEFAULT_HUMIDIFIER_MODEL])
+
+    return PulseProfile(**profiles[model])
+
+
+def press_edges(profile, presses):
+    """Returns the edges of `presses` button presses, as (pin value, seconds to hold it) pairs."""
+    edges = []
+    for press in range(presses):
+        if press > 0:
+            edges.append((False, profile.between_presses_seconds))
+        edges.append((True, profile.press_seconds))
+    # Released for a pause at the end too, so a sequence queued right after isn't taken as part of this one.
+    edges.append((False, profile.between_presses_seconds))
+
+    return edges
+
+
+class PulseSequencer:
+    """Plays edge sequences on an output pin from its own thread.
+
+    Sequences are queued and played one after the other, so two callers can never interleave their pulses on the pin.
+    Submitting never blocks: it returns a `Future` that completes once the whole sequence was played.
+    """
+
+    def __init__(self, pin):
+        self._pin = pin
+        self._queue = Queue()
+        self._thread = None
+
+        self.sequences_played = 0
+        self.sequences_failed = 0
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='pulses', daemon=True)
+        self._thread.start()
+
+    def submit(self, edges, name=None):
+        future = Future()
+        self._queue.put((list(edges), name, future))
+        return future
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            (edges, name, future) = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                self._play(edges)
+            except Exception as e:
+                self.sequences_failed += 1
+                logger.exception(f'Failed to play pulse sequence {name}.')
+                # Whatever happened, the pin is left low rather than stuck in a press.
+                self._release()
+                future.set_exception(e)
+                continue
+
+            self.sequences_played += 1
+            future.set_result(name)
+
+    def _play(self, edges):
+        # Holds are measured from when each edge was due, so the time spent switching the pin doesn't add up.
+        due = time.monotonic()
+        for (value, hold_seconds) in edges:
+            self._pin.value = value
+            due += hold_seconds
+            remaining = due - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def _release(self):
+        try:
+            self._pin.value = False
+        except Exception:
+            logger.exception('Failed to release the pulse pin.')
@@ -0,0 +1,73 @@
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+FIXED_MODE = 'fixed'
+ADAPTIVE_MODE = 'adaptive'
+
+# Fewest samples a window needs before its trend is trusted, and how many standard errors a trend has to be away from 0.
+MIN_TREND_SAMPLES = 3
+TREND_SIGNIFICANCE = 2
+
+
+def _trending(stats, threshold):
+    # Trends are per second, thresholds per minute. A trend only counts once it stands out of the noise (by two
+    # standard errors), since a window with a handful of noisy samples always has some slope.
+    return stats.count >= MIN_TREND_SAMPLES and abs(stats.trend) * 60 >= threshold and \
+        abs(stats.trend) >= TREND_SIGNIFICANCE * stats.trend_stderr
+
+
+class SamplingPolicy:
+    """Decides how long to wait before the next measurement, given the window stats of the measurements so far.
+
+    In fixed mode that's always `measurement_delay_seconds`. In adaptive mode, measurements drop straight to the
+    shortest delay as soon as readings move (their trend or spread reaches a threshold), like after the door was opened
+    or the humidifier kicked in, and the delay then grows by a factor with every steady measurement, up to the longest
+    delay. A stable cave then costs a fraction of the I2C traffic and sensor wear, without reacting any slower.
+    """
+
+    def __init__(self, configs):
+        self._configs = configs
+        self._delay = None
+
+    def minimum_delay(self):
+        """Returns the shortest delay the policy can pick, whatever the mode."""
+        return min(self._configs.measurement_delay_seconds, self._configs.measurement_min_delay_seconds)
+
+    def _bounds(self):
+        shortest = self._configs.measurement_min_delay_seconds
+        return (shortest, max(shortest, self._configs.measurement_max_delay_seconds))
+
+    def current_delay(self):
+        """Returns the delay last picked, brought within the current configs (which may have just changed)."""
+        configs = self._configs
+        if configs.measurement_mode != ADAPTIVE_MODE:
+            return configs.measurement_delay_seconds
+
+        (shortest, longest) = self._bounds()
+        return max(shortest, min(longest, self._delay or configs.measurement_delay_seconds))
+
+    def next_delay(self, temperature_stats, humidity_stats):
+        configs = self._configs
+        if configs.measurement_mode != ADAPTIVE_MODE:
+            self._delay = configs.measurement_delay_seconds
+            return self._delay
+
+        (shortest, longest) = self._bounds()
+
+        moving = _trending(humidity_stats, configs.measurement_humidity_trend_threshold) or \
+            _trending(temperature_stats, configs.measurement_temperature_trend_threshold) or \
+            humidity_stats.stddev >= configs.measurement_humidity_stddev_threshold
+
+        if moving:
+            delay = shortest
+        else:
+            delay = (self._delay or configs.measurement_delay_seconds) * configs.measurement_backoff_factor
+
+        delay = max(shortest, min(longest, delay))
+        if delay != self._delay:
+            logger.debug(f'Measuring every {delay:.1f}s.')
+        self._delay = delay
+
+        return delay
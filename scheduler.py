@@ -0,0 +1,263 @@
+import heapq
+import logging
+import time
+from itertools import count
+from threading import Condition, Thread
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+JOB_LAG_SECONDS = metrics.histogram(
+    'cheesecave_scheduler_lag_seconds', 'How late jobs start compared to when they were due.', ['job'])
+JOB_SECONDS = metrics.histogram('cheesecave_scheduler_job_seconds', 'How long jobs run.', ['job'])
+JOB_FAILURES = metrics.counter('cheesecave_scheduler_job_failures', 'Jobs that raised an exception.', ['job'])
+
+
+def _check_interval(interval):
+    if not interval > 0:
+        raise ValueError(f'Job interval must be greater than 0, not {interval}.')
+
+
+class ScheduledJob:
+    def __init__(self, name, callback, due, interval):
+        self.name = name
+        self.callback = callback
+        # Monotonic time at which the job should run next.
+        self.due = due
+        # None for one-shot jobs, otherwise the period of a fixed-rate job.
+        self.interval = interval
+        self.runs = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_lag = None
+        self.running = False
+        self.cancelled = False
+        # Set when the job's own callback asked for an explicit delay before its next run.
+        self.explicitly_rescheduled = False
+        # Incremented every time the job is (re)pushed on the heap, so stale heap entries can be recognised and dropped.
+        self.generation = 0
+
+    def describe(self, now):
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'due_in': None if self.running else self.due - now,
+            'runs': self.runs,
+            'running': self.running,
+            'last_duration': self.last_duration,
+            'last_lag': self.last_lag,
+        }
+
+
+class Scheduler:
+    """Runs every timed job of the controller from a single thread.
+
+    Jobs are identified by name. Scheduling a job with a name that is already in use replaces the existing job, which
+    mirrors the old pattern of cancelling a `Timer` and creating a new one.
+    """
+
+    def __init__(self, time_func=time.monotonic):
+        self._time = time_func
+        self._condition = Condition()
+        self._heap = []
+        self._jobs = {}
+        self._sequence = count()
+        self._running = False
+        self._thread = None
+
+    def time(self):
+        return self._time()
+
+    def every(self, name, interval, callback, first_delay=0):
+        """Runs `callback` every `interval` seconds at a fixed rate, starting after `first_delay` seconds."""
+        _check_interval(interval)
+        return self._add(name, callback, first_delay, interval)
+
+    def after(self, name, delay, callback):
+        """Runs `callback` once, `delay` seconds from now."""
+        return self._add(name, callback, delay, None)
+
+    def cancel(self, name):
+        with self._condition:
+            job = self._jobs.pop(name, None)
+            if job is None:
+                return False
+
+            job.cancelled = True
+            self._condition.notify()
+            return True
+
+    def reschedule(self, name, delay=None, interval=None):
+        """Changes when a job runs next and/or its period.
+
+        When called from within the job's own callback, the new values take effect once the callback returns. Without a
+        `delay`, a periodic job keeps its phase and the new interval is applied from the last time it was due.
+        """
+        if interval is not None:
+            _check_interval(interval)
+
+        with self._condition:
+            job = self._jobs.get(name)
+            if job is None:
+                return False
+
+            if job.running:
+                if interval is not None:
+                    job.interval = interval
+                if delay is not None:
+                    job.due = self._time() + delay
+                    job.explicitly_rescheduled = True
+                return True
+
+            if delay is not None:
+                job.due = self._time() + delay
+            elif interval is not None and job.interval is not None:
+                # Keep the phase: the job now runs `interval` seconds after it last was (or would have been) due.
+                job.due = max(self._time(), job.due - job.interval + interval)
+
+            if interval is not None:
+                job.interval = interval
+
+            self._push(job)
+            return True
+
+    def jobs(self):
+        """Returns a snapshot of the job table, ordered by when each job is due."""
+        with self._condition:
+            now = self._time()
+            table = [job.describe(now) for job in self._jobs.values()]
+
+        return sorted(table, key=lambda j: (j['due_in'] is not None, j['due_in'] or 0))
+
+    def has_job(self, name):
+        with self._condition:
+            return name in self._jobs
+
+    def start(self):
+        """Runs the scheduler loop in a background thread."""
+        self._thread = Thread(target=self.run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        """Runs the scheduler loop in the calling thread until `stop` is called."""
+        with self._condition:
+            self._running = True
+
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            self._run_job(job)
+
+    def run_until(self, end, advance_to):
+        """Runs every job due until `end` in the calling thread, without waiting.
+
+        Meant for a virtual clock (the one `time_func` reads): `advance_to` is called to move it to each job's due time,
+        and to `end` once no job is left before it.
+        """
+        while True:
+            with self._condition:
+                job = self._peek()
+                if job is None or job.due > end:
+                    break
+
+                advance_to(max(job.due, self._time()))
+                heapq.heappop(self._heap)
+                job.running = True
+
+            self._run_job(job)
+
+        advance_to(max(end, self._time()))
+
+    def _add(self, name, callback, delay, interval):
+        with self._condition:
+            previous = self._jobs.get(name)
+            if previous is not None:
+                previous.cancelled = True
+
+            job = ScheduledJob(name, callback, self._time() + delay, interval)
+            self._jobs[name] = job
+            self._push(job)
+            return job
+
+    def _push(self, job):
+        job.generation += 1
+        heapq.heappush(self._heap, (job.due, next(self._sequence), job.generation, job))
+        self._condition.notify()
+
+    def _peek(self):
+        # Drops stale heap entries until the next job that should actually run is on top.
+        while self._heap:
+            _, _, generation, job = self._heap[0]
+            if not job.cancelled and generation == job.generation:
+                return job
+
+            heapq.heappop(self._heap)
+
+        return None
+
+    def _next_job(self):
+        with self._condition:
+            while self._running:
+                job = self._peek()
+                if job is None:
+                    self._condition.wait()
+                    continue
+
+                wait_for = job.due - self._time()
+                if wait_for > 0:
+                    self._condition.wait(wait_for)
+                    continue
+
+                heapq.heappop(self._heap)
+                job.running = True
+                return job
+
+            return None
+
+    def _run_job(self, job):
+        started = self._time()
+        job.last_lag = started - job.due
+
+        try:
+            job.callback()
+        except Exception:
+            logger.exception(f'Scheduled job {job.name} failed.')
+            JOB_FAILURES.inc(job.name)
+
+        finished = self._time()
+        JOB_LAG_SECONDS.observe(job.last_lag, job.name)
+        JOB_SECONDS.observe(finished - started, job.name)
+
+        with self._condition:
+            job.running = False
+            job.runs += 1
+            job.last_run = started
+            job.last_duration = finished - started
+
+            if job.cancelled:
+                return
+
+            if job.explicitly_rescheduled:
+                job.explicitly_rescheduled = False
+                self._push(job)
+            elif job.interval is None:
+                del self._jobs[job.name]
+            else:
+                # Fixed-rate timing: the next run is anchored on when this run was due, not on when it finished, so
+                # the schedule doesn't drift. Ticks that were missed entirely are skipped instead of run in a burst.
+                job.due += job.interval
+                if job.due <= finished:
+                    # Intervals are checked when set, but a job that still ended up without one mustn't take the
+                    # scheduler's thread down with it. It's run again right away rather than in a burst.
+                    missed = int((finished - job.due) // job.interval) + 1 if job.interval > 0 else 0
+                    job.due = max(job.due + missed * job.interval, finished)
+                self._push(job)
@@ -0,0 +1,137 @@
+import copy
+
+
+# Key every serialized state carries, so older layouts can be migrated when they're loaded.
+SCHEMA_VERSION_KEY = 'schema_version'
+
+# Stands for a value that isn't known, e.g. the stored value of a field before the state was ever synced.
+MISSING = object()
+
+
+class Field:
+    """A typed field of a schema class, declared in the class body with its default.
+
+    The type is taken from the default unless given. Numbers accept both ints and floats, but never bools. `validate`,
+    if given, is called with every new value and returns the value to store (e.g. clamped) or raises `ValueError`.
+    `merge` resolves conflicting changes made locally and in etcd to the same field, as `merge(base, local, remote)`
+    where `base` is the last value known to be stored (`MISSING` if unknown). It defaults to the state's
+    `default_merge`. Custom setters are declared like a property's, and are expected to go through `_set_field`:
+
+        desired_humidity = Field(50)
+
+        @desired_humidity.setter
+        def desired_humidity(self, value):
+            ...
+    """
+
+    def __init__(self, default, type=None, validate=None, merge=None):
+        self.name = None
+        self.default = default
+        self.validate = validate
+        self.merge = merge
+        self.setter_function = None
+
+        if type is None:
+            if default is None:
+                raise ValueError('Fields defaulting to None need an explicit type.')
+            type = default.__class__
+
+        self.types = type if isinstance(type, tuple) else (type,)
+        if float in self.types or (int in self.types and bool not in self.types):
+            self.types = tuple(set(self.types) | {int, float})
+        self._allows_bool = bool in self.types
+
+    def setter(self, function):
+        self.setter_function = function
+        return self
+
+    def new_default(self):
+        # Defaults are copied, so a list or dict default is never shared between states.
+        return copy.deepcopy(self.default)
+
+    def check(self, value):
+        if not isinstance(value, self.types) or (isinstance(value, bool) and not self._allows_bool):
+            expected = ' or '.join(sorted(t.__name__ for t in self.types))
+            raise TypeError(f'{self.name} must be {expected}, not {value.__class__.__name__}.')
+
+        if self.validate is not None:
+            value = self.validate(value)
+
+        return value
+
+
+def prefer_local(base, local, remote):
+    return local
+
+
+def prefer_remote(base, local, remote):
+    return remote
+
+
+def optional(type):
+    return (type, None.__class__)
+
+
+def clamped(minimum, maximum):
+    return lambda value: max(minimum, min(maximum, value))
+
+
+def one_of(*values):
+    def validate(value):
+        if value not in values:
+            raise ValueError(f'{value!r} is not one of {", ".join(repr(v) for v in values)}.')
+        return value
+
+    return validate
+
+
+def each_one_of(*values):
+    def validate(value):
+        unknown = [v for v in value if v not in values]
+        if unknown:
+            raise ValueError(f'{", ".join(repr(v) for v in unknown)} not one of {", ".join(repr(v) for v in values)}.')
+        return value
+
+    return validate
+
+
+def at_least(minimum):
+    def validate(value):
+        if value < minimum:
+            raise ValueError(f'{value!r} is less than {minimum!r}.')
+        return value
+
+    return validate
+
+
+def greater_than(minimum):
+    def validate(value):
+        if value <= minimum:
+            raise ValueError(f'{value!r} is not greater than {minimum!r}.')
+        return value
+
+    return validate
+
+
+class SchemaMeta(type):
+    """Turns the `Field`s declared in a class body into `__slots__`.
+
+    Reading a field is then a plain slot read, without any Python code involved. Every other attribute also has to be
+    declared in `__slots__`, so a typo fails loudly instead of creating a new attribute.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, '_fields', {}))
+
+        own_fields = {key: value for key, value in namespace.items() if isinstance(value, Field)}
+        for key, field in own_fields.items():
+            field.name = key
+            del namespace[key]
+
+        fields.update(own_fields)
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + tuple(own_fields)
+        namespace['_fields'] = fields
+
+        return super().__new__(mcs, name, bases, namespace)
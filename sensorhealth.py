@@ -0,0 +1,235 @@
+import logging
+import statistics
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+SENSOR_READ_SECONDS = metrics.histogram('cheesecave_sensor_read_seconds', 'Latency of sensor reads.', ['sensor'])
+SENSOR_FAILURES = metrics.counter('cheesecave_sensor_failures', 'Failed sensor reads, by reason.', ['sensor', 'reason'])
+SENSOR_OUTLIERS = metrics.counter('cheesecave_sensor_outliers', 'Sensor readings rejected as outliers.', ['sensor'])
+
+OK = 'ok'
+BACKING_OFF = 'backing off'
+QUARANTINED = 'quarantined'
+
+SensorStatus = namedtuple(
+    'SensorStatus', ['name', 'status', 'consecutive_failures', 'failures', 'reads', 'outliers', 'last_error'])
+
+# Scales the median absolute deviation into an estimate of the standard deviation for normally distributed readings.
+MAD_SCALE = 1.4826
+# Deviations below these are never treated as outliers, so a very steady sensor (MAD close to 0) doesn't reject noise.
+MIN_TEMPERATURE_DEVIATION = 1.0
+MIN_HUMIDITY_DEVIATION = 5.0
+# How many accepted readings of each sensor are kept to spot outliers over time.
+SENSOR_HISTORY_SIZE = 9
+# Readings are only checked against a sensor's own history once it has this many.
+MIN_SENSOR_HISTORY = 5
+# After this many readings in a row are rejected against a sensor's history, they're taken as a real change instead.
+MAX_CONSECUTIVE_OUTLIERS = 3
+
+
+def _is_outlier(value, values, threshold, min_deviation):
+    median = statistics.median(values)
+    mad = statistics.median(abs(v - median) for v in values)
+
+    return abs(value - median) > max(threshold * MAD_SCALE * mad, min_deviation)
+
+
+class SensorHealth:
+    def __init__(self, name, retry_base_seconds, retry_max_seconds, quarantine_failures):
+        self.name = name
+        self.configure(retry_base_seconds, retry_max_seconds, quarantine_failures)
+
+        self.status = OK
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.reads = 0
+        self.outliers = 0
+        self.last_error = None
+        self.next_attempt = 0
+
+        self.history = deque(maxlen=SENSOR_HISTORY_SIZE)
+        self.consecutive_outliers = 0
+
+    def configure(self, retry_base_seconds, retry_max_seconds, quarantine_failures):
+        # Applies from the next failure on.
+        self._retry_base_seconds = retry_base_seconds
+        self._retry_max_seconds = retry_max_seconds
+        self._quarantine_failures = quarantine_failures
+
+    def can_read(self, now):
+        return now >= self.next_attempt
+
+    def record_success(self):
+        if self.status != OK:
+            logger.info(f'Sensor {self.name} is reading again.')
+
+        self.reads += 1
+        self.status = OK
+        self.consecutive_failures = 0
+        self.next_attempt = 0
+
+    def record_failure(self, now, error):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = str(error) or type(error).__name__
+
+        # Quarantined sensors are only probed every `retry_max_seconds`.
+        delay = min(self._retry_base_seconds * 2 ** (self.consecutive_failures - 1), self._retry_max_seconds)
+        self.next_attempt = now + delay
+
+        if self.consecutive_failures >= self._quarantine_failures:
+            if self.status != QUARANTINED:
+                logger.warning(f'Sensor {self.name} failed {self.consecutive_failures} times in a row. Quarantining it.')
+            self.status = QUARANTINED
+        else:
+            self.status = BACKING_OFF
+            logger.warning(f'Sensor {self.name} failed to read ({self.last_error}). Retrying in {delay}s.')
+
+    def snapshot(self):
+        return SensorStatus(self.name, self.status, self.consecutive_failures, self.failures, self.reads, self.outliers,
+            self.last_error)
+
+
+class SensorMonitor:
+    """Reads a `SensorArray` while keeping track of each sensor's health.
+
+    Every read is bounded by a timeout. Sensors that fail are retried with exponential backoff and quarantined when
+    they keep failing, so a bad sensor can't stall or break the measurements of the others. Readings that are outliers
+    compared to the other sensors, or to the sensor's own recent readings, are rejected using the median absolute
+    deviation.
+    """
+
+    def __init__(self, sensor_array, read_timeout_seconds=0.5, retry_base_seconds=5, retry_max_seconds=300,
+            quarantine_failures=5, outlier_threshold=3.5, time_func=time.monotonic):
+        self._sensor_array = sensor_array
+        self._time = time_func
+        self._health = []
+        self.reconfigure(read_timeout_seconds, retry_base_seconds, retry_max_seconds, quarantine_failures,
+            outlier_threshold)
+        self._executor = self._new_executor()
+
+    def reconfigure(self, read_timeout_seconds=0.5, retry_base_seconds=5, retry_max_seconds=300, quarantine_failures=5,
+            outlier_threshold=3.5):
+        """Applies new settings, and follows the sensors added to or removed from the array since. Sensors that were
+        already there keep their health and history."""
+        self._read_timeout_seconds = read_timeout_seconds
+        self._outlier_threshold = outlier_threshold
+
+        previous = {health.name: health for health in self._health}
+        self._health = []
+        for spec in self._sensor_array.specs:
+            name = f'{spec.address:#x}' if spec.mux_address is None else \
+                f'{spec.mux_address:#x}/{spec.mux_channel}/{spec.address:#x}'
+            health = previous.get(name) or SensorHealth(name, retry_base_seconds, retry_max_seconds, quarantine_failures)
+            health.configure(retry_base_seconds, retry_max_seconds, quarantine_failures)
+            self._health.append(health)
+
+    def _new_executor(self):
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix='sensor-read')
+
+    def _call(self, function, *args):
+        # Without a timeout (like in the simulation, where sensors can't hang), there's no need for the thread.
+        if not self._read_timeout_seconds:
+            return function(*args)
+
+        return self._executor.submit(function, *args).result(timeout=self._read_timeout_seconds)
+
+    def health(self):
+        return [health.snapshot() for health in self._health]
+
+    def read(self):
+        """Returns the accepted readings of this round."""
+        now = self._time()
+        readings = []
+
+        for sensor, health in zip(self._sensor_array.sensors, self._health):
+            if not health.can_read(now):
+                continue
+
+            try:
+                with SENSOR_READ_SECONDS.time(health.name):
+                    reading = self._call(sensor.read)
+            except TimeoutError as e:
+                # The hung read keeps its thread busy, so later reads get a fresh one.
+                self._executor.shutdown(wait=False)
+                self._executor = self._new_executor()
+                health.record_failure(now, e)
+                SENSOR_FAILURES.inc(health.name, 'timeout')
+                continue
+            except Exception as e:
+                health.record_failure(now, e)
+                SENSOR_FAILURES.inc(health.name, type(e).__name__)
+                continue
+
+            if reading is None:
+                # Read again before its next conversion. Nothing new from this sensor this round.
+                continue
+
+            health.record_success()
+            if not self._accept_over_time(health, reading):
+                continue
+
+            readings.append((health, reading))
+
+        return [reading for (_, reading) in self._reject_across_sensors(readings)]
+
+    def set_heater(self, value):
+        # Goes through the same thread as reads, so switching the heater never interleaves with a read of the sensor.
+        for sensor, health in zip(self._sensor_array.sensors, self._health):
+            if health.status == QUARANTINED:
+                continue
+
+            try:
+                self._call(setattr, sensor, 'heater', value)
+            except Exception:
+                logger.warning(f'Failed to switch the heater of sensor {health.name}.', exc_info=True)
+
+    def _accept_over_time(self, health, reading):
+        if len(health.history) >= MIN_SENSOR_HISTORY:
+            temperatures = [r.temperature for r in health.history]
+            humidities = [r.humidity for r in health.history]
+
+            is_outlier = _is_outlier(reading.temperature, temperatures, self._outlier_threshold,
+                MIN_TEMPERATURE_DEVIATION) or _is_outlier(reading.humidity, humidities, self._outlier_threshold,
+                MIN_HUMIDITY_DEVIATION)
+
+            if is_outlier:
+                health.consecutive_outliers += 1
+                if health.consecutive_outliers <= MAX_CONSECUTIVE_OUTLIERS:
+                    health.outliers += 1
+                    SENSOR_OUTLIERS.inc(health.name)
+                    return False
+
+                # Readings consistently disagree with the history, so conditions actually changed.
+                logger.info(f'Sensor {health.name} readings shifted. Starting its history over.')
+                health.history.clear()
+
+        health.consecutive_outliers = 0
+        health.history.append(reading)
+        return True
+
+    def _reject_across_sensors(self, readings):
+        # With less than 3 sensors there's no majority to tell which one is off.
+        if len(readings) < 3:
+            return readings
+
+        temperatures = [r.temperature for (_, r) in readings]
+        humidities = [r.humidity for (_, r) in readings]
+
+        accepted = []
+        for health, reading in readings:
+            if _is_outlier(reading.temperature, temperatures, self._outlier_threshold, MIN_TEMPERATURE_DEVIATION) or \
+                    _is_outlier(reading.humidity, humidities, self._outlier_threshold, MIN_HUMIDITY_DEVIATION):
+                health.outliers += 1
+                SENSOR_OUTLIERS.inc(health.name)
+                logger.debug(f'Rejected outlier reading {reading} from sensor {health.name}.')
+                continue
+
+            accepted.append((health, reading))
+
+        return accepted
@@ -0,0 +1,238 @@
+import logging
+import struct
+import time
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+# SHT31-D commands, from Sensirion's datasheet. Every periodic command uses high repeatability.
+PERIODIC_COMMANDS = {
+    0.5: 0x2032,
+    1: 0x2130,
+    2: 0x2236,
+    4: 0x2334,
+    10: 0x2737,
+}
+ART_COMMAND = 0x2B32
+FETCH_DATA_COMMAND = 0xE000
+BREAK_COMMAND = 0x3093
+SOFT_RESET_COMMAND = 0x30A2
+HEATER_ON_COMMAND = 0x306D
+HEATER_OFF_COMMAND = 0x3066
+
+# How long the sensor needs after a command before it accepts the next one.
+COMMAND_DELAY_SECONDS = 0.002
+SOFT_RESET_DELAY_SECONDS = 0.002
+# How long a conversion takes at high repeatability (15.5ms at most). Until the first one is done after starting, the
+# sensor has no data and NACKs fetches.
+MEASUREMENT_DURATION_SECONDS = 0.016
+# Measurements per second in ART mode.
+ART_FREQUENCY = 4
+
+# Addresses a SHT31-D can be strapped to. Without a multiplexer, this is as many sensors as a single bus can have.
+SHT31D_ADDRESSES = [0x44, 0x45]
+
+# Channels of a TCA9548A multiplexer.
+MUX_CHANNELS = 8
+
+SensorSpec = namedtuple('SensorSpec', ['address', 'mux_address', 'mux_channel'])
+SensorSpec.__new__.__defaults__ = (None, None)
+
+Reading = namedtuple('Reading', ['temperature', 'humidity'])
+
+
+def _crc8(data):
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+
+    return crc
+
+
+def validate_sensor_list(sensor_list):
+    """Checks `sensor_list` entries against `SensorSpec`, so a typo in a stored config is ignored instead of breaking
+    the sensors' setup."""
+    for spec in sensor_list:
+        if not isinstance(spec, dict):
+            raise ValueError(f'Sensor {spec!r} is not an object.')
+
+        unknown_keys = set(spec) - set(SensorSpec._fields)
+        if unknown_keys:
+            raise ValueError(f'Sensor {spec!r} has unknown keys {", ".join(sorted(unknown_keys))}.')
+        if 'address' not in spec:
+            raise ValueError(f'Sensor {spec!r} has no address.')
+        if ('mux_address' in spec) != ('mux_channel' in spec):
+            raise ValueError(f'Sensor {spec!r} needs both a mux_address and a mux_channel, or neither.')
+
+        for key, value in spec.items():
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError(f'Sensor {spec!r} has a {key} that is not an integer.')
+        if not 0 <= spec.get('mux_channel', 0) < MUX_CHANNELS:
+            raise ValueError(f'Sensor {spec!r} has a mux_channel outside of 0-{MUX_CHANNELS - 1}.')
+
+    return sensor_list
+
+
+def sensor_specs_from_configs(configs):
+    """Returns the sensors configured in `sensor_list`, falling back to the older `sensors` count."""
+    if configs.sensor_list:
+        return [SensorSpec(**spec) for spec in configs.sensor_list]
+
+    if configs.sensors > len(SHT31D_ADDRESSES):
+        logger.warning(f'Controller is configured with {configs.sensors} sensors, but only {len(SHT31D_ADDRESSES)} '
+            'fit on the bus without a multiplexer. Use `sensor_list` to configure more.')
+
+    return [SensorSpec(address) for address in SHT31D_ADDRESSES[:configs.sensors]]
+
+
+class SHT31D:
+    """SHT31-D driver that keeps the sensor in periodic (or ART) mode.
+
+    In periodic mode the sensor converts on its own, so reading it never waits on a conversion: it's a single fetch
+    that returns both temperature and humidity. Fetching again before the next conversion is done gets a NACK, since
+    every conversion can only be fetched once. That's no new data rather than a failure, and `read` returns None.
+    """
+
+    def __init__(self, i2c, address, frequency=1, art=False, sleep_func=time.sleep, time_func=time.monotonic):
+        if not art and frequency not in PERIODIC_COMMANDS:
+            raise ValueError(f'SHT31-D periodic frequency must be one of {sorted(PERIODIC_COMMANDS)}.')
+
+        self._i2c = i2c
+        self._sleep = sleep_func
+        self._time = time_func
+        self.address = address
+        self._start_command = ART_COMMAND if art else PERIODIC_COMMANDS[frequency]
+        self._period = 1 / (ART_FREQUENCY if art else frequency)
+        self._heater = False
+        # The sensor is only started on first use, so one that's missing or broken doesn't prevent the others from starting.
+        self._started = False
+        # When data was last fetched, or measurements (re)started. Until the next conversion is due after it, a NACK
+        # only means there's no new data yet.
+        self._last_data = None
+
+    def _start(self):
+        self._command(SOFT_RESET_COMMAND)
+        self._sleep(SOFT_RESET_DELAY_SECONDS)
+        self._start_measuring()
+        self._started = True
+
+    def _start_measuring(self):
+        self._command(self._start_command)
+        # Waits for the first conversion, so the next fetch has data.
+        self._sleep(MEASUREMENT_DURATION_SECONDS)
+        self._last_data = self._time()
+
+    def _command(self, command, read_length=0):
+        while not self._i2c.try_lock():
+            pass
+
+        try:
+            self._i2c.writeto(self.address, struct.pack('>H', command))
+            if read_length == 0:
+                return None
+
+            data = bytearray(read_length)
+            self._i2c.readfrom_into(self.address, data)
+            return data
+        finally:
+            self._i2c.unlock()
+
+    def read(self):
+        if not self._started:
+            self._start()
+
+        try:
+            data = self._command(FETCH_DATA_COMMAND, read_length=6)
+        except OSError:
+            # Read again before the next conversion was due, the sensor just has nothing new. Past that, it may have been
+            # reset or power cycled, in which case it's no longer measuring periodically.
+            if self._time() - self._last_data < self._period + MEASUREMENT_DURATION_SECONDS:
+                return None
+
+            self._started = False
+            raise
+
+        self._last_data = self._time()
+
+        if _crc8(data[0:2]) != data[2] or _crc8(data[3:5]) != data[5]:
+            raise OSError(f'CRC mismatch reading SHT31-D at {self.address:#x}.')
+
+        (raw_temperature,) = struct.unpack_from('>H', data, 0)
+        (raw_humidity,) = struct.unpack_from('>H', data, 3)
+
+        return Reading(-45 + 175 * raw_temperature / 65535, 100 * raw_humidity / 65535)
+
+    @property
+    def heater(self):
+        return self._heater
+
+    @heater.setter
+    def heater(self, value):
+        if not self._started:
+            self._start()
+
+        # The heater can't be switched while measuring periodically, so measurements are paused around it.
+        self._command(BREAK_COMMAND)
+        self._sleep(COMMAND_DELAY_SECONDS)
+        self._command(HEATER_ON_COMMAND if value else HEATER_OFF_COMMAND)
+        self._sleep(COMMAND_DELAY_SECONDS)
+        self._start_measuring()
+        self._heater = value
+
+
+class SensorArray:
+    """Every SHT31-D of the controller, either directly on the bus or behind TCA9548A multiplexers.
+
+    All sensors convert in parallel on their own in periodic mode, so a read of the whole array is just one short fetch
+    per sensor on the bus.
+    """
+
+    def __init__(self, i2c, specs, frequency=1, art=False, sleep_func=time.sleep, time_func=time.monotonic):
+        self._i2c = i2c
+        self._frequency = frequency
+        self._art = art
+        self._sleep = sleep_func
+        self._time = time_func
+        self._multiplexers = {}
+        self.specs = list(specs)
+        self.sensors = [self._new_sensor(spec) for spec in self.specs]
+
+    def _new_sensor(self, spec):
+        return SHT31D(self._bus_for(self._i2c, spec), spec.address, frequency=self._frequency, art=self._art,
+            sleep_func=self._sleep, time_func=self._time)
+
+    def reconfigure(self, specs, frequency=1, art=False):
+        """Switches to `specs`, keeping the drivers of the sensors that were already there. Returns the specs of the
+        sensors added and removed."""
+        specs = list(specs)
+        previous = dict(zip(self.specs, self.sensors))
+
+        if (frequency, art) != (self._frequency, self._art):
+            # A sensor is only told its mode when it starts, so every sensor has to start over.
+            self._frequency = frequency
+            self._art = art
+            previous = {}
+
+        self.sensors = [previous[spec] if spec in previous else self._new_sensor(spec) for spec in specs]
+        added = [spec for spec in specs if spec not in self.specs]
+        removed = [spec for spec in self.specs if spec not in specs]
+        self.specs = specs
+
+        return (added, removed)
+
+    def _bus_for(self, i2c, spec):
+        if spec.mux_address is None:
+            return i2c
+
+        if spec.mux_address not in self._multiplexers:
+            # Only needed with multiplexed sensors, so it's imported lazily.
+            import adafruit_tca9548a
+            self._multiplexers[spec.mux_address] = adafruit_tca9548a.TCA9548A(i2c, address=spec.mux_address)
+
+        return self._multiplexers[spec.mux_address][spec.mux_channel]
+
+    def __len__(self):
+        return len(self.sensors)
@@ -0,0 +1,690 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import resource
+import struct
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from PIL import Image
+
+from displayworker import DISPLAY_QUEUE_SECONDS, DISPLAY_REQUESTS
+from etcdconnection import DOCUMENT_LAYOUT, FIELDS_LAYOUT
+from main import CheeseCaveController
+from state import CheeseCaveControllerMode
+from sensors import (
+    ART_COMMAND, ART_FREQUENCY, BREAK_COMMAND, FETCH_DATA_COMMAND, HEATER_OFF_COMMAND, HEATER_ON_COMMAND,
+    PERIODIC_COMMANDS, SHT31D_ADDRESSES, SOFT_RESET_COMMAND, _crc8)
+
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 24 * 60 * 60
+# Simulations start at a fixed time, so two runs with the same seed give the same results.
+DEFAULT_START_TIME = 1767225600  # 2026-01-01 00:00 UTC
+
+# Two presses this close to each other turn the simulated humidifier on. A single press turns it off.
+HUMIDIFIER_DOUBLE_PRESS_SECONDS = 0.5
+
+# How long the simulation runs the scheduler before checking how far it got.
+RUN_CHUNK_SECONDS = 60 * 60
+# How often the cave's actual humidity is compared with the desired one.
+SAMPLE_SECONDS = 60
+
+# Buttons, as wired on the Pi.
+TOP_BUTTON = 6
+BOTTOM_BUTTON = 5
+
+
+def _saturation_vapour_pressure(temperature):
+    # Magnus formula, in hPa.
+    return 6.112 * math.exp(17.62 * temperature / (243.12 + temperature))
+
+
+class VirtualClock:
+    """A clock that only moves when told to, with the `time()`, `monotonic()` and `sleep()` of the `time` module."""
+
+    def __init__(self, start_time=DEFAULT_START_TIME):
+        self._start_time = start_time
+        self._monotonic = 0.0
+
+    def time(self):
+        return self._start_time + self._monotonic
+
+    def monotonic(self):
+        return self._monotonic
+
+    def sleep(self, seconds):
+        # Whoever sleeps doesn't hold anything else up, but the time still passes.
+        self._monotonic += seconds
+
+    def advance_to(self, monotonic):
+        if monotonic > self._monotonic:
+            self._monotonic = monotonic
+
+
+class CavePlant:
+    """Thermal and humidity model of the cave and its humidifier.
+
+    The cave's temperature follows the room's, which swings over the day. Its humidity leaks towards the room's, and
+    the humidifier adds a fixed amount of humidity per second for as long as it runs and has water. The model is
+    integrated lazily up to the clock's time whenever it's looked at.
+    """
+
+    def __init__(self, clock, room_temperature=12.0, room_temperature_swing=1.5, temperature_time_constant=4 * 60 * 60,
+            room_humidity=40.0, humidity_time_constant=6 * 60 * 60, humidifier_rate=0.012,
+            water_capacity_seconds=4 * 60 * 60, initial_humidity=None):
+        self._clock = clock
+        self.room_temperature = room_temperature
+        self.room_temperature_swing = room_temperature_swing
+        self.temperature_time_constant = temperature_time_constant
+        self.room_humidity = room_humidity
+        self.humidity_time_constant = humidity_time_constant
+        # In % RH per second.
+        self.humidifier_rate = humidifier_rate
+        self.water_capacity_seconds = water_capacity_seconds
+
+        self.temperature = room_temperature
+        self.humidity = room_humidity if initial_humidity is None else initial_humidity
+        self.humidifier_on = False
+        self.water_seconds = water_capacity_seconds
+        self.humidifier_run_seconds = 0.0
+        self._time = clock.monotonic()
+
+    def room_temperature_at(self, monotonic):
+        phase = 2 * math.pi * (self._clock.time() - self._clock.monotonic() + monotonic) / DAY_SECONDS
+        return self.room_temperature + self.room_temperature_swing * math.sin(phase)
+
+    def advance(self):
+        now = self._clock.monotonic()
+
+        # Short enough steps that the room's daily swing is followed closely.
+        while self._time < now:
+            step = min(now - self._time, 60.0)
+            self._step(step)
+            self._time += step
+
+    def _step(self, dt):
+        room_temperature = self.room_temperature_at(self._time + dt / 2)
+        self.temperature = room_temperature + (self.temperature - room_temperature) * \
+            math.exp(-dt / self.temperature_time_constant)
+
+        running = self.humidifier_on and self.water_seconds > 0
+        if running:
+            # The humidifier can run dry partway through the step.
+            run = min(dt, self.water_seconds)
+            self.water_seconds -= run
+            self.humidifier_run_seconds += run
+            added = self.humidifier_rate * run
+        else:
+            added = 0.0
+
+        # Exact solution of the leak towards the room's humidity, with the humidifier's output spread over the step.
+        decay = math.exp(-dt / self.humidity_time_constant)
+        equilibrium = self.room_humidity + added / dt * self.humidity_time_constant
+        self.humidity = max(0.0, min(100.0, equilibrium + (self.humidity - equilibrium) * decay))
+
+    def switch_humidifier(self, value):
+        self.advance()
+        self.humidifier_on = value
+
+    def refill(self):
+        self.advance()
+        self.water_seconds = self.water_capacity_seconds
+
+
+class FakeHumidifierPin:
+    """The humidifier's control pin. Presses on it switch the plant's humidifier like presses on its button would."""
+
+    def __init__(self, plant, clock):
+        self._plant = plant
+        self._clock = clock
+        self._value = False
+        self._last_press = None
+        self.presses = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        pressed = value and not self._value
+        self._value = value
+        if not pressed:
+            return
+
+        self.presses += 1
+        now = self._clock.monotonic()
+
+        if self._plant.humidifier_on:
+            self._plant.switch_humidifier(False)
+        elif self._last_press is not None and now - self._last_press <= HUMIDIFIER_DOUBLE_PRESS_SECONDS:
+            self._plant.switch_humidifier(True)
+            self._last_press = None
+            return
+
+        self._last_press = now
+
+
+# Measurements per second of every periodic mode, by the command starting it.
+PERIODIC_FREQUENCIES = {**{command: frequency for frequency, command in PERIODIC_COMMANDS.items()},
+    ART_COMMAND: ART_FREQUENCY}
+
+
+class FakeSHT31D:
+    """A SHT31-D in periodic mode, reading the plant with some noise.
+
+    With a clock, conversions take time like on a real sensor: fetches get a NACK (an `OSError`) until measurements were
+    started and converted once, and then until the next conversion after every fetch. Without one, there's always data.
+    """
+
+    def __init__(self, plant, rng, temperature_noise=0.1, humidity_noise=0.8, temperature_offset=0.0,
+            humidity_offset=0.0, failure_rate=0.0, heater_temperature_rise=3.0, clock=None, conversion_seconds=0.0155):
+        self._plant = plant
+        self._rng = rng
+        self._clock = clock
+        self.conversion_seconds = conversion_seconds
+        self.temperature_noise = temperature_noise
+        self.humidity_noise = humidity_noise
+        self.temperature_offset = temperature_offset
+        self.humidity_offset = humidity_offset
+        self.failure_rate = failure_rate
+        self.heater_temperature_rise = heater_temperature_rise
+        self.heater = False
+        self._fetching = False
+        # When periodic measurements started and at what frequency (None when not measuring), and which conversion was
+        # fetched last.
+        self._measuring_since = None
+        self._frequency = None
+        self._fetched_conversion = -1
+
+    def command(self, command):
+        if self._rng.random() < self.failure_rate:
+            raise OSError('Simulated I2C failure.')
+
+        self._fetching = command == FETCH_DATA_COMMAND
+        if command == HEATER_ON_COMMAND:
+            self.heater = True
+        elif command in (HEATER_OFF_COMMAND, SOFT_RESET_COMMAND):
+            self.heater = False
+
+        if command in PERIODIC_FREQUENCIES and self._clock is not None:
+            self._measuring_since = self._clock.monotonic()
+            self._frequency = PERIODIC_FREQUENCIES[command]
+            self._fetched_conversion = -1
+        elif command in (BREAK_COMMAND, SOFT_RESET_COMMAND):
+            self._measuring_since = None
+
+    def _latest_conversion(self):
+        # Index of the last conversion done since measurements started, -1 if none is done yet.
+        elapsed = self._clock.monotonic() - self._measuring_since - self.conversion_seconds
+        return math.floor(elapsed * self._frequency) if elapsed >= 0 else -1
+
+    def read_into(self, buffer):
+        if not self._fetching:
+            raise OSError('Simulated SHT31-D has no data to fetch.')
+
+        if self._clock is not None:
+            if self._measuring_since is None or self._latest_conversion() <= self._fetched_conversion:
+                self._fetching = False
+                raise OSError('Simulated SHT31-D NACKed the fetch: no new data.')
+
+            self._fetched_conversion = self._latest_conversion()
+
+        self._plant.advance()
+        temperature = self._plant.temperature
+        humidity = self._plant.humidity
+
+        if self.heater:
+            # The heater warms the sensor up, so it sees the same air with a lower relative humidity.
+            heated_temperature = temperature + self.heater_temperature_rise
+            humidity *= _saturation_vapour_pressure(temperature) / _saturation_vapour_pressure(heated_temperature)
+            temperature = heated_temperature
+
+        temperature += self.temperature_offset + self._rng.gauss(0, self.temperature_noise)
+        humidity += self.humidity_offset + self._rng.gauss(0, self.humidity_noise)
+
+        raw_temperature = max(0, min(65535, round((temperature + 45) * 65535 / 175)))
+        raw_humidity = max(0, min(65535, round(humidity * 65535 / 100)))
+        temperature_bytes = struct.pack('>H', raw_temperature)
+        humidity_bytes = struct.pack('>H', raw_humidity)
+
+        buffer[0:6] = temperature_bytes + bytes([_crc8(temperature_bytes)]) + humidity_bytes + \
+            bytes([_crc8(humidity_bytes)])
+        self._fetching = False
+
+
+class FakeI2C:
+    """An I2C bus with the same API as busio's, with `FakeSHT31D` devices on it."""
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise OSError(f'No simulated device at {address:#x}.')
+
+        return device
+
+    def writeto(self, address, buffer):
+        (command,) = struct.unpack('>H', bytes(buffer))
+        self._device(address).command(command)
+
+    def readfrom_into(self, address, buffer):
+        self._device(address).read_into(buffer)
+
+
+class FakeSSD1680:
+    """Stands in for the e-ink panel, keeping the frames it's given."""
+
+    def __init__(self, clock, width=122, height=250, frames_kept=100):
+        self._clock = clock
+        self._native_size = (width, height)
+        self.rotation = 1
+        # Buffer layout of the real driver, so frames go through the same path as on the Pi.
+        self._blackframebuf = SimpleNamespace(buf=bytearray((width + 7) // 8 * height))
+        self._colorframebuf = None
+        self._black_inverted = True
+        self._color_inverted = False
+
+        self.refreshes = 0
+        self.frames = deque(maxlen=frames_kept)
+
+    @property
+    def width(self):
+        return self._native_size[1] if self.rotation in (1, 3) else self._native_size[0]
+
+    @property
+    def height(self):
+        return self._native_size[0] if self.rotation in (1, 3) else self._native_size[1]
+
+    def image(self, image):
+        native_image = image.convert('1').transpose(Image.Transpose.ROTATE_270)
+        self._blackframebuf.buf[:] = native_image.tobytes()
+
+    def display(self):
+        self.refreshes += 1
+        self.frames.append((self._clock.time(), bytes(self._blackframebuf.buf)))
+
+    def frame_image(self, frame):
+        """Returns a kept frame as the image the panel shows."""
+        (_, buffer) = frame
+        return Image.frombytes('1', self._native_size, buffer).transpose(Image.Transpose.ROTATE_90)
+
+
+class SimulatedHardware:
+    def __init__(self, plant, clock, sensor_count=2, seed=0, sensor_failure_rate=0.0):
+        self._rng = random.Random(seed)
+        self.i2c = FakeI2C({
+            address: FakeSHT31D(plant, self._rng, failure_rate=sensor_failure_rate, clock=clock)
+            for address in SHT31D_ADDRESSES[:sensor_count]
+        })
+        self.display = FakeSSD1680(clock)
+        self.humidifier = FakeHumidifierPin(plant, clock)
+        self._button_callback = None
+
+    def humidifier_pin(self):
+        return self.humidifier
+
+    def setup_buttons(self, callback):
+        self._button_callback = callback
+
+    def press_button(self, channel):
+        if self._button_callback is not None:
+            self._button_callback(channel)
+
+
+class InProcessEtcd:
+    """Stands in for `EtcdConnection`, keeping every state in memory (in either layout) and syncing it right away.
+
+    Writes are checked against the revision they were based on like etcd transactions are, and `put` plays another
+    client, so conflicting writes go through the same merges as with a real etcd.
+    """
+
+    def __init__(self, stored_states=None, layout=DOCUMENT_LAYOUT):
+        self._layout = layout
+        # Every key, with its value and the revision it was last written at.
+        self._stored = {}
+        self._revision = 0
+        self._states = {}
+        self.puts = 0
+        self.conflicts = 0
+
+        for path, state in (stored_states or {}).items():
+            if layout == FIELDS_LAYOUT:
+                self._write({f'{path}/{name}': json.dumps(value) for name, value in state.items()})
+            else:
+                self._write({path: json.dumps(state)})
+
+    def _write(self, values):
+        self._revision += 1
+        for key, value in values.items():
+            self._stored[key] = (value, self._revision)
+
+        return self._revision
+
+    def _transaction(self, revisions, values):
+        if any(self._stored.get(key, (None, 0))[1] != revision for key, revision in revisions.items()):
+            self.conflicts += 1
+            return None
+
+        self.puts += len(values)
+        return self._write(values)
+
+    def _reconcile(self, state):
+        if self._layout == FIELDS_LAYOUT:
+            prefix = state.etcd_path + '/'
+            state.reconcile_fields(
+                {key[len(prefix):]: stored for key, stored in self._stored.items() if key.startswith(prefix)})
+        else:
+            (value, revision) = self._stored.get(state.etcd_path, (None, 0))
+            state.reconcile(value, revision)
+
+    def register(self, state):
+        self._states[state.etcd_path] = state
+        self._reconcile(state)
+        self.notify_pending()
+
+    def notify_pending(self):
+        for path, state in self._states.items():
+            while state.has_pending_writes():
+                if self._layout == FIELDS_LAYOUT:
+                    pending = state.pending_fields()
+                    revision = self._transaction({f'{path}/{name}': revision for name, (_, revision) in pending.items()},
+                        {f'{path}/{name}': value for name, (value, _) in pending.items()})
+                    if revision is not None:
+                        state.fields_synced({name: value for name, (value, _) in pending.items()}, revision)
+                else:
+                    (state_serialized, revision) = state.pending_write()
+                    revision = self._transaction({path: revision}, {path: state_serialized})
+                    if revision is not None:
+                        state.write_synced(state_serialized, revision)
+
+                if revision is None:
+                    self._reconcile(state)
+
+    def put(self, path, value):
+        """Changes a stored state like another client would, without going through the state. In the per-field layout,
+        `value` only has the fields that changed."""
+        state = self._states.get(path)
+
+        if self._layout == FIELDS_LAYOUT:
+            fields_serialized = {name: json.dumps(field_value) for name, field_value in value.items()}
+            revision = self._write({f'{path}/{name}': field for name, field in fields_serialized.items()})
+            if state is not None:
+                state.apply_stored_fields({name: (field, revision) for name, field in fields_serialized.items()})
+        else:
+            revision = self._write({path: json.dumps(value)})
+            if state is not None:
+                state.apply_stored_state(self._stored[path][0], revision)
+
+        self.notify_pending()
+
+
+class InlineDisplayWorker:
+    """Updates the display from the scheduler, with the same latest-wins requests as `DisplayWorker`."""
+
+    def __init__(self, display_controller, scheduler):
+        self._display_controller = display_controller
+        self._scheduler = scheduler
+        self._force = False
+        # Scheduler time the waiting request is due at, to measure its queueing on the virtual clock.
+        self._due = None
+
+    def start(self):
+        pass
+
+    def request(self, delay=0, force=False):
+        DISPLAY_REQUESTS.inc('coalesced' if self._scheduler.has_job('display_worker') else 'queued')
+        self._force = self._force or force
+        self._due = self._scheduler.time() + delay
+        self._scheduler.after('display_worker', delay, self._update)
+
+    def _update(self):
+        force = self._force
+        self._force = False
+        DISPLAY_QUEUE_SECONDS.observe(self._scheduler.time() - self._due)
+        self._display_controller.update_display(force=force)
+
+
+class ScheduledPulseSequencer:
+    """Plays edge sequences like `PulseSequencer`, from scheduler jobs instead of a thread."""
+
+    def __init__(self, pin, scheduler):
+        self._pin = pin
+        self._scheduler = scheduler
+        self._queue = deque()
+        self._playing = None
+
+        self.sequences_played = 0
+        self.sequences_failed = 0
+
+    def submit(self, edges, name=None):
+        future = Future()
+        self._queue.append((deque(edges), name, future))
+        if self._playing is None:
+            self._play_next()
+
+        return future
+
+    def pending(self):
+        return len(self._queue)
+
+    def _play_next(self):
+        while self._queue:
+            self._playing = self._queue.popleft()
+            if self._playing[2].set_running_or_notify_cancel():
+                self._next_edge()
+                return
+
+        self._playing = None
+
+    def _next_edge(self):
+        (edges, name, future) = self._playing
+        if not edges:
+            self.sequences_played += 1
+            future.set_result(name)
+            self._play_next()
+            return
+
+        (value, hold_seconds) = edges.popleft()
+        self._pin.value = value
+        self._scheduler.after('pulse_edge', hold_seconds, self._next_edge)
+
+
+class SimulatedController(CheeseCaveController):
+    def run_startup_steps(self, steps):
+        # One step after the other, like everything else in the simulation, so runs stay reproducible.
+        for name, step in steps.items():
+            self._timed_startup_step(name, step)
+
+    def make_display_worker(self):
+        return InlineDisplayWorker(self.display_controller, self.scheduler)
+
+    def make_pulse_sequencer(self, pin):
+        return ScheduledPulseSequencer(pin, self.scheduler)
+
+
+class Simulation:
+    """Runs the whole controller against `CavePlant`, on a virtual clock.
+
+    Every thread of the controller is replaced by jobs of its scheduler, which the simulation runs back to back while
+    moving the clock forward, so days of control take seconds.
+    """
+
+    def __init__(self, configs=None, state=None, sensor_count=2, seed=0, refill_every_seconds=DAY_SECONDS,
+            plant_options=None, sensor_failure_rate=0.0, directory=None, etcd_layout=DOCUMENT_LAYOUT):
+        self._temporary_directory = None
+        if directory is None:
+            self._temporary_directory = tempfile.TemporaryDirectory(prefix='cheesecave-simulation-')
+            directory = self._temporary_directory.name
+
+        self.clock = VirtualClock()
+        self.plant = CavePlant(self.clock, **(plant_options or {}))
+        self.hardware = SimulatedHardware(self.plant, self.clock, sensor_count, seed, sensor_failure_rate)
+
+        stored_configs = {
+            'sensors': sensor_count,
+            'humidifier_connected': True,
+            # Simulated sensors never hang, and reading them from the monitor's thread would cost more than the read.
+            'sensor_read_timeout_seconds': 0,
+            'history_directory': os.path.join(directory, 'history'),
+            **(configs or {}),
+        }
+        self.etcd = InProcessEtcd(
+            {'/cheesecave/config': stored_configs, '/cheesecave/state': state or {}}, layout=etcd_layout)
+
+        self.controller = SimulatedController(
+            hardware=self.hardware,
+            connection=self.etcd,
+            clock=self.clock,
+            snapshot_directory=os.path.join(directory, 'state'),
+            cache_directory=os.path.join(directory, 'cache'),
+        )
+
+        self._refill_every_seconds = refill_every_seconds
+        self._samples = 0
+        self._absolute_error_sum = 0.0
+        self._samples_in_band = 0
+        self._minimum_humidity = math.inf
+        self._maximum_humidity = -math.inf
+        self.refills = 0
+
+    def run(self, seconds):
+        """Runs `seconds` of simulated time and returns a summary of how the cave was controlled and what it cost."""
+        scheduler = self.controller.scheduler
+        if not scheduler.has_job('measure'):
+            self.controller.start()
+            scheduler.every('simulation_sample', SAMPLE_SECONDS, self._sample)
+            if self._refill_every_seconds:
+                scheduler.every('simulation_refill', self._refill_every_seconds, self._refill,
+                    first_delay=self._refill_every_seconds)
+
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        simulated_started = self.clock.monotonic()
+        end = simulated_started + seconds
+
+        while self.clock.monotonic() < end:
+            scheduler.run_until(min(end, self.clock.monotonic() + RUN_CHUNK_SECONDS), self.clock.advance_to)
+
+        self.controller.history.flush()
+
+        wall_seconds = time.perf_counter() - wall_started
+        cpu_seconds = time.process_time() - cpu_started
+        simulated_days = (self.clock.monotonic() - simulated_started) / DAY_SECONDS
+
+        return {
+            'simulated_days': simulated_days,
+            'wall_seconds': wall_seconds,
+            'speedup': (simulated_days * DAY_SECONDS) / wall_seconds if wall_seconds else math.inf,
+            'cpu_seconds_per_simulated_day': cpu_seconds / simulated_days if simulated_days else 0.0,
+            # ru_maxrss is in kilobytes on Linux.
+            'peak_rss_megabytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'humidity_mean_absolute_error': self._absolute_error_sum / max(1, self._samples),
+            'humidity_in_band_fraction': self._samples_in_band / max(1, self._samples),
+            'humidity_minimum': self._minimum_humidity,
+            'humidity_maximum': self._maximum_humidity,
+            'humidifier_actuations': sum(self.controller.state.humidifier_actuations.values()),
+            'humidifier_presses': self.hardware.humidifier.presses,
+            'measurements': next(job['runs'] for job in scheduler.jobs() if job['name'] == 'measure'),
+            'humidifier_run_hours': self.plant.humidifier_run_seconds / 3600,
+            'water_refills': self.refills,
+            'display_refreshes': self.hardware.display.refreshes,
+            'etcd_puts': self.etcd.puts,
+            'etcd_conflicts': self.etcd.conflicts,
+        }
+
+    def _sample(self):
+        self.plant.advance()
+        humidity = self.plant.humidity
+        error = humidity - self.controller.state.desired_humidity
+
+        self._samples += 1
+        self._absolute_error_sum += abs(error)
+        if abs(error) <= self.controller.configs.humidifier_hysteresis / 2:
+            self._samples_in_band += 1
+        self._minimum_humidity = min(self._minimum_humidity, humidity)
+        self._maximum_humidity = max(self._maximum_humidity, humidity)
+
+    def _refill(self):
+        # Refilled the way a person would: the tank, then telling the controller through the water menu.
+        self.plant.refill()
+        self.refills += 1
+
+        # Menus are walked by looking at where every press lands, so a reordered menu doesn't silently leave the water
+        # level alone. From the general info menu, which the controller returns to by itself, since other menus give the
+        # bottom button another use.
+        state = self.controller.state
+        if state.mode != CheeseCaveControllerMode.GENERAL_INFO:
+            self.controller.return_to_general_menu()
+        for _ in CheeseCaveControllerMode:
+            if state.mode == CheeseCaveControllerMode.WATER_SET:
+                self.hardware.press_button(BOTTOM_BUTTON)
+                return
+            self.hardware.press_button(BOTTOM_BUTTON)
+
+        logger.warning('The water menu is no longer reached with the bottom button. The water level was not reset.')
+
+    def save_last_frame(self, path):
+        if self.hardware.display.frames:
+            self.hardware.display.frame_image(self.hardware.display.frames[-1]).save(path)
+
+    def close(self):
+        if self._temporary_directory is not None:
+            self._temporary_directory.cleanup()
+
+
+def _parse_config_value(text):
+    (name, _, value) = text.partition('=')
+    try:
+        return (name, json.loads(value))
+    except ValueError:
+        return (name, value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the controller against a simulated cave.')
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--sensors', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--desired-humidity', type=float, default=80)
+    parser.add_argument('--sensor-failure-rate', type=float, default=0.0)
+    parser.add_argument('--config', action='append', default=[], type=_parse_config_value, metavar='NAME=VALUE',
+        help='Overrides a config, with the value as JSON (e.g. humidifier_control_mode=\'"pi"\').')
+    parser.add_argument('--last-frame', help='Saves the last frame shown on the display to this image.')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(module)s: %(message)s',
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    simulation = Simulation(
+        configs=dict(args.config),
+        state={'desired_humidity': args.desired_humidity},
+        sensor_count=args.sensors,
+        seed=args.seed,
+        sensor_failure_rate=args.sensor_failure_rate,
+    )
+    try:
+        summary = simulation.run(args.days * DAY_SECONDS)
+        if args.last_frame:
+            simulation.save_last_frame(args.last_frame)
+    finally:
+        simulation.close()
+
+    print(json.dumps(summary, indent=2))
@@ -1,6 +1,13 @@
 from enum import Enum
 import time
-from etcdstate import EtcdBackedState
+from datetime import date, timedelta
+from etcdstate import SNAPSHOT_DIRECTORY, EtcdBackedState
+from schema import Field, at_least, optional
+from stats import EMPTY_WINDOW_STATS
+
+
+# How many days of humidifier actuation counts are kept in the state.
+HUMIDIFIER_ACTUATION_DAYS_KEPT = 30
 
 
 class CheeseCaveControllerMode(Enum):
@@ -8,56 +15,75 @@ class CheeseCaveControllerMode(Enum):
     HUMIDITY_SET = 1
     SETTINGS = 2
     WATER_SET = 3
+    HISTORY = 4
+
+
+def _merge_actuations(base, local, remote):
+    # Counts only ever go up, so the highest of both sides is never an undercount.
+    return {day: max(local.get(day, 0), remote.get(day, 0)) for day in local.keys() | remote.keys()}
 
 
 class CheeseCaveState(EtcdBackedState):
-    def __init__(self, shutdown_hook=None):
-        super().__init__('/cheesecave/state')
+    __slots__ = ('temperature', 'humidity', 'temperature_stats', 'humidity_stats', 'sensor_health', 'mode',
+        '_shutdown_hook', '_time')
+
+    desired_humidity = Field(50)
+    has_water = Field(True)
+    heater_on = Field(False)
+    humidifier_state = Field(False)
+    time_humidifier_turned_on = Field(None, optional(float))
+    total_humidifier_run_time = Field(0, validate=at_least(0))
+    humidifier_capacity_time_seconds = Field(4 * 60 * 60, validate=at_least(1))  # 4 hours
+    # How many times the humidifier was switched on or off, per day (ISO dates).
+    humidifier_actuations = Field({}, merge=_merge_actuations)
+
+    def __init__(self, shutdown_hook=None, scheduler=None, connection=None, snapshot_directory=SNAPSHOT_DIRECTORY,
+            time_func=time.time):
+        self._time = time_func
+        super().__init__('/cheesecave/state', scheduler, connection, snapshot_directory)
 
         self.temperature = 0
         self.humidity = 0
+        # Rolling window statistics (`stats.WindowStats`) of the averaged measurements. Trends are in units per second.
+        self.temperature_stats = EMPTY_WINDOW_STATS
+        self.humidity_stats = EMPTY_WINDOW_STATS
+        # Health of every sensor, as `sensorhealth.SensorStatus`.
+        self.sensor_health = []
         self.mode = CheeseCaveControllerMode.GENERAL_INFO
         self._shutdown_hook = shutdown_hook
 
-    def default_state(self):
-        return {
-            'desired_humidity': 50,
-            'has_water': True,
-            'heater_on': False,
-            'humidifier_state': False,
-            'time_humidifier_turned_on': None,
-            'total_humidifier_run_time': 0,
-            'humidifier_capacity_time_seconds': 4 * 60 * 60,  # 4 hours
-        }
-
-    @property
-    def desired_humidity(self):
-        return self.state['desired_humidity']
-
     @desired_humidity.setter
     def desired_humidity(self, value):
-        value = max(0, min(100, value))
-        self.state['desired_humidity'] = value
-
-    @property
-    def humidifier_state(self):
-        return self.state['humidifier_state']
+        self._set_field('desired_humidity', max(0, min(100, value)))
 
     @humidifier_state.setter
     def humidifier_state(self, value):
+        if value == self.humidifier_state:
+            return
+
         if value:
-            self.state['time_humidifier_turned_on'] = time.time()
+            self._set_field('time_humidifier_turned_on', self._time())
         else:
-            self.state['total_humidifier_run_time'] += time.time() - \
-                self.state['time_humidifier_turned_on']
-            self.state['time_humidifier_turned_on'] = None
+            if self.time_humidifier_turned_on is not None:
+                self._set_field('total_humidifier_run_time', self.total_humidifier_run_time + self._time() - \
+                    self.time_humidifier_turned_on)
+            self._set_field('time_humidifier_turned_on', None)
+
+        self._set_field('humidifier_state', value)
+        self._count_humidifier_actuation()
+
+    def _count_humidifier_actuation(self):
+        today = date.fromtimestamp(self._time())
+        oldest_kept = (today - timedelta(days=HUMIDIFIER_ACTUATION_DAYS_KEPT)).isoformat()
 
-        self.state['humidifier_state'] = value
+        # Replaced with a new dict rather than mutated, so the change is noticed and stored.
+        actuations = {day: count for day, count in self.humidifier_actuations.items() if day > oldest_kept}
+        actuations[today.isoformat()] = actuations.get(today.isoformat(), 0) + 1
+        self._set_field('humidifier_actuations', actuations)
 
     @property
     def water_level(self):
-        used_water_percentage = self.state['total_humidifier_run_time'] / \
-            self.state['humidifier_capacity_time_seconds']
+        used_water_percentage = self.total_humidifier_run_time / self.humidifier_capacity_time_seconds
 
         if used_water_percentage < 0.05:
             return 1
@@ -65,23 +91,35 @@ class CheeseCaveState(EtcdBackedState):
         return 1 - used_water_percentage
 
     def top_button_pressed(self):
-        if self.mode == CheeseCaveControllerMode.GENERAL_INFO:
-            self.mode = CheeseCaveControllerMode.HUMIDITY_SET
-        elif self.mode == CheeseCaveControllerMode.HUMIDITY_SET:
-            self.desired_humidity = self.desired_humidity + 1
-        elif self.mode == CheeseCaveControllerMode.SETTINGS:
-            if self._shutdown_hook is not None:
-                self._shutdown_hook()
-        elif self.mode == CheeseCaveControllerMode.WATER_SET:
-            self.state['has_water'] = False
+        # Held throughout, since the desired humidity is read before being changed.
+        with self.atomic():
+            mode = self.mode
+            if mode == CheeseCaveControllerMode.GENERAL_INFO:
+                self.mode = CheeseCaveControllerMode.HUMIDITY_SET
+            elif mode == CheeseCaveControllerMode.HUMIDITY_SET:
+                self.desired_humidity = self.desired_humidity + 1
+            elif mode == CheeseCaveControllerMode.WATER_SET:
+                self.has_water = False
+            elif mode == CheeseCaveControllerMode.HISTORY:
+                self.mode = CheeseCaveControllerMode.GENERAL_INFO
+
+        # Outside of the lock, since shutting down waits for other threads that may need the state.
+        if mode == CheeseCaveControllerMode.SETTINGS and self._shutdown_hook is not None:
+            self._shutdown_hook()
 
     def bottom_button_pressed(self):
-        if self.mode == CheeseCaveControllerMode.GENERAL_INFO:
-            self.mode = CheeseCaveControllerMode.SETTINGS
-        elif self.mode == CheeseCaveControllerMode.HUMIDITY_SET:
-            self.desired_humidity = self.desired_humidity - 1
-        elif self.mode == CheeseCaveControllerMode.SETTINGS:
-            self.mode = CheeseCaveControllerMode.WATER_SET
-        elif self.mode == CheeseCaveControllerMode.WATER_SET:
-            self.state['has_water'] = True
-            self.state['total_humidifier_run_time'] = 0
+        with self.atomic():
+            if self.mode == CheeseCaveControllerMode.GENERAL_INFO:
+                self.mode = CheeseCaveControllerMode.HISTORY
+            elif self.mode == CheeseCaveControllerMode.HISTORY:
+                self.mode = CheeseCaveControllerMode.SETTINGS
+            elif self.mode == CheeseCaveControllerMode.HUMIDITY_SET:
+                self.desired_humidity = self.desired_humidity - 1
+            elif self.mode == CheeseCaveControllerMode.SETTINGS:
+                self.mode = CheeseCaveControllerMode.WATER_SET
+            elif self.mode == CheeseCaveControllerMode.WATER_SET:
+                self.has_water = True
+                self.total_humidifier_run_time = 0
+                # A running humidifier only uses the new water from now on.
+                if self.time_humidifier_turned_on is not None:
+                    self.time_humidifier_turned_on = self._time()
@@ -0,0 +1,264 @@
+import math
+from array import array
+from collections import deque, namedtuple
+
+
+WindowStats = namedtuple('WindowStats',
+    ['count', 'mean', 'minimum', 'maximum', 'variance', 'stddev', 'trend', 'trend_stderr'])
+EMPTY_WINDOW_STATS = WindowStats(0, 0, 0, 0, 0, 0, 0, 0)
+
+
+class RollingStats:
+    """Streaming statistics over the last `capacity` samples of a series or, with `window_seconds`, over the samples of
+    the last `window_seconds` (with `capacity` as the most it keeps).
+
+    Samples live in a preallocated ring buffer and every aggregate is updated in constant (amortised) time per sample:
+    the mean and variance with a sliding-window version of Welford's method, min/max with monotonic deques and the
+    trend (least-squares slope, in units per second) with running regression sums. A time-based window keeps averages
+    right when samples don't come at a fixed rate.
+    """
+
+    def __init__(self, capacity, window_seconds=None):
+        if capacity < 1:
+            raise ValueError('RollingStats needs a capacity of at least 1.')
+
+        self._capacity = capacity
+        self._window_seconds = window_seconds
+        self._values = array('d', bytes(8 * capacity))
+        self._timestamps = array('d', bytes(8 * capacity))
+        # Index where the next sample is written.
+        self._head = 0
+        self._count = 0
+        # Total samples ever added. Used as a sequence number by the min/max deques.
+        self._added = 0
+
+        self._mean = 0.0
+        self._m2 = 0.0
+
+        # Deques of (sequence number, value) whose values are monotonic, so the front is always the window min/max.
+        self._min_candidates = deque()
+        self._max_candidates = deque()
+
+        # Regression sums, with timestamps taken relative to `_time_base` to keep them small.
+        self._time_base = 0.0
+        self._sum_t = 0.0
+        self._sum_tt = 0.0
+        self._sum_tv = 0.0
+        # Running sums slowly accumulate floating point error, so they are recomputed from the buffer once per lap.
+        self._adds_since_resync = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def window_seconds(self):
+        return self._window_seconds
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def minimum(self):
+        return self._min_candidates[0][1] if self._min_candidates else 0
+
+    @property
+    def maximum(self):
+        return self._max_candidates[0][1] if self._max_candidates else 0
+
+    @property
+    def variance(self):
+        if self._count == 0:
+            return 0
+
+        return max(0.0, self._m2 / self._count)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    def _time_spread(self):
+        # Sum of squared deviations of the timestamps from their mean.
+        return self._sum_tt - self._sum_t * self._sum_t / self._count
+
+    @property
+    def trend(self):
+        if self._count < 2:
+            return 0
+
+        denominator = self._time_spread()
+        if denominator <= 0:
+            return 0
+
+        return (self._sum_tv - self._sum_t * self._mean) / denominator
+
+    @property
+    def trend_stderr(self):
+        """Standard error of the trend: how much of it could be noise. 0 until there are at least 3 samples."""
+        if self._count < 3:
+            return 0
+
+        denominator = self._time_spread()
+        if denominator <= 0:
+            return 0
+
+        # What's left of the variance once the trend is taken out of it.
+        residual = max(0.0, self._m2 - self.trend ** 2 * denominator)
+        return math.sqrt(residual / (self._count - 2) / denominator)
+
+    def snapshot(self):
+        return WindowStats(self._count, self._mean, self.minimum, self.maximum, self.variance, self.stddev, self.trend,
+            self.trend_stderr)
+
+    def add(self, value, timestamp):
+        if self._window_seconds is not None:
+            self._expire(timestamp)
+
+        if self._count == 0:
+            self._time_base = timestamp
+
+        if self._count == self._capacity:
+            self._replace_oldest(value, timestamp)
+        else:
+            self._grow(value, timestamp)
+
+        sequence = self._added
+        self._added += 1
+
+        while self._min_candidates and self._min_candidates[-1][1] >= value:
+            self._min_candidates.pop()
+        self._min_candidates.append((sequence, value))
+
+        while self._max_candidates and self._max_candidates[-1][1] <= value:
+            self._max_candidates.pop()
+        self._max_candidates.append((sequence, value))
+
+        self._drop_expired_candidates()
+
+        self._adds_since_resync += 1
+        if self._adds_since_resync >= self._capacity:
+            self._resync()
+
+    def resize(self, capacity, window_seconds=None):
+        """Changes how many samples (and how much time) the window holds, keeping the newest samples that still fit."""
+        if capacity < 1:
+            raise ValueError('RollingStats needs a capacity of at least 1.')
+
+        samples = [(self._values[i], self._timestamps[i]) for i in self._ordered_indices()]
+        self.__init__(capacity, window_seconds)
+        for (value, timestamp) in samples[-capacity:]:
+            self.add(value, timestamp)
+
+    def _drop_expired_candidates(self):
+        oldest_sequence = self._added - self._count
+        while self._min_candidates and self._min_candidates[0][0] < oldest_sequence:
+            self._min_candidates.popleft()
+        while self._max_candidates and self._max_candidates[0][0] < oldest_sequence:
+            self._max_candidates.popleft()
+
+    def _expire(self, now):
+        # Samples exactly `window_seconds` old are out, so a window of 60s sampled every 5s holds 12 samples.
+        oldest_kept = now - self._window_seconds
+        expired = False
+
+        while self._count > 0:
+            tail = (self._head - self._count) % self._capacity
+            if self._timestamps[tail] > oldest_kept:
+                break
+
+            self._remove_oldest(tail)
+            expired = True
+
+        if expired:
+            self._drop_expired_candidates()
+
+    def _remove_oldest(self, tail):
+        old_value = self._values[tail]
+        old_t = self._timestamps[tail] - self._time_base
+        self._count -= 1
+
+        if self._count == 0:
+            self._mean = 0.0
+            self._m2 = 0.0
+            self._sum_t = 0.0
+            self._sum_tt = 0.0
+            self._sum_tv = 0.0
+            return
+
+        old_mean = self._mean
+        self._mean -= (old_value - old_mean) / self._count
+        self._m2 -= (old_value - old_mean) * (old_value - self._mean)
+
+        self._sum_t -= old_t
+        self._sum_tt -= old_t * old_t
+        self._sum_tv -= old_t * old_value
+
+    def _grow(self, value, timestamp):
+        self._values[self._head] = value
+        self._timestamps[self._head] = timestamp
+        self._head = (self._head + 1) % self._capacity
+        self._count += 1
+
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (value - self._mean)
+
+        t = timestamp - self._time_base
+        self._sum_t += t
+        self._sum_tt += t * t
+        self._sum_tv += t * value
+
+    def _replace_oldest(self, value, timestamp):
+        old_value = self._values[self._head]
+        old_t = self._timestamps[self._head] - self._time_base
+
+        self._values[self._head] = value
+        self._timestamps[self._head] = timestamp
+        self._head = (self._head + 1) % self._capacity
+
+        old_mean = self._mean
+        self._mean += (value - old_value) / self._count
+        self._m2 += (value - old_value) * (value - self._mean + old_value - old_mean)
+
+        t = timestamp - self._time_base
+        self._sum_t += t - old_t
+        self._sum_tt += t * t - old_t * old_t
+        self._sum_tv += t * value - old_t * old_value
+
+    def _ordered_indices(self):
+        start = (self._head - self._count) % self._capacity
+        return ((start + i) % self._capacity for i in range(self._count))
+
+    def _resync(self):
+        self._adds_since_resync = 0
+
+        indices = list(self._ordered_indices())
+        self._time_base = self._timestamps[indices[0]]
+
+        mean = 0.0
+        m2 = 0.0
+        sum_t = 0.0
+        sum_tt = 0.0
+        sum_tv = 0.0
+
+        for n, i in enumerate(indices, start=1):
+            value = self._values[i]
+            delta = value - mean
+            mean += delta / n
+            m2 += delta * (value - mean)
+
+            t = self._timestamps[i] - self._time_base
+            sum_t += t
+            sum_tt += t * t
+            sum_tv += t * value
+
+        self._mean = mean
+        self._m2 = m2
+        self._sum_t = sum_t
+        self._sum_tt = sum_tt
+        self._sum_tv = sum_tv